@@ -0,0 +1,195 @@
+"""Reproducible synthetic DICOM corpora for the benchmarks. The same seed
+gives byte-identical files, so results of different commits can be compared.
+
+Kinds of files:
+- cr: small CR header with a tiny image
+- sr: structured report with deeply nested content sequences
+- mr: large multi-frame MR image
+- private: vendor file with many private blocks
+"""
+
+import random
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian
+
+# root for UIDs of generated files (UUID derived, see DICOM PS3.5 B.2)
+_UID_ROOT = "2.25."
+
+SOP_CLASSES = {
+    "cr": "1.2.840.10008.5.1.4.1.1.1",
+    "sr": "1.2.840.10008.5.1.4.1.1.88.33",
+    "mr": "1.2.840.10008.5.1.4.1.1.4.1",
+    "private": "1.2.840.10008.5.1.4.1.1.2",
+}
+
+
+def _uid(rng: random.Random) -> str:
+    return _UID_ROOT + str(rng.getrandbits(120))
+
+
+def _name(rng: random.Random) -> str:
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return "^".join("".join(rng.choices(letters, k=8)) for _ in range(2))
+
+
+def _base_dataset(rng: random.Random, kind: str) -> FileDataset:
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SOP_CLASSES[kind]
+    file_meta.MediaStorageSOPInstanceUID = _uid(rng)
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = _UID_ROOT + "1"
+    ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = _uid(rng)
+    ds.SeriesInstanceUID = _uid(rng)
+    ds.FrameOfReferenceUID = _uid(rng)
+    ds.PatientName = _name(rng)
+    ds.PatientID = str(rng.randrange(10**9))
+    ds.PatientBirthDate = (
+        f"19{rng.randrange(30, 99)}0{rng.randrange(1, 9)}1{rng.randrange(0, 9)}"
+    )
+    ds.PatientSex = rng.choice(["M", "F", "O"])
+    ds.StudyDate = ds.SeriesDate = ds.ContentDate = "20210315"
+    ds.StudyTime = ds.SeriesTime = ds.ContentTime = "101530.000000"
+    ds.AccessionNumber = str(rng.randrange(10**7))
+    ds.InstitutionName = "Synthetic Hospital"
+    ds.ReferringPhysicianName = _name(rng)
+    ds.StationName = "STATION1"
+    ds.StudyDescription = "Synthetic study"
+    ds.SeriesDescription = f"Synthetic {kind} series"
+    ds.Modality = {"cr": "CR", "sr": "SR", "mr": "MR", "private": "CT"}[kind]
+    return ds
+
+
+def _add_pixels(
+    ds: FileDataset, rng: random.Random, rows: int, columns: int, frames: int = 1
+):
+    ds.Rows, ds.Columns = rows, columns
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 12, 11
+    ds.SamplesPerPixel, ds.PixelRepresentation = 1, 0
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    n_bytes = rows * columns * frames * 2
+    ds.PixelData = rng.getrandbits(8 * n_bytes).to_bytes(n_bytes, "little")
+    ds["PixelData"].VR = "OW"
+
+
+def make_cr(rng: random.Random) -> FileDataset:
+    """Small CR header with a 64x64 image"""
+    ds = _base_dataset(rng, "cr")
+    ds.BodyPartExamined = "CHEST"
+    ds.ViewPosition = "PA"
+    ds.KVP = "120"
+    ds.Exposure = "4"
+    _add_pixels(ds, rng, 64, 64)
+    return ds
+
+
+def make_sr(rng: random.Random, depth: int = 6, width: int = 3) -> FileDataset:
+    """Structured report, content sequences nested `depth` levels, `width` items each"""
+    ds = _base_dataset(rng, "sr")
+    ds.ValueType = "CONTAINER"
+    ds.CompletionFlag = "COMPLETE"
+    ds.VerificationFlag = "UNVERIFIED"
+
+    def content(level):
+        items = []
+        for i in range(width):
+            item = pydicom.Dataset()
+            item.RelationshipType = "CONTAINS"
+            item.ValueType = "TEXT" if level == depth else "CONTAINER"
+            item.TextValue = f"Finding {level}.{i} of {_name(rng)}"
+            item.ReferencedSOPSequence = Sequence([pydicom.Dataset()])
+            item.ReferencedSOPSequence[0].ReferencedSOPClassUID = SOP_CLASSES["cr"]
+            item.ReferencedSOPSequence[0].ReferencedSOPInstanceUID = _uid(rng)
+            if level < depth:
+                item.ContentSequence = content(level + 1)
+            items.append(item)
+        return Sequence(items)
+
+    ds.ContentSequence = content(1)
+    return ds
+
+
+def make_mr(rng: random.Random, frames: int = 64, size: int = 256) -> FileDataset:
+    """Multi-frame MR, `frames` frames of `size` x `size` 16 bit pixels"""
+    ds = _base_dataset(rng, "mr")
+    ds.MagneticFieldStrength = "3"
+    ds.SequenceName = "*tfl3d1"
+    ds.PerFrameFunctionalGroupsSequence = Sequence(
+        [pydicom.Dataset() for _ in range(frames)]
+    )
+    for i, item in enumerate(ds.PerFrameFunctionalGroupsSequence):
+        item.FrameContentSequence = Sequence([pydicom.Dataset()])
+        item.FrameContentSequence[0].InStackPositionNumber = i + 1
+    _add_pixels(ds, rng, size, size, frames)
+    return ds
+
+
+def make_private(
+    rng: random.Random, blocks: int = 16, elements: int = 32
+) -> FileDataset:
+    """Vendor CT file with `blocks` private blocks of `elements` elements each"""
+    ds = _base_dataset(rng, "private")
+    for b in range(blocks):
+        group = 0x0009 + 2 * (b % 8)
+        block = ds.private_block(group, f"VENDOR {b}", create=True)
+        for e in range(elements):
+            block.add_new(e, "LO", f"value {rng.randrange(10**6)}")
+    _add_pixels(ds, rng, 128, 128)
+    return ds
+
+
+MAKERS: Dict[str, Callable[[random.Random], FileDataset]] = {
+    "cr": make_cr,
+    "sr": make_sr,
+    "mr": make_mr,
+    "private": make_private,
+}
+
+
+def make_dataset(kind: str, seed: int) -> FileDataset:
+    """Generate one dataset of the `kind`
+
+    Args:
+        kind (str): one of MAKERS
+        seed (int): random seed
+
+    Returns:
+        FileDataset: dataset
+    """
+    return MAKERS[kind](random.Random(f"{kind}-{seed}"))
+
+
+def write_tree(
+    root: Path, kind: str, n_files: int, files_per_folder: int = 50, depth: int = 2
+) -> List[Path]:
+    """Write `n_files` files of the `kind` into a tree of folders `depth` levels deep,
+    at most `files_per_folder` files per leaf folder
+
+    Args:
+        root (Path): root folder, created if not exists
+        kind (str): one of MAKERS
+        n_files (int): number of files
+        files_per_folder (int, optional): files per leaf folder. Defaults to 50.
+        depth (int, optional): depth of the leaf folders. Defaults to 2.
+
+    Returns:
+        List[Path]: paths of the written files
+    """
+    paths = []
+    for i in range(n_files):
+        folder = i // files_per_folder
+        parts = [f"d{(folder >> (4 * level)) % 16}" for level in range(depth - 1)]
+        path = root.joinpath(*parts, f"s{folder}", f"{kind}_{i:06d}.dcm")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        make_dataset(kind, i).save_as(path)
+        paths.append(path)
+    return paths
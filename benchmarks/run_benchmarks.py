@@ -0,0 +1,242 @@
+"""Throughput benchmarks of the anonymization entry points on synthetic corpora
+(see corpus.py). Results are printed (or saved) as JSON, so runs of different
+commits can be compared:
+
+    python benchmarks/run_benchmarks.py --files 200 --out bench.json
+
+Every benchmark reports number of files, files/s, MB/s (of the source files),
+p50/p99 latency of one file and peak RSS of the process. Folder benchmarks
+anonymize files in one call, their latencies are the read + anonymize + write
+timings of the files (see `FileResult`), throughput is of the whole call.
+"""
+
+import argparse
+import json
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import pydicom
+from corpus import MAKERS, make_dataset, write_tree
+
+from dicomanonymizer import __version__, batch_anonymizer
+from dicomanonymizer.result_manifest import ResultManifestWriter
+from dicomanonymizer.simpledicomanonymizer import (
+    anonymize_bytes,
+    anonymize_dataset,
+    anonymize_dicom_file,
+    build_plan,
+)
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _report(
+    n_files: int, n_bytes: int, latencies: List[float], total: float = 0.0
+) -> Dict[str, float]:
+    # files are processed one after another, unless the total (wall) time is given
+    total = total or sum(latencies)
+    return {
+        "files": n_files,
+        "files_per_s": n_files / total,
+        "mb_per_s": n_bytes / 2**20 / total,
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p99_ms": 1000 * _percentile(latencies, 0.99),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _timed_calls(calls: List[Callable[[], None]]) -> List[float]:
+    latencies = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _timed_run(
+    run: Callable[..., None], results_path: Path
+) -> Tuple[float, List[float]]:
+    """Time the call, which anonymizes many files, `run(results=...)`
+
+    Returns:
+        Tuple[float, List[float]]: seconds of the call and per file latencies,
+        read from the result manifest
+    """
+    results_path.unlink(missing_ok=True)
+    with ResultManifestWriter(results_path) as results:
+        start = time.perf_counter()
+        run(results=results)
+        total = time.perf_counter() - start
+    with open(results_path) as fin:
+        records = [json.loads(line) for line in fin]
+    return total, [sum(record["timings"].values()) for record in records]
+
+
+def bench_dataset(kind: str, n_files: int, plan) -> Dict[str, float]:
+    """`anonymize_dataset` on datasets in memory (parsing and writing not included,
+    MB/s counts pixel data only)"""
+    datasets = [make_dataset(kind, i) for i in range(n_files)]
+    # element values are converted on first access, do it before timing
+    for ds in datasets:
+        ds.walk(lambda ds, elem: None)
+    n_bytes = sum(len(ds.PixelData) for ds in datasets if "PixelData" in ds)
+    latencies = _timed_calls(
+        [lambda ds=ds: anonymize_dataset(ds, plan=plan) for ds in datasets]
+    )
+    return _report(n_files, n_bytes, latencies)
+
+
+def bench_file(paths: List[Path], out: Path, plan, **kwargs) -> Dict[str, float]:
+    """`anonymize_dicom_file` file by file"""
+    out.mkdir(parents=True, exist_ok=True)
+    latencies = _timed_calls(
+        [
+            lambda p=p: anonymize_dicom_file(p, out / p.name, plan=plan, **kwargs)
+            for p in paths
+        ]
+    )
+    return _report(len(paths), sum(p.stat().st_size for p in paths), latencies)
+
+
+def bench_bytes(paths: List[Path], plan) -> Dict[str, float]:
+    """`anonymize_bytes` on file data in memory (reading the files not included)"""
+    buffers = [p.read_bytes() for p in paths]
+    latencies = _timed_calls(
+        [lambda data=data: anonymize_bytes(data, plan=plan) for data in buffers]
+    )
+    return _report(len(paths), sum(len(data) for data in buffers), latencies)
+
+
+def bench_folder(paths: List[Path], out: Path, plan, **kwargs) -> Dict[str, float]:
+    """`anonymize_dicom_folder` of the folder of the first file"""
+    folder = paths[0].parent
+    files = [p for p in paths if p.parent == folder]
+    total, latencies = _timed_run(
+        lambda results: batch_anonymizer.anonymize_dicom_folder(
+            folder, out, plan=plan, results=results, **kwargs
+        ),
+        out.with_name(out.name + "_results.jsonl"),
+    )
+    return _report(len(files), sum(p.stat().st_size for p in files), latencies, total)
+
+
+def bench_root_folder(
+    root: Path, paths: List[Path], out: Path, plan, **kwargs
+) -> Dict[str, float]:
+    """`anonymize_root_folder` of the whole tree, with a fresh state kept next to `out`"""
+    # anonymize_root_folder saves its state, keep it away from the user's one
+    # (and from the other runs, the state is keyed by relative paths only)
+    batch_anonymizer._STATE_PATH = out.with_name(out.name + "_state")
+    # a reused --workdir keeps both from the previous run, visited folders would
+    # be skipped without being anonymized
+    for path in (batch_anonymizer._STATE_PATH, out):
+        shutil.rmtree(path, ignore_errors=True)
+    batch_anonymizer._STATE_PATH.mkdir(parents=True)
+    total, latencies = _timed_run(
+        lambda results: batch_anonymizer.anonymize_root_folder(
+            root, out, plan=plan, results=results, **kwargs
+        ),
+        out.with_name(out.name + "_results.jsonl"),
+    )
+    return _report(len(paths), sum(p.stat().st_size for p in paths), latencies, total)
+
+
+def run(kinds: List[str], n_files: int, workdir: Path, workers: int) -> dict:
+    """Generate corpora and run all benchmarks
+
+    Args:
+        kinds (List[str]): kinds of files, see corpus.MAKERS
+        n_files (int): number of files per kind
+        workdir (Path): folder for the corpora, anonymized copies and state
+        workers (int): worker processes of the folder benchmarks
+
+    Returns:
+        dict: machine info and results per kind and benchmark
+    """
+    plan = build_plan()
+    results = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "pydicom": pydicom.__version__,
+        "platform": platform.platform(),
+        "files_per_kind": n_files,
+        "workers": workers,
+        "benchmarks": {},
+    }
+    for kind in kinds:
+        root = workdir / "src" / kind
+        paths = write_tree(root, kind, n_files)
+        out = workdir / "dst" / kind
+        results["benchmarks"][kind] = {
+            "anonymize_dataset": bench_dataset(kind, min(n_files, 50), plan),
+            "anonymize_dicom_file": bench_file(paths, out / "file", plan),
+            "anonymize_bytes": bench_bytes(paths, plan),
+            "anonymize_dicom_folder": bench_folder(
+                paths, out / "folder", plan, workers=workers
+            ),
+            "anonymize_root_folder": bench_root_folder(
+                root, paths, out / "root", plan, workers=workers
+            ),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Anonymization benchmarks")
+    parser.add_argument(
+        "--kinds",
+        nargs="+",
+        choices=sorted(MAKERS),
+        default=sorted(MAKERS),
+        help="Kinds of synthetic files, default = all",
+    )
+    parser.add_argument(
+        "--files", type=int, default=100, help="Files per kind, default = 100"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes of the folder benchmarks, default = 1",
+    )
+    parser.add_argument(
+        "--workdir",
+        default="",
+        help="Folder for the corpora (temporary folder by default, removed after the run)",
+    )
+    parser.add_argument("--out", default="", help="Save JSON results to the file")
+    args = parser.parse_args()
+    # random UIDs of the default plan are often not valid, pydicom warns on each
+    warnings.filterwarnings("ignore", category=UserWarning, module="pydicom")
+
+    if args.workdir:
+        results = run(args.kinds, args.files, Path(args.workdir), args.workers)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run(args.kinds, args.files, Path(workdir), args.workers)
+    report = json.dumps(results, indent=2)
+    if args.out:
+        Path(args.out).write_text(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Cold start time of the CLI and of the library import, every command is run in
+a fresh interpreter. Reported as JSON: median wall time and the overhead over
+a bare interpreter start, checked against budgets (exit code 1 if exceeded):
+
+    python benchmarks/startup.py --runs 20 --out startup.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+PROJ_ROOT = Path(__file__).absolute().parent.parent
+
+COMMANDS: Dict[str, List[str]] = {
+    "python": ["-c", "pass"],
+    "help": ["-m", "dicomanonymizer.cli", "--help"],
+    "import": ["-c", "import dicomanonymizer"],
+    "import_api": ["-c", "from dicomanonymizer import anonymize_dataset"],
+    "import_batch": ["-c", "import dicomanonymizer.batch_anonymizer"],
+}
+
+# budgets of the overhead over the bare interpreter start, ms
+BUDGETS_MS = {
+    "help": 50,
+    "import": 20,
+}
+
+
+def measure(args: List[str], runs: int, env: Dict[str, str]) -> float:
+    """Median wall time of `runs` runs of python with `args`, ms"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable] + args, env=env, check=True, stdout=subprocess.DEVNULL
+        )
+        times.append(time.perf_counter() - start)
+    return 1000 * statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup benchmarks")
+    parser.add_argument("--runs", type=int, default=10, help="Runs per command")
+    parser.add_argument("--out", default="", help="Save JSON results to the file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        # an empty home also shows that nothing is created on import
+        env = dict(os.environ, HOME=home, PYTHONPATH=str(PROJ_ROOT))
+        median_ms = {
+            name: measure(cmd, args.runs, env) for name, cmd in COMMANDS.items()
+        }
+        created = os.listdir(home)
+    results = {
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "median_ms": median_ms,
+        "overhead_ms": {
+            name: ms - median_ms["python"] for name, ms in median_ms.items()
+        },
+        "budgets_ms": BUDGETS_MS,
+        "created_in_home": created,
+    }
+    over_budget = [
+        name
+        for name, budget in BUDGETS_MS.items()
+        if results["overhead_ms"][name] > budget
+    ]
+    results["over_budget"] = over_budget
+    report = json.dumps(results, indent=2)
+    if args.out:
+        Path(args.out).write_text(report)
+    print(report)
+    sys.exit(1 if over_budget or created else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,21 @@
-from .anonymizer import anonymize
-from .simpledicomanonymizer import *
+import importlib
 
 __version__ = "2.0.0"  # TODO: update version
+
+
+def __getattr__(name):
+    # the API of `simpledicomanonymizer` (and `anonymize`) is imported on first use,
+    # so `import dicomanonymizer` and the CLI don't import pydicom and tqdm up front
+    if name == "anonymize":
+        return importlib.import_module(".anonymizer", __name__).anonymize
+    if name.startswith("__") and name != "__all__":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    simpledicomanonymizer = importlib.import_module(".simpledicomanonymizer", __name__)
+    if name == "__all__":
+        # `from dicomanonymizer import *`
+        public = [n for n in vars(simpledicomanonymizer) if not n.startswith("_")]
+        return public + ["anonymize"]
+    try:
+        return getattr(simpledicomanonymizer, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
@@ -0,0 +1,184 @@
+"""This module wraps anonymization rules (tag -> action function mapping)
+into an immutable plan. The plan is built once from the de-id profile and
+extra rules and then reused for every anonymized dataset.
+"""
+import functools
+import hashlib
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Callable, Mapping, Tuple
+
+from pydicom.tag import Tag
+
+from .utils import ActionsDict, TagTuple
+
+# (7FE0,0008) Float Pixel Data, (7FE0,0009) Double Float Pixel Data, (7FE0,0010) Pixel Data
+PIXEL_DATA_TAGS = (0x7FE00008, 0x7FE00009, 0x7FE00010)
+
+# (group_mask, element_mask, {masked (group, element): (rule position, tag, action)})
+MaskIndexEntry = Tuple[
+    int, int, Mapping[Tuple[int, int], Tuple[int, TagTuple, Callable]]
+]
+
+
+def _to_ints(tag: TagTuple) -> Tuple[int, ...]:
+    """Tags from json files are strings like "0xFF00", convert them to ints"""
+    return tuple(int(x, 16) if isinstance(x, str) else int(x) for x in tag)
+
+
+def _action_key(action: Callable) -> str:
+    """Stable (between processes and runs) description of the action function"""
+    if isinstance(action, functools.partial):
+        keywords = sorted(action.keywords.items())
+        return f"{_action_key(action.func)}{action.args!r}{keywords!r}"
+    name = getattr(action, "__qualname__", None) or repr(action)
+    return f"{getattr(action, '__module__', '')}.{name}"
+
+
+@dataclass(frozen=True)
+class AnonymizationPlan:
+    """Compiled anonymization rules. Rules are kept in the order they
+    were defined (profile rules first, then extra rules), which is also
+    the order actions are applied in by the per-rule (reference) engine.
+
+    Individual tag rules are additionally indexed by tag as int, so that an
+    element found in a dataset is matched to its rule with one dict lookup.
+    Repeating group rules are indexed by their (group_mask, element_mask) pair,
+    so that one traversal of a dataset tests all of them at once. Index entries
+    keep the rule position, so rules matching the same element are applied in
+    the plan order. Group and element of a repeating group rule must not have bits
+    outside of their masks (such a rule would never match), ValueError is raised.
+
+    The plan is picklable as long as all actions are picklable
+    (module level functions are), so it can be sent to worker processes.
+    """
+
+    rules: Tuple[Tuple[TagTuple, Callable], ...]
+    _actions: Mapping[TagTuple, Callable] = field(init=False, repr=False, compare=False)
+    _tag_index: Mapping[int, Tuple[TagTuple, Callable]] = field(
+        init=False, repr=False, compare=False
+    )
+    _repeating_rules: Tuple[Tuple[TagTuple, Callable], ...] = field(
+        init=False, repr=False, compare=False
+    )
+    _mask_index: Tuple[MaskIndexEntry, ...] = field(
+        init=False, repr=False, compare=False
+    )
+    _touches_pixel_data: bool = field(init=False, repr=False, compare=False)
+    _fingerprint: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        actions = dict(self.rules)
+        tag_index = {}
+        repeating_rules = []
+        masks = {}
+        for position, (tag, action) in enumerate(actions.items()):
+            # (group, element, group_mask, element_mask)
+            if len(tag) > 2:
+                group, element, group_mask, element_mask = _to_ints(tag)
+                if group & group_mask != group or element & element_mask != element:
+                    # such a rule never matches in the per-rule engine (see
+                    # `walk_repeating_group`), the index would match other tags
+                    raise ValueError(
+                        f"Repeating group rule {tag} has group or element bits "
+                        "outside of its masks"
+                    )
+                repeating_rules.append((tag, action))
+                masked = masks.setdefault((group_mask, element_mask), {})
+                masked[(group & group_mask, element & element_mask)] = (
+                    position,
+                    tag,
+                    action,
+                )
+            else:
+                # tags from json files are strings like ("0x0008", "0x0012")
+                tag_index[int(Tag(tag))] = (tag, action)
+        mask_index = tuple(
+            (group_mask, element_mask, MappingProxyType(masked))
+            for (group_mask, element_mask), masked in masks.items()
+        )
+        object.__setattr__(self, "_actions", MappingProxyType(actions))
+        object.__setattr__(self, "_tag_index", MappingProxyType(tag_index))
+        object.__setattr__(self, "_repeating_rules", tuple(repeating_rules))
+        object.__setattr__(self, "_mask_index", mask_index)
+        object.__setattr__(
+            self,
+            "_touches_pixel_data",
+            any(self.matches(tag) for tag in PIXEL_DATA_TAGS),
+        )
+        description = repr([(_to_ints(tag), _action_key(a)) for tag, a in self.rules])
+        object.__setattr__(
+            self, "_fingerprint", hashlib.sha256(description.encode()).hexdigest()
+        )
+
+    def __reduce__(self):
+        # derived lookups are rebuilt from rules on unpickling
+        return (self.__class__, (self.rules,))
+
+    @classmethod
+    def from_actions(cls, actions: ActionsDict) -> "AnonymizationPlan":
+        """Create a plan from a mapping of tag -> action function
+
+        Args:
+            actions (ActionsDict): mapping of tag -> action function
+
+        Returns:
+            AnonymizationPlan: plan holding a copy of `actions`
+        """
+        return cls(tuple(actions.items()))
+
+    @property
+    def actions(self) -> Mapping[TagTuple, Callable]:
+        """Read-only view of tag -> action mapping"""
+        return self._actions
+
+    @property
+    def tag_index(self) -> Mapping[int, Tuple[TagTuple, Callable]]:
+        """Read-only view of int tag -> (tag as defined in rules, action)
+        for individual tag rules
+        """
+        return self._tag_index
+
+    @property
+    def repeating_rules(self) -> Tuple[Tuple[TagTuple, Callable], ...]:
+        """Repeating group rules, tags are (group, element, group_mask, element_mask)"""
+        return self._repeating_rules
+
+    @property
+    def mask_index(self) -> Tuple[MaskIndexEntry, ...]:
+        """Repeating group rules grouped by masks: tuple of (group_mask, element_mask,
+        {(group & group_mask, element & element_mask): (position in the rules, tag, action)})
+        """
+        return self._mask_index
+
+    @property
+    def touches_pixel_data(self) -> bool:
+        """If any rule matches pixel data elements"""
+        return self._touches_pixel_data
+
+    @property
+    def fingerprint(self) -> str:
+        """Hex digest of the rules (tags and actions with their options), the same
+        for equal plans built in different processes and runs
+        """
+        return self._fingerprint
+
+    def matches(self, tag: int) -> bool:
+        """Check if any rule (individual or repeating group) matches the tag
+
+        Args:
+            tag (int): tag as int
+
+        Returns:
+            bool: True if there is a rule for the tag
+        """
+        if tag in self._tag_index:
+            return True
+        group, element = tag >> 16, tag & 0xFFFF
+        return any(
+            (group & group_mask, element & element_mask) in masked
+            for group_mask, element_mask, masked in self._mask_index
+        )
+
+    def __len__(self) -> int:
+        return len(self.rules)
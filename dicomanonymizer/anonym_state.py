@@ -2,21 +2,57 @@
 functionality into python class implementation.
 """
 import json
+import os
+import time
 from collections import Counter
 from dataclasses import dataclass
 from pathlib import Path
 
 
+def _dump_json(obj, path: Path):
+    # write to a temporary file first, so a crash never leaves a truncated file
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as fin:
+        json.dump(obj, fin)
+    os.replace(tmp_path, path)
+
+
 @dataclass
 class AnonState:
+    """Progress of the batch anonymization: visited (completed) folders, counts
+    of seen tags and completed files.
+
+    Completed files and folders are appended to the journal (json lines) in batches
+    of `journal_batch_size` records or every `journal_flush_interval` seconds, so
+    a crash or a kill loses at most the last batch. Every batch is one append write,
+    a torn last line (process killed mid write) is ignored on loading. `save_state`
+    dumps folders and tags to json files and drops journal records of visited folders.
+
+    Completed files are kept in memory (and replayed from the journal on loading) only
+    until their folder is visited. Archive runs keep every completed member: memory and
+    the journal grow with the number of members (about 100 bytes per member). Manifest
+    runs keep only the number of leading manifest entries completed (see
+    `mark_manifest_progress`), dumped to its own json file every `journal_flush_interval`
+    seconds.
+    """
+
     state_path: Path
     vf_filename: str = "state_cache.json"
     tc_filename: str = "tag_cache.json"
+    jn_filename: str = "file_journal.jsonl"
+    mp_filename: str = "manifest_progress.json"
+    journal_batch_size: int = 256
+    journal_flush_interval: float = 5.0
     _inited: bool = False
 
     def init_state(self):
         self.visited_folders = {}
         self.tag_counter = Counter()
+        self.completed_files = set()
+        self.manifest_progress = {}
+        self._journal_buffer = []
+        self._last_flush = time.monotonic()
+        self._last_progress_dump = time.monotonic()
         self._inited = True
 
     def _assert_inited(self):
@@ -28,21 +64,161 @@ class AnonState:
 
         vf_path = self.state_path / self.vf_filename
         tc_path = self.state_path / self.tc_filename
+        mp_path = self.state_path / self.mp_filename
         if vf_path.exists() and vf_path.is_file():
             with open(vf_path, "r") as fout:
                 self.visited_folders = json.load(fout)
         if tc_path.exists() and tc_path.is_file():
             with open(tc_path, "r") as fout:
                 self.tag_counter = Counter(json.load(fout))
+        if mp_path.is_file():
+            with open(mp_path, "r") as fout:
+                self.manifest_progress = json.load(fout)
+        self._load_journal()
+
+    def _load_journal(self):
+        jn_path = self.state_path / self.jn_filename
+        if not jn_path.is_file():
+            return
+        with open(jn_path, "r") as fout:
+            for line in fout:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn line, the process was killed while appending
+                    continue
+                if "file" in record:
+                    self.completed_files.add(record["file"])
+                elif "folder" in record:
+                    self.visited_folders[record["folder"]] = True
+
+    def mark_file_done(self, rel_path: str):
+        """Record completed file, see `is_file_done`
+
+        Args:
+            rel_path (str): path of the file relative to the source root
+        """
+        self._assert_inited()
+        self.completed_files.add(rel_path)
+        self._append({"file": rel_path})
+
+    def mark_folder_done(self, rel_path: str):
+        """Record visited folder (all its files are completed)
+
+        Args:
+            rel_path (str): path of the folder relative to the source root
+        """
+        self._assert_inited()
+        self.visited_folders[rel_path] = True
+        self._append({"folder": rel_path})
+
+    def mark_manifest_progress(self, manifest: str, count: int):
+        """Record the number of leading entries of the manifest completed, the progress
+        is dumped at most every `journal_flush_interval` seconds (and by `save_state`)
+
+        Args:
+            manifest (str): absolute path of the manifest file
+            count (int): number of the completed leading entries
+        """
+        self._assert_inited()
+        self.manifest_progress[manifest] = count
+        if time.monotonic() - self._last_progress_dump >= self.journal_flush_interval:
+            self._dump_manifest_progress()
+
+    def manifest_done(self, manifest: str) -> int:
+        """Get the number of leading entries of the manifest completed by a previous
+        (interrupted) run, see `mark_manifest_progress`
+
+        Args:
+            manifest (str): absolute path of the manifest file
+
+        Returns:
+            int: number of the completed leading entries
+        """
+        return self.manifest_progress.get(manifest, 0)
+
+    def _dump_manifest_progress(self):
+        if self.manifest_progress:
+            _dump_json(self.manifest_progress, self.state_path / self.mp_filename)
+        self._last_progress_dump = time.monotonic()
+
+    def is_file_done(self, rel_path: str) -> bool:
+        """Check if the file was completed by this or a previous (interrupted) run
+
+        Args:
+            rel_path (str): path of the file relative to the source root
+
+        Returns:
+            bool: True if the file is completed
+        """
+        return rel_path in self.completed_files or (
+            str(Path(rel_path).parent) in self.visited_folders
+        )
+
+    def merge(self, other: "AnonState"):
+        """Add progress of the other state (e.g. of another shard): visited folders
+        and completed files are joined, tag counts are summed, the furthest progress
+        of every manifest is kept
+
+        Args:
+            other (AnonState): state to add
+        """
+        self._assert_inited()
+        other._assert_inited()
+        self.visited_folders.update(other.visited_folders)
+        self.tag_counter.update(other.tag_counter)
+        self.completed_files.update(other.completed_files)
+        for manifest, count in other.manifest_progress.items():
+            self.manifest_progress[manifest] = max(
+                count, self.manifest_progress.get(manifest, 0)
+            )
+
+    def _append(self, record: dict):
+        self._journal_buffer.append(json.dumps(record) + "\n")
+        if (
+            len(self._journal_buffer) >= self.journal_batch_size
+            or time.monotonic() - self._last_flush >= self.journal_flush_interval
+        ):
+            self.flush_journal()
+
+    def flush_journal(self):
+        """Append buffered records to the journal"""
+        self._assert_inited()
+        if self._journal_buffer:
+            data = "".join(self._journal_buffer).encode()
+            fd = os.open(
+                self.state_path / self.jn_filename,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o644,
+            )
+            try:
+                # one append write per batch, never interleaved with other writers
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            self._journal_buffer = []
+        self._last_flush = time.monotonic()
 
     def save_state(self):
         self._assert_inited()
+        self.flush_journal()
         vf_path = self.state_path / self.vf_filename
         tc_path = self.state_path / self.tc_filename
-        with open(vf_path, "w") as fin:
-            json.dump(self.visited_folders, fin)
-        with open(tc_path, "w") as fin:
-            json.dump(self.tag_counter, fin)
+        _dump_json(self.visited_folders, vf_path)
+        _dump_json(self.tag_counter, tc_path)
+        self._dump_manifest_progress()
+        # visited folders are saved, keep only files of the folders in progress
+        self.completed_files = {
+            f
+            for f in self.completed_files
+            if str(Path(f).parent) not in self.visited_folders
+        }
+        jn_path = self.state_path / self.jn_filename
+        tmp_path = jn_path.with_name(jn_path.name + ".tmp")
+        with open(tmp_path, "w") as fin:
+            for rel_path in sorted(self.completed_files):
+                fin.write(json.dumps({"file": rel_path}) + "\n")
+        os.replace(tmp_path, jn_path)
 
 
 if __name__ == "__main__":
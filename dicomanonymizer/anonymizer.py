@@ -6,7 +6,7 @@ import sys
 
 import tqdm
 
-from .simpledicomanonymizer import anonymize_dicom_file, generate_actions
+from .simpledicomanonymizer import anonymize_dicom_file, build_plan, generate_actions
 
 
 def anonymize(
@@ -52,13 +52,16 @@ def anonymize(
             input_files_list.append(input_folder + "/" + fileName)
             output_files_list.append(output_folder + "/" + fileName)
 
+    # Compile the rules once for all files
+    plan = build_plan(anonymization_actions)
+
     progress_bar = tqdm.tqdm(total=len(input_files_list))
     for cpt in range(len(input_files_list)):
         anonymize_dicom_file(
             input_files_list[cpt],
             output_files_list[cpt],
-            anonymization_actions,
-            deletePrivateTags,
+            delete_private_tags=deletePrivateTags,
+            plan=plan,
         )
         progress_bar.update(1)
 
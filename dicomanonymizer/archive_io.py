@@ -0,0 +1,174 @@
+"""This module reads and writes tar/zip archives as a stream of (member name, data) pairs,
+so archives are anonymized without being extracted to disk (see
+`batch_anonymizer.anonymize_archive`). A folder can stand for an archive on either side.
+"""
+
+import functools
+import io
+import logging
+import os
+import tarfile
+import time
+import zipfile
+from itertools import chain
+from pathlib import Path, PurePosixPath
+from typing import Callable, Iterator, Optional, Tuple
+
+from .utils import Path_Str, get_dirs, get_files, to_Path
+
+logger = logging.getLogger(__name__)
+
+# suffix -> tarfile stream compression
+TAR_SUFFIXES = {
+    ".tar": "",
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+    ".tar.bz2": "bz2",
+    ".tbz2": "bz2",
+    ".tar.xz": "xz",
+    ".txz": "xz",
+}
+ZIP_SUFFIXES = (".zip",)
+
+# (member name, function reading the member data), the data should be read
+# before the next member is requested
+Member = Tuple[str, Callable[[], bytes]]
+
+
+# longest first, so ".tar.gz" is not taken for ".gz"
+_SUFFIXES = sorted([*TAR_SUFFIXES, *ZIP_SUFFIXES], key=len, reverse=True)
+
+
+def _archive_suffix(path: Path_Str) -> Optional[str]:
+    name = os.path.basename(path).lower()
+    for suffix in _SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
+def is_archive(path: Path_Str) -> bool:
+    """Check if the path is a tar/zip archive (by its name, it may not exist yet)
+
+    Args:
+        path (Path_Str): path to check
+
+    Returns:
+        bool: True if the name ends with one of the archive suffixes
+    """
+    return _archive_suffix(path) is not None
+
+
+def safe_member_name(name: str) -> Optional[str]:
+    """Normalize the member name, archives from outside must not write outside `dst`
+
+    Args:
+        name (str): member name as stored in the archive
+
+    Returns:
+        Optional[str]: relative posix path or None if the name is absolute or has ".."
+    """
+    path = PurePosixPath(name.replace("\\", "/"))
+    if path.is_absolute() or ".." in path.parts or not path.parts:
+        return None
+    return path.as_posix()
+
+
+def iter_members(src: Path_Str) -> Iterator[Member]:
+    """Stream regular file members of the archive (or files of the folder) in the order
+    they are stored. Tar archives (compressed too) are read sequentially in one pass.
+
+    Args:
+        src (Path_Str): path to the tar/zip archive or to the folder
+
+    Yields:
+        Iterator[Member]: (member name, read function) pairs, names of the folder files
+        are posix paths relative to it
+    """
+    src = to_Path(src)
+    suffix = _archive_suffix(src)
+    if suffix is None:
+        for folder in chain([src], get_dirs(src)):
+            for path in get_files(folder):
+                yield path.relative_to(src).as_posix(), path.read_bytes
+    elif suffix in ZIP_SUFFIXES:
+        with zipfile.ZipFile(src) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, functools.partial(archive.read, info)
+    else:
+        with tarfile.open(src, "r|*") as archive:
+            for member in archive:
+                if member.isfile():
+                    # data is read from the stream on demand, skipped otherwise
+                    yield member.name, archive.extractfile(member).read
+
+
+class MemberWriter:
+    """Write members into a new tar/zip archive in one pass, or into files of the folder.
+    An archive is written to `<dst>.part` and renamed to `dst` on `close`, so `dst`
+    exists only if complete. Tar compression is chosen by the suffix, zip members
+    are deflated.
+    """
+
+    def __init__(self, dst: Path_Str):
+        self.dst = to_Path(dst)
+        self.part = None
+        self._file = None
+        self._tar = None
+        self._zip = None
+        suffix = _archive_suffix(self.dst)
+        if suffix is None:
+            self.dst.mkdir(parents=True, exist_ok=True)
+            return
+        self.dst.parent.mkdir(parents=True, exist_ok=True)
+        self.part = self.dst.with_name(self.dst.name + ".part")
+        if suffix in ZIP_SUFFIXES:
+            self._zip = zipfile.ZipFile(self.part, "w", zipfile.ZIP_DEFLATED)
+        else:
+            # opened by us, the stream doesn't store the name of the ".part" file
+            self._file = open(self.part, "wb")
+            self._tar = tarfile.open(
+                fileobj=self._file, mode=f"w|{TAR_SUFFIXES[suffix]}"
+            )
+
+    def add(self, name: str, data: bytes):
+        """Write the member
+
+        Args:
+            name (str): member name (relative posix path)
+            data (bytes): member data
+        """
+        if self._zip is not None:
+            self._zip.writestr(name, data)
+        elif self._tar is not None:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(data))
+        else:
+            path = self.dst / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+
+    def close(self, complete: bool = True):
+        """Finish the archive
+
+        Args:
+            complete (bool, optional): if all members are written, the archive is moved
+            to `dst` then, otherwise it's left as `<dst>.part` for the resume.
+            Defaults to True.
+        """
+        if self._zip is not None:
+            self._zip.close()
+        if self._tar is not None:
+            self._tar.close()
+            self._file.close()
+        if self.part is not None and complete:
+            os.replace(self.part, self.dst)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
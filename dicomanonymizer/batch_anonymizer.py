@@ -5,43 +5,135 @@
     dicom files.
 """
 
-import argparse
+import csv
+import functools
+import hashlib
 import json
 import logging
 import logging.config
+import multiprocessing.util
+import os
 import random
+import shutil
+import tempfile
+import time
+from collections import Counter, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import suppress
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import pydicom
 
+from dicomanonymizer.anonym_plan import AnonymizationPlan
 from dicomanonymizer.anonym_state import AnonState
-from dicomanonymizer.dicom_utils import fix_exposure
+from dicomanonymizer.archive_io import (
+    MemberWriter,
+    is_archive,
+    iter_members,
+    safe_member_name,
+)
+from dicomanonymizer.defaults import READ_AHEAD, WRITE_BEHIND
+from dicomanonymizer.dicom_utils import is_dicomdir, sniff_dicom, sniff_dicom_header
+from dicomanonymizer.fingerprint_index import FingerprintIndex
+from dicomanonymizer.result_manifest import (
+    STATUS_ERROR,
+    STATUS_OK,
+    STATUS_SKIPPED,
+    FileResult,
+    ResultManifestWriter,
+)
+from dicomanonymizer.sharding import SHARD_BY_PATH, Shard
 from dicomanonymizer.simpledicomanonymizer import (
+    anonymize_bytes,
     anonymize_dicom_file,
+    anonymize_file_dataset,
+    get_uid_mapper,
     initialize_actions,
+    read_dicom_file,
+    recording_uids,
+    resolve_plan,
+    set_uid_mapper,
+    write_dicom_file,
 )
+from dicomanonymizer.stage_metrics import (
+    StageMetrics,
+    get_stage_metrics,
+    observe_stage,
+    set_stage_metrics,
+)
+from dicomanonymizer.tag_stats import TagKey, TagStats, tag_keywords, tag_stats
+from dicomanonymizer.uid_mapping import KeyedUIDMapper, RandomUIDMapper, UIDMapper
 from dicomanonymizer.utils import (
     LOGS_PATH,
     PROJ_ROOT,
     ActionsDict,
     Path_Str,
     get_dirs,
+    get_files,
     to_Path,
     try_valid_dir,
 )
 
-# setup logging (create dirs, if it is first time)
-LOGS_PATH.mkdir(parents=True, exist_ok=True)
-logging.config.fileConfig(
-    PROJ_ROOT / "dicomanonymizer/config/logging.ini",
-    defaults={"logfilename": (LOGS_PATH / "file.log").as_posix()},
-    disable_existing_loggers=False,
-)
 logger = logging.getLogger(__name__)
 
+# created on first use, see `_load_state`
 _STATE_PATH = Path.home() / ".dicomanonymizer/cache"
-_STATE_PATH.mkdir(parents=True, exist_ok=True)
+
+# (input file, output file)
+FileTask = Tuple[Path, Path]
+# bound on the number of submitted, but not finished files per worker process
+_TASKS_PER_WORKER = 4
+# bound on the number of files being sniffed per sniffer thread
+_SNIFF_AHEAD = 4
+# default queue depths of the overlapped I/O mode
+_READ_AHEAD = READ_AHEAD
+_WRITE_BEHIND = WRITE_BEHIND
+
+
+def setup_logging():
+    """Log to the rotating file in LOGS_PATH (create dirs, if it is first time).
+    Called by the CLI, the library leaves logging configuration to the application.
+    """
+    LOGS_PATH.mkdir(parents=True, exist_ok=True)
+    logging.config.fileConfig(
+        PROJ_ROOT / "dicomanonymizer/config/logging.ini",
+        defaults={"logfilename": (LOGS_PATH / "file.log").as_posix()},
+        disable_existing_loggers=False,
+    )
+
+
+def _shard_state_path(shard: Shard) -> Path:
+    return _STATE_PATH / "shards" / shard.name
+
+
+def _archive_state_path(archive: Path) -> Path:
+    digest = hashlib.blake2b(str(archive).encode(), digest_size=8).hexdigest()
+    return _STATE_PATH / "archives" / f"{archive.name}-{digest}"
+
+
+def _load_state(
+    shard: Optional[Shard] = None, archive: Optional[Path] = None
+) -> AnonState:
+    # state of the previous runs (create dirs, if it is first time),
+    # every shard has its own state, see `merge_shard_states`,
+    # so does every source archive, see `anonymize_archive`
+    state_path = _STATE_PATH
+    if shard is not None:
+        state_path = _shard_state_path(shard)
+    elif archive is not None:
+        state_path = _archive_state_path(archive)
+    state_path.mkdir(parents=True, exist_ok=True)
+    state = AnonState(state_path)
+    state.init_state()
+    state.load_state()
+    return state
 
 
 def get_extra_rules(
@@ -73,18 +165,66 @@ def get_extra_rules(
     return extra_rules
 
 
-def anonymize_dicom_folder(
-    in_path: Path_Str, out_path: Path_Str, debug: bool = False, **kwargs
-):
-    """Anonymize dicom files in `in_path`, if `in_path` doesn't
-    contain dicom files, will do nothing. Debug == True will do
-    sort of dry run to check if all good for the large data storages
+def sniff_files(
+    paths: Iterable[Path], sniff_threads: int = 0
+) -> Iterator[Tuple[Path, bool]]:
+    """Sniff files (see `sniff_dicom`) in order of `paths`. Sniffing costs an open and
+    a small read per file, on network storages that is a round trip per file: with
+    `sniff_threads` files are sniffed by a pool of threads, up to _SNIFF_AHEAD files
+    per thread ahead of the consumer.
+
+    Args:
+        paths (Iterable[Path]): files to sniff, consumed lazily
+        sniff_threads (int, optional): number of sniffer threads, 0 - sniff in the
+        current thread. Defaults to 0.
+
+    Yields:
+        Iterator[Tuple[Path, bool]]: file and if it is a dicom file
+    """
+    if sniff_threads <= 0:
+        for p in paths:
+            yield p, sniff_dicom(p) is not None
+        return
+    with ThreadPoolExecutor(sniff_threads) as sniffers:
+        # (file, sniff future)
+        sniffs = deque()
+        try:
+            for p in paths:
+                sniffs.append((p, sniffers.submit(sniff_dicom, p)))
+                if len(sniffs) >= sniff_threads * _SNIFF_AHEAD:
+                    p, sniff_future = sniffs.popleft()
+                    yield p, sniff_future.result() is not None
+            while sniffs:
+                p, sniff_future = sniffs.popleft()
+                yield p, sniff_future.result() is not None
+        finally:
+            # do not start queued sniffs if the consumer stopped
+            for _, sniff_future in sniffs:
+                sniff_future.cancel()
+
+
+def iter_folder_tasks(
+    in_path: Path_Str,
+    out_path: Path_Str,
+    non_dicom: str = "ignore",
+    sniff_threads: int = 0,
+) -> Iterator[FileTask]:
+    """Lazily yield (input file, output file) pairs for the dicom files in `in_path`,
+    while the folder is being listed, will create `out_path` if not exists. Files are
+    sniffed (see `sniff_files`), non-dicom files are never parsed.
 
     Args:
         in_path (Path_Str): path to the folder containing dicom files
         out_path (Path_Str): path to the folder there anonymized copies
         will be saved
-        debuf (bool): if true, will do a "dry" run
+        non_dicom (str): what to do with non-dicom files: "ignore" or "copy"
+        (as is, not anonymized!) to `out_path`, DICOMDIR files hold patient data
+        and are always skipped. Defaults to "ignore".
+        sniff_threads (int): number of threads sniffing files ahead, see `sniff_files`.
+        Defaults to 0.
+
+    Yields:
+        Iterator[FileTask]: (input file, output file) pairs
     """
     # check and prepare
     in_path = to_Path(in_path)
@@ -94,37 +234,683 @@ def anonymize_dicom_folder(
     out_path.mkdir(parents=True, exist_ok=True)
 
     logger.info(f"Processing: {in_path}")
-    # work itself
-    in_files = [p for p in in_path.iterdir() if p.is_file()]
+    for p, is_dicom in sniff_files(get_files(in_path), sniff_threads):
+        if is_dicom:
+            yield p, out_path / p.name
+        elif is_dicomdir(p):
+            logger.info(f"{p} is a DICOMDIR with patient data, skip")
+        elif non_dicom == "copy":
+            logger.debug(f"{p} is not a dicom file, copy")
+            shutil.copy2(p, out_path / p.name)
+        else:
+            logger.debug(f"{p} is not a dicom file, skip")
+
+
+def get_folder_tasks(
+    in_path: Path_Str,
+    out_path: Path_Str,
+    debug: bool = False,
+    non_dicom: str = "ignore",
+    sniff_threads: int = 0,
+) -> List[FileTask]:
+    """Prepare (input file, output file) pairs for the dicom files in `in_path`,
+    see `iter_folder_tasks`
 
-    if not in_files:
+    Args:
+        in_path (Path_Str): path to the folder containing dicom files
+        out_path (Path_Str): path to the folder there anonymized copies
+        will be saved
+        debug (bool): if true, will return just one random file
+        non_dicom, sniff_threads: see `iter_folder_tasks`
+
+    Returns:
+        List[FileTask]: (input file, output file) pairs, empty if no files
+    """
+    tasks = list(iter_folder_tasks(in_path, out_path, non_dicom, sniff_threads))
+
+    if not tasks:
         logger.info(f"Folder {in_path} doesn't have dicom files, skip.")
-        return
+        return []
 
     if debug:
         # anonymize just one file
-        f_in = random.choice(in_files)
-        f_out = out_path / f_in.name
-        try:
-            anonymize_dicom_file(f_in, f_out)
-        except Exception as e:
-            logger.info(f_in)
-            logger.exception(e)
+        tasks = [random.choice(tasks)]
+    return tasks
+
+
+def anonymize_file_task(
+    f_in: Path, f_out: Path, collect_tags: Union[bool, TagStats] = False, **kwargs
+) -> Optional[List[TagKey]]:
+    """Anonymize one file. Runs either in the current process or in a worker
+    process, so tags are returned instead of being collected with a callback.
+
+    Args:
+        f_in (Path): path to the original file
+        f_out (Path): path to the anonymized copy
+        collect_tags (Union[bool, TagStats], optional): if (or which, see `TagStats`)
+        return the dataset tags. Defaults to False.
+
+    Returns:
+        Optional[List[TagKey]]: tags of the dataset if `collect_tags` else None
+    """
+    tags = None
+    stats = tag_stats(collect_tags)
+    if stats is not None:
+        tags = []
+        kwargs["ds_callback"] = lambda dataset: tags.extend(stats.collect(dataset))
+    try:
+        anonymize_dicom_file(f_in, f_out, **kwargs)
+    except Exception as e:
+        logger.info(f_in)
+        logger.exception(e)
+        raise e
+    return tags
+
+
+def _add_sizes(result: FileResult):
+    with suppress(OSError):
+        result.bytes_in = os.stat(result.source).st_size
+        if result.status == STATUS_OK:
+            result.bytes_out = os.stat(result.output).st_size
+
+
+def _set_error(result: FileResult, e: Exception):
+    result.status = STATUS_ERROR
+    result.error = type(e).__name__
+
+
+def anonymize_file_result(
+    f_in: Path, f_out: Path, collect_tags: Union[bool, TagStats] = False, **kwargs
+) -> FileResult:
+    """Anonymize one file and describe what was done, see `FileResult`. Unlike
+    `anonymize_file_task` exceptions are logged and reported in the result.
+
+    Args:
+        f_in (Path): path to the original file
+        f_out (Path): path to the anonymized copy
+        collect_tags (Union[bool, TagStats], optional): if (or which, see `TagStats`)
+        collect the dataset tags into `FileResult.tags`. Defaults to False.
+
+    Returns:
+        FileResult: result of the file
+    """
+    result = FileResult(str(f_in), str(f_out))
+    stats = tag_stats(collect_tags)
+    if stats is not None:
+        result.tags = []
+        kwargs["ds_callback"] = lambda dataset: result.tags.extend(
+            stats.collect(dataset)
+        )
+    try:
+        with recording_uids() as uids:
+            result.uids = uids
+            if not anonymize_dicom_file(f_in, f_out, timings=result.timings, **kwargs):
+                result.status = STATUS_SKIPPED
+    except Exception as e:
+        logger.info(f_in)
+        logger.exception(e)
+        _set_error(result, e)
+    _add_sizes(result)
+    return result
+
+
+# keyed mapper with a secret of this process, see `_shared_uid_mapper`
+_run_uid_mapper: Optional[KeyedUIDMapper] = None
+
+
+def _shared_uid_mapper() -> UIDMapper:
+    """UID mapper sent to the worker processes. Random replacements are kept per process,
+    so every worker would replace the same UID with its own random one and studies would
+    fall apart. The random mapper is replaced with a keyed one (see `KeyedUIDMapper`)
+    with a random secret generated once per process, so all workers of all runs of this
+    process give the same replacements. Deterministic mappers are sent as is.
+
+    Returns:
+        UIDMapper: mapper of the workers
+    """
+    global _run_uid_mapper
+    mapper = get_uid_mapper()
+    if not isinstance(mapper, RandomUIDMapper):
+        return mapper
+    if _run_uid_mapper is None:
+        _run_uid_mapper = KeyedUIDMapper(os.urandom(32))
+    return _run_uid_mapper
+
+
+# tag counts of the tasks run by this worker process, see `run_in_workers`
+_worker_tags: Optional[Counter] = None
+
+
+def _count_tags(value, tag_counter: Counter):
+    """Move tags out of the task value into the counter, tags of failed tasks are
+    dropped. The value is tags (see `anonymize_file_task`), `FileResult` or
+    (`FileResult`, data) (see `anonymize_member`).
+
+    Returns:
+        value without tags
+    """
+    result = value[0] if isinstance(value, tuple) else value
+    if isinstance(result, FileResult):
+        if result.tags is not None and result.status != STATUS_ERROR:
+            tag_counter.update(result.tags)
+        result.tags = None
+        return value
+    if value is not None:
+        tag_counter.update(value)
+    return None
+
+
+def _counting_task(task_func: Callable, *args, **kwargs):
+    # runs in a worker process, tags are counted there and sent once on exit
+    return _count_tags(task_func(*args, **kwargs), _worker_tags)
+
+
+def _export_worker_tags(tag_counter: Counter, tags_dir: str):
+    # keys are ints and strings, so the counts are dumped as pairs
+    with open(Path(tags_dir) / f"tags-{os.getpid()}.json", "w") as fout:
+        json.dump(list(tag_counter.items()), fout)
+
+
+def _init_worker(
+    data_element_callback,
+    uid_mapper: UIDMapper,
+    metrics_settings: Optional[dict],
+    tags_dir: Optional[str] = None,
+):
+    # worker processes might be spawned, not forked, so configuration is set explicitly
+    global _worker_tags
+    pydicom.config.data_element_callback = data_element_callback
+    set_uid_mapper(uid_mapper)
+    if tags_dir is not None:
+        # tag counts are exported as the worker exits, see `run_in_workers`
+        _worker_tags = Counter()
+        multiprocessing.util.Finalize(
+            _worker_tags,
+            _export_worker_tags,
+            args=(_worker_tags, tags_dir),
+            exitpriority=10,
+        )
+    metrics = None
+    if metrics_settings is not None:
+        # every worker aggregates its own histograms, exported as the worker exits
+        metrics = StageMetrics(**metrics_settings, label=f"worker-{os.getpid()}")
+        multiprocessing.util.Finalize(metrics, metrics.export, exitpriority=10)
+    set_stage_metrics(metrics)
+
+
+def _timed(func: Callable, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    return value, time.perf_counter() - start
+
+
+def _file_size(path: Path) -> int:
+    # missing files take no budget, reading them fails anyway
+    with suppress(OSError):
+        return os.stat(path).st_size
+    return 0
+
+
+def _over_budget(inflight: int, size: int, max_inflight_bytes: int) -> bool:
+    """Check if the file of `size` bytes doesn't fit into the byte budget. A file
+    is always admitted if nothing is in flight, so larger files still go one by one.
+    """
+    return 0 < max_inflight_bytes < inflight + size and inflight > 0
+
+
+def run_file_tasks_overlapped(
+    tasks: Iterable[FileTask],
+    io_threads: int,
+    read_ahead: int = _READ_AHEAD,
+    write_behind: int = _WRITE_BEHIND,
+    collect_tags: Union[bool, TagStats] = False,
+    extra_anonymization_rules: Optional[ActionsDict] = None,
+    plan: Optional[AnonymizationPlan] = None,
+    ds_callback: Optional[Callable[[pydicom.Dataset], None]] = None,
+    pixel_passthrough: bool = False,
+    use_mmap: bool = False,
+    collect_results: bool = False,
+    write_threads: int = 0,
+    max_inflight_bytes: int = 0,
+    **kwargs,
+) -> Iterator[Tuple[Path, Path, Union[Optional[List[TagKey]], FileResult]]]:
+    """Anonymize files of `tasks` overlapping I/O with anonymization. Files go through
+    stages connected by bounded queues: discover (folders are listed lazily as tasks
+    are pulled, see `iter_folder_tasks`) -> sniff (pool of `sniff_threads` threads of
+    the folder functions, see `sniff_files`) -> read (pool of reader threads, up to `read_ahead` files ahead)
+    -> anonymize (current thread) -> write (pool of writer threads, up to `write_behind`
+    files behind) -> record (the caller, as results are yielded). Useful if storage
+    (NFS/SMB) latency and not CPU is the bottleneck.
+
+    Files are anonymized one by one in the current thread. It can't be combined with
+    worker processes, see `run_file_tasks`.
+
+    Memory is bounded by `max_inflight_bytes`: a file is read only if sizes of the files
+    read, but not yet written, plus its size fit into the budget (file size is used as
+    an estimate of the dataset size). A file larger than the budget is read, when nothing
+    else is in flight.
+
+    Args:
+        tasks (Iterable[FileTask]): (input file, output file) pairs
+        io_threads (int): number of reader threads (and of writer threads,
+        if `write_threads` is not set)
+        read_ahead (int, optional): max number of files read, but not yet anonymized.
+        Defaults to _READ_AHEAD.
+        write_behind (int, optional): max number of anonymized, but not yet written files.
+        Defaults to _WRITE_BEHIND.
+        collect_tags (Union[bool, TagStats], optional): if (or which) collect dataset tags,
+        see `anonymize_file_task`. Defaults to False.
+        collect_results (bool, optional): if yield `FileResult` instead of tags,
+        see `run_file_tasks`. Defaults to False.
+        write_threads (int, optional): number of writer threads, 0 - `io_threads`.
+        Defaults to 0.
+        max_inflight_bytes (int, optional): budget of bytes in flight, 0 - unlimited.
+        Defaults to 0.
+        extra_anonymization_rules, plan, ds_callback, pixel_passthrough, use_mmap, kwargs:
+        see `anonymize_dicom_file`
+
+    Yields:
+        Iterator[Tuple[Path, Path, Union[Optional[List[TagKey]], FileResult]]]: input file,
+        output file and tags (or result) of every finished task, in order of `tasks`
+    """
+    plan = resolve_plan(extra_anonymization_rules, plan)
+    pixel_passthrough = pixel_passthrough and not plan.touches_pixel_data
+    stats = tag_stats(collect_tags)
+    tasks = iter(tasks)
+    # task waiting for the budget: (input file, output file, size)
+    next_task = None
+    # bytes of files read (or being read), but not yet written
+    inflight = 0
+    # (input file, output file, size, read future)
+    reads = deque()
+    # (input file, output file, size, tags, result, write future or None if nothing to write)
+    writes = deque()
+
+    def handle_error(f_in, e, result):
+        logger.info(f_in)
+        logger.exception(e)
+        if result is None:
             raise e
-    else:
-        for f_in in in_files:
-            f_out = out_path / f_in.name
+        _set_error(result, e)
+
+    def finish(f_in, f_out, size, tags, result, write_future):
+        nonlocal inflight
+        if write_future is not None:
             try:
-                anonymize_dicom_file(f_in, f_out, **kwargs)
+                _, seconds = write_future.result()
+                observe_stage("write", seconds)
+                if result is not None:
+                    result.timings["write"] = seconds
             except Exception as e:
-                logger.info(f_in)
-                logger.exception(e)
-                raise e
+                handle_error(f_in, e, result)
+        # the dataset is gone with the write
+        inflight -= size
+        if result is None:
+            return f_in, f_out, tags
+        result.tags = tags
+        _add_sizes(result)
+        return f_in, f_out, result
+
+    with ThreadPoolExecutor(io_threads) as readers, ThreadPoolExecutor(
+        write_threads or io_threads
+    ) as writers:
+        try:
+            while True:
+                # keep the read-ahead queue full, as far as the budget allows
+                while len(reads) < read_ahead:
+                    if next_task is None:
+                        task = next(tasks, None)
+                        if task is None:
+                            break
+                        size = _file_size(task[0]) if max_inflight_bytes else 0
+                        next_task = (*task, size)
+                    f_in, f_out, size = next_task
+                    if _over_budget(inflight, size, max_inflight_bytes):
+                        break
+                    read_future = readers.submit(
+                        _timed, read_dicom_file, f_in, pixel_passthrough, use_mmap
+                    )
+                    reads.append((f_in, f_out, size, read_future))
+                    inflight += size
+                    next_task = None
+                if not reads:
+                    if next_task is None:
+                        break
+                    # budget is taken by the files being written, wait for the oldest
+                    yield finish(*writes.popleft())
+                    continue
+
+                f_in, f_out, size, read_future = reads.popleft()
+                tags = [] if stats is not None else None
+                result = FileResult(str(f_in), str(f_out)) if collect_results else None
+                write_future = None
+                try:
+                    dataset, seconds = read_future.result()
+                    observe_stage("read", seconds)
+                    if result is not None:
+                        result.timings["read"] = seconds
+                        result.status = STATUS_SKIPPED
+                    if dataset is not None:
+                        if stats is not None:
+                            tags.extend(stats.collect(dataset))
+                        start = time.perf_counter()
+                        with recording_uids() as uids:
+                            anonymized = anonymize_file_dataset(
+                                dataset, f_in, plan, ds_callback=ds_callback, **kwargs
+                            )
+                        seconds = time.perf_counter() - start
+                        observe_stage("anonymize", seconds)
+                        if result is not None:
+                            result.timings["anonymize"] = seconds
+                            result.uids = uids
+                        if anonymized:
+                            write_future = writers.submit(
+                                _timed, write_dicom_file, dataset, f_out
+                            )
+                            if result is not None:
+                                result.status = STATUS_OK
+                except Exception as e:
+                    handle_error(f_in, e, result)
+                writes.append((f_in, f_out, size, tags, result, write_future))
+
+                # report finished files, wait for writes if the queue is full
+                while writes and (
+                    len(writes) > write_behind
+                    or writes[0][5] is None
+                    or writes[0][5].done()
+                ):
+                    yield finish(*writes.popleft())
+
+            while writes:
+                yield finish(*writes.popleft())
+        finally:
+            # do not start queued reads if something went wrong
+            for _, _, _, read_future in reads:
+                read_future.cancel()
+
+
+def run_file_tasks(
+    tasks: Iterable[FileTask],
+    workers: int = 1,
+    collect_tags: Union[bool, TagStats] = False,
+    io_threads: int = 0,
+    read_ahead: int = _READ_AHEAD,
+    write_behind: int = _WRITE_BEHIND,
+    collect_results: bool = False,
+    write_threads: int = 0,
+    max_inflight_bytes: int = 0,
+    tag_counter: Optional[Counter] = None,
+    **kwargs,
+) -> Iterator[Tuple[Path, Path, Union[Optional[List[TagKey]], FileResult]]]:
+    """Anonymize files of `tasks`, with `workers` > 1 files are distributed
+    among the pool of worker processes one by one. Tasks are consumed lazily,
+    at most `workers` * _TASKS_PER_WORKER files (and, if set, `max_inflight_bytes`
+    bytes of them) are in flight.
+
+    Args:
+        tasks (Iterable[FileTask]): (input file, output file) pairs
+        workers (int, optional): number of worker processes. Defaults to 1
+        (anonymize in the current process).
+        collect_tags (Union[bool, TagStats], optional): if (or which) collect dataset tags,
+        see `anonymize_file_task`. Defaults to False.
+        io_threads (int, optional): if > 0, overlap reads and writes with anonymization,
+        see `run_file_tasks_overlapped`. Only with `workers` == 1. Defaults to 0.
+        read_ahead (int, optional): read queue depth for `io_threads`. Defaults to _READ_AHEAD.
+        write_behind (int, optional): write queue depth for `io_threads`. Defaults to _WRITE_BEHIND.
+        collect_results (bool, optional): if yield `FileResult` (see `anonymize_file_result`,
+        tags are in `FileResult.tags`) instead of tags. Failed files don't stop the run then,
+        the error is reported in the result. Defaults to False.
+        write_threads (int, optional): number of writer threads for `io_threads`,
+        0 - `io_threads`. Defaults to 0.
+        max_inflight_bytes (int, optional): budget of (source file) bytes being anonymized
+        at once, 0 - unlimited. A file larger than the budget is anonymized alone.
+        Defaults to 0.
+        tag_counter (Optional[Counter], optional): if set, tags of the finished files are
+        counted in it instead of being yielded (failed files are not counted). Worker
+        processes count their own tags and send the counts once, as the pool shuts down,
+        so the counter is complete only when the run ends. Defaults to None.
+        kwargs: passed to `anonymize_dicom_file`, must be picklable if `workers` > 1
+
+    Raises:
+        ValueError: if both `workers` > 1 and `io_threads` are set
+
+    Yields:
+        Iterator[Tuple[Path, Path, Union[Optional[List[TagKey]], FileResult]]]: input file,
+        output file and tags (see `anonymize_file_task`) or result of every finished task,
+        in order of completion
+    """
+    if workers > 1 and io_threads > 0:
+        raise ValueError("io_threads can't be used with workers > 1")
+    task_func = anonymize_file_result if collect_results else anonymize_file_task
+    if workers > 1:
+        for (f_in, f_out), info in run_in_workers(
+            tasks,
+            workers,
+            task_func,
+            lambda task: _file_size(task[0]),
+            max_inflight_bytes,
+            tag_counter,
+            collect_tags=collect_tags,
+            **kwargs,
+        ):
+            yield f_in, f_out, info
+        return
+
+    if io_threads > 0:
+        finished = run_file_tasks_overlapped(
+            tasks,
+            io_threads,
+            read_ahead,
+            write_behind,
+            collect_tags,
+            collect_results=collect_results,
+            write_threads=write_threads,
+            max_inflight_bytes=max_inflight_bytes,
+            **kwargs,
+        )
+    else:
+        finished = (
+            (f_in, f_out, task_func(f_in, f_out, collect_tags, **kwargs))
+            for f_in, f_out in tasks
+        )
+    for f_in, f_out, info in finished:
+        if tag_counter is not None:
+            info = _count_tags(info, tag_counter)
+        yield f_in, f_out, info
+
+
+def run_in_workers(
+    tasks: Iterable[tuple],
+    workers: int,
+    task_func: Callable,
+    task_size: Callable[[tuple], int],
+    max_inflight_bytes: int = 0,
+    tag_counter: Optional[Counter] = None,
+    **kwargs,
+) -> Iterator[tuple]:
+    """Run `task_func(*task, **kwargs)` for every task in the pool of `workers` worker
+    processes, tasks are submitted one by one as there is room for them: at most
+    `workers` * _TASKS_PER_WORKER tasks and (if set) `max_inflight_bytes` bytes of them
+    are in flight. Workers share one deterministic UID mapper, see `_shared_uid_mapper`.
+
+    Args:
+        tasks (Iterable[tuple]): arguments of `task_func`, consumed lazily
+        workers (int): number of worker processes
+        task_func (Callable): picklable function to run
+        task_size (Callable[[tuple], int]): bytes of the task, see `_over_budget`
+        max_inflight_bytes (int, optional): budget of bytes in flight, 0 - unlimited.
+        Defaults to 0.
+        tag_counter (Optional[Counter], optional): if set, tags of the task values
+        (see `_count_tags`) are counted by every worker and added to it once, after
+        the pool is shut down. Defaults to None.
+        kwargs: passed to `task_func`, must be picklable
+
+    Yields:
+        Iterator[tuple]: task and value of `task_func` of every finished task,
+        in order of completion
+    """
+    max_pending = workers * _TASKS_PER_WORKER
+    metrics = get_stage_metrics()
+    tags_dir = None
+    if tag_counter is not None:
+        tags_dir = tempfile.mkdtemp(prefix="dicomanonymizer-tags-")
+        task_func = functools.partial(_counting_task, task_func)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(
+                pydicom.config.data_element_callback,
+                _shared_uid_mapper(),
+                None if metrics is None else metrics.settings(),
+                tags_dir,
+            ),
+        ) as executor:
+            # future -> (task, size)
+            pending = {}
+            # bytes of the pending tasks
+            inflight = 0
+            try:
+                for task in tasks:
+                    size = task_size(task) if max_inflight_bytes else 0
+                    # wait for room: in the queue and in the budget
+                    while len(pending) >= max_pending or _over_budget(
+                        inflight, size, max_inflight_bytes
+                    ):
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            done_task, done_size = pending.pop(future)
+                            inflight -= done_size
+                            yield done_task, future.result()
+                    future = executor.submit(task_func, *task, **kwargs)
+                    pending[future] = (task, size)
+                    inflight += size
+                for future in as_completed(list(pending)):
+                    done_task, _ = pending.pop(future)
+                    yield done_task, future.result()
+            finally:
+                # do not start queued tasks if something went wrong
+                for future in pending:
+                    future.cancel()
+    finally:
+        # workers exported their counts on exit
+        if tags_dir is not None:
+            for path in Path(tags_dir).glob("tags-*.json"):
+                with open(path) as fin:
+                    tag_counter.update(dict(json.load(fin)))
+            shutil.rmtree(tags_dir, ignore_errors=True)
+
+
+def skip_unchanged(
+    tasks: Iterable[FileTask], index: Optional[FingerprintIndex]
+) -> Iterator[FileTask]:
+    """Filter out tasks of files, which didn't change since they were anonymized,
+    see `FingerprintIndex.is_unchanged`
+
+    Args:
+        tasks (Iterable[FileTask]): (input file, output file) pairs
+        index (Optional[FingerprintIndex]): index of the previous runs, all tasks
+        are kept if None
+
+    Yields:
+        Iterator[FileTask]: tasks to run
+    """
+    for f_in, f_out in tasks:
+        if index is not None and index.is_unchanged(f_in, f_out):
+            logger.debug(f"{f_in} is unchanged, skipping")
+            continue
+        yield f_in, f_out
+
+
+def _update_index(
+    index: Optional[FingerprintIndex], f_in: Path, f_out: Path, done: bool
+):
+    # record the anonymized file, the fingerprint of the failed one is dropped
+    if index is None:
+        return
+    if done:
+        index.record(f_in, f_out)
+    else:
+        index.discard(f_in)
+
+
+def _unpack_result(
+    info: Union[Optional[List[TagKey]], FileResult],
+    results: Optional[ResultManifestWriter],
+) -> bool:
+    """Write the result (if `results` are collected) and tell if the file is done
+
+    Returns:
+        bool: False if the file failed
+    """
+    if results is None:
+        return True
+    results.write(info)
+    return info.status != STATUS_ERROR
+
+
+def anonymize_dicom_folder(
+    in_path: Path_Str,
+    out_path: Path_Str,
+    debug: bool = False,
+    workers: int = 1,
+    index: Optional[FingerprintIndex] = None,
+    non_dicom: str = "ignore",
+    results: Optional[ResultManifestWriter] = None,
+    shard: Optional[Shard] = None,
+    sniff_threads: int = 0,
+    **kwargs,
+):
+    """Anonymize dicom files in `in_path`, if `in_path` doesn't
+    contain dicom files, will do nothing. Debug == True will do
+    sort of dry run to check if all good for the large data storages
+
+    Args:
+        in_path (Path_Str): path to the folder containing dicom files
+        out_path (Path_Str): path to the folder there anonymized copies
+        will be saved
+        debuf (bool): if true, will do a "dry" run
+        workers (int): number of worker processes, default 1 (no pool)
+        index (Optional[FingerprintIndex]): if set, skip files unchanged since
+        the previous run and record anonymized ones
+        non_dicom (str): see `get_folder_tasks`
+        results (Optional[ResultManifestWriter]): if set, a record per file is written
+        to it and failed files don't stop the run
+        shard (Optional[Shard]): if set, anonymize only files of the shard (keyed by
+        the file name, all files share the folder)
+        sniff_threads (int): number of threads sniffing files ahead, see `sniff_files`
+    """
+    if debug:
+        tasks = get_folder_tasks(in_path, out_path, debug, non_dicom, sniff_threads)
+    else:
+        tasks = iter_folder_tasks(in_path, out_path, non_dicom, sniff_threads)
+    if shard is not None:
+        tasks = shard.select(tasks, to_Path(in_path), by_folder=False)
+    tasks = skip_unchanged(tasks, index)
+    try:
+        for f_in, f_out, info in run_file_tasks(
+            tasks, workers, collect_results=results is not None, **kwargs
+        ):
+            done = _unpack_result(info, results)
+            _update_index(index, f_in, f_out, done)
+    finally:
+        if index is not None:
+            index.flush()
+        if results is not None:
+            results.flush()
 
 
 def anonymize_root_folder(
     in_root: Path_Str,
     out_root: Path_Str,
+    debug: bool = False,
+    workers: int = 1,
+    index: Optional[FingerprintIndex] = None,
+    non_dicom: str = "ignore",
+    results: Optional[ResultManifestWriter] = None,
+    count_tags: TagStats = TagStats(),
+    shard: Optional[Shard] = None,
+    sniff_threads: int = 0,
     **kwargs,
 ):
     """The fuction will get all nested folders from `in_root`
@@ -136,6 +922,20 @@ def anonymize_root_folder(
         some dicom-files inide, maybe nested)
         out_root (Path_Str): destination root folder, will create
         if not exists
+        debug (bool): if true, will do a "dry" run (one file per folder)
+        workers (int): number of worker processes, default 1 (no pool).
+        Files (not folders) are distributed among workers.
+        index (Optional[FingerprintIndex]): if set, the run is incremental: all folders
+        are checked, files unchanged since the previous run are skipped (see `skip_unchanged`),
+        the index and not the visited folders of the state decides what to anonymize
+        non_dicom (str): see `get_folder_tasks`
+        results (Optional[ResultManifestWriter]): if set, a record per file is written
+        to it and failed files don't stop the run (their folders are not marked visited)
+        count_tags (TagStats): which tags are counted in the state, see `TagStats`
+        shard (Optional[Shard]): if set, anonymize only files of the shard, folders of
+        other shards are skipped without listing (if sharded by path). The shard has
+        its own state, see `merge_shard_states`
+        sniff_threads (int): number of threads sniffing files ahead, see `sniff_files`
     """
     in_root = to_Path(in_root)
     try_valid_dir(in_root)
@@ -143,116 +943,515 @@ def anonymize_root_folder(
     out_root.mkdir(parents=True, exist_ok=True)
     in_dirs = get_dirs(in_root)
 
-    state = AnonState(_STATE_PATH)
-    state.init_state()
-    state.load_state()
+    state = _load_state(shard)
 
-    def get_tags_callback(dataset: pydicom.Dataset):
-        state.tag_counter.update(dataset.dir())
+    # number of not yet anonymized files per folder (relative path as a str), plus
+    # one while the folder is being listed. Folder is marked as visited, then all
+    # its files are done
+    folders_pending = {}
+
+    def release_folder(rel_path):
+        folders_pending[rel_path] -= 1
+        if not folders_pending[rel_path]:
+            del folders_pending[rel_path]
+            # sharded by study, files of the folder might belong to other shards
+            if shard is None or shard.by == SHARD_BY_PATH:
+                state.mark_folder_done(rel_path)
+
+    def get_tasks():
+        # folders and files are listed lazily, so anonymization starts right away,
+        # `run_file_tasks` pulls tasks only when there is room for them
+        for in_d in in_dirs:
+            rel_path = str(in_d.relative_to(in_root))
+            if index is None and rel_path in state.visited_folders:
+                logger.info(f"{in_d} path is in cache, skipping")
+                continue
+            if shard is not None and not shard.owns_folder(rel_path):
+                continue
+            out_d = out_root / rel_path
+            if debug:
+                tasks = get_folder_tasks(in_d, out_d, debug, non_dicom, sniff_threads)
+            else:
+                tasks = iter_folder_tasks(in_d, out_d, non_dicom, sniff_threads)
+            if shard is not None:
+                tasks = shard.select(tasks, in_root)
+            if index is None:
+                # files completed by an interrupted run
+                tasks = (
+                    (f_in, f_out)
+                    for f_in, f_out in tasks
+                    if not state.is_file_done(str(f_in.relative_to(in_root)))
+                )
+            else:
+                tasks = skip_unchanged(tasks, index)
+            folders_pending[rel_path] = 1
+            for task in tasks:
+                folders_pending[rel_path] += 1
+                yield task
+            release_folder(rel_path)
 
     logger.info(
         "Processed paths will be added to the cache, if cache exist and has some paths included, they will be skipped"
     )
     logger.info(
-        f"if, you need to process data again delete files {_STATE_PATH}, please"
+        f"if, you need to process data again delete files {state.state_path}, please"
     )
+    # counts of tags (as ints) seen in this run
+    tag_ids = Counter()
     # will try to process all folders, if exception will dump state before raising
     try:
-        for in_d in in_dirs:
-            rel_path = in_d.relative_to(in_root)
-            if str(rel_path) in state.visited_folders:
-                logger.info(f"{in_d} path is in cache, skipping")
+        for f_in, f_out, info in run_file_tasks(
+            get_tasks(),
+            workers,
+            collect_tags=count_tags,
+            collect_results=results is not None,
+            tag_counter=tag_ids,
+            **kwargs,
+        ):
+            done = _unpack_result(info, results)
+            _update_index(index, f_in, f_out, done)
+            if not done:
                 continue
-            else:
-                out_d = out_root / rel_path
-                anonymize_dicom_folder(
-                    in_d, out_d, ds_callback=get_tags_callback, **kwargs
-                )
-                # update state
-                state.visited_folders[str(rel_path)] = True
+            # update state
+            state.mark_file_done(str(f_in.relative_to(in_root)))
+            release_folder(str(f_in.parent.relative_to(in_root)))
     except Exception as e:
         raise e
     finally:
-        # before saving updated state let's flag tags not seen previously
-        prev_state = AnonState(_STATE_PATH)
-        prev_state.init_state()
-        prev_state.load_state()
-        new_tags = set(state.tag_counter.keys()).difference(
-            prev_state.tag_counter.keys()
+        if index is not None:
+            index.flush()
+        if results is not None:
+            results.flush()
+        # keywords are resolved once per distinct tag
+        state.tag_counter.update(tag_keywords(tag_ids))
+        report_and_save_state(state)
+
+
+def report_and_save_state(state: AnonState):
+    """Warn about tags not seen by the previous runs and save the state
+
+    Args:
+        state (AnonState): state of the current run
+    """
+    # before saving updated state let's flag tags not seen previously
+    prev_state = AnonState(state.state_path)
+    prev_state.init_state()
+    prev_state.load_state()
+    new_tags = set(state.tag_counter.keys()).difference(prev_state.tag_counter.keys())
+    if new_tags:
+        logger.warning(f"During the anonymization new tags: {new_tags} were present")
+    else:
+        logger.info("No new tags werer present")
+    # now we can save the current state
+    state.save_state()
+
+
+def merge_shard_states(
+    shard_paths: Optional[List[Path_Str]] = None,
+    out_path: Optional[Path_Str] = None,
+) -> AnonState:
+    """Combine states of the shards (see `anonymize_root_folder`) into one:
+    visited folders and completed files are joined, tag counts are summed. The merged
+    state is rebuilt from the shards every time, so merging again doesn't double counts.
+    Tags not seen by the previous merge are reported for the whole run.
+
+    Args:
+        shard_paths (Optional[List[Path_Str]]): state folders of the shards, e.g. copied
+        from the nodes. Defaults to all shard states of this machine.
+        out_path (Optional[Path_Str]): folder of the merged state. Defaults to
+        "merged" folder in the state folder.
+
+    Returns:
+        AnonState: merged state
+    """
+    if shard_paths is None:
+        shards_root = _STATE_PATH / "shards"
+        shard_paths = sorted(shards_root.glob("*-of-*")) if shards_root.is_dir() else []
+    out_path = _STATE_PATH / "merged" if out_path is None else to_Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+
+    # file names are taken from the defaults, only counts are not loaded
+    merged = AnonState(out_path)
+    merged.init_state()
+    for shard_path in shard_paths:
+        shard_path = to_Path(shard_path)
+        try_valid_dir(shard_path)
+        shard_state = AnonState(shard_path)
+        shard_state.init_state()
+        shard_state.load_state()
+        logger.info(
+            f"Merging {shard_path}: {len(shard_state.visited_folders)} folders, "
+            f"{len(shard_state.completed_files)} files"
+        )
+        merged.merge(shard_state)
+    report_and_save_state(merged)
+    return merged
+
+
+def _manifest_entries(fin, suffix: str) -> Iterator[Tuple[str, Optional[str]]]:
+    # (source, output or None) pairs of the manifest lines, see `read_manifest`
+    if suffix in (".jsonl", ".ndjson"):
+        for line in fin:
+            if line.strip():
+                record = json.loads(line)
+                yield record["source"], record.get("output")
+    elif suffix == ".csv":
+        for i, row in enumerate(csv.reader(fin)):
+            if not row or (i == 0 and row[0].strip().lower() == "source"):
+                continue
+            yield row[0], row[1] if len(row) > 1 and row[1] else None
+    else:
+        for line in fin:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line, None
+
+
+def _safe_output(path: str) -> Optional[str]:
+    # relative path inside the destination root (see `safe_member_name`) or None
+    return None if Path(path).anchor else safe_member_name(path)
+
+
+def read_manifest(manifest_path: Path_Str, out_root: Path_Str) -> Iterator[FileTask]:
+    """Stream (input file, output file) pairs from the manifest file, one line at a time.
+    Format is chosen by the extension:
+    - .jsonl/.ndjson: {"source": path, "output": relative output path (optional)}
+    - .csv: source[,output] rows, optional header row starting with "source"
+    - otherwise: one source path per line, empty lines and lines starting with # are skipped
+
+    Relative source paths are relative to the manifest folder, sources are yielded as
+    absolute paths. Output paths are relative to `out_root`, if not given, the source path
+    relative to the manifest folder (or the absolute source path without its root, if the
+    source is absolute or has "..") is used. Entries with absolute or ".." output paths
+    would be written outside `out_root`, they are skipped with a warning.
+
+    Args:
+        manifest_path (Path_Str): path to the manifest file
+        out_root (Path_Str): destination root folder
+
+    Yields:
+        Iterator[FileTask]: (input file, output file) pairs
+    """
+    manifest_path = to_Path(manifest_path)
+    out_root = to_Path(out_root)
+    base = manifest_path.resolve().parent
+    suffix = manifest_path.suffix.lower()
+
+    with open(manifest_path, "r", newline="") as fin:
+        for source, output in _manifest_entries(fin, suffix):
+            f_in = Path(os.path.normpath(base / source))
+            if output is None:
+                # relative source as is, other ones without their root (drive)
+                output = _safe_output(source) or f_in.relative_to(f_in.anchor)
+            elif _safe_output(output) is None:
+                logger.warning(f"Unsafe output path {output} of {source}, skip")
+                continue
+            yield f_in, out_root / output
+
+
+class _ManifestProgress:
+    """Number of the leading manifest entries finished. Entries finish out of order
+    (workers, I/O threads), the ones past the first unfinished entry are held until
+    it is finished, so memory is bounded by the entries in flight, not by the manifest.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self._finished = set()
+
+    def finish(self, position: int):
+        self._finished.add(position)
+        while self.count in self._finished:
+            self._finished.remove(self.count)
+            self.count += 1
+
+
+def anonymize_manifest(
+    manifest_path: Path_Str,
+    out_root: Path_Str,
+    workers: int = 1,
+    index: Optional[FingerprintIndex] = None,
+    results: Optional[ResultManifestWriter] = None,
+    count_tags: TagStats = TagStats(),
+    shard: Optional[Shard] = None,
+    **kwargs,
+):
+    """Anonymize files listed in the manifest (see `read_manifest`) instead of walking
+    the source tree. The manifest is streamed and memory doesn't grow with its size:
+    the state keeps only the number of leading entries finished (see
+    `AnonState.mark_manifest_progress`, keyed by the absolute manifest path), they are
+    skipped on resume, so the manifest should not be edited between the runs. Failed
+    entries (with `results`) count as finished, they are listed in the results.
+    Tags are counted as with `anonymize_root_folder`.
+
+    Args:
+        manifest_path (Path_Str): path to the manifest file
+        out_root (Path_Str): destination root folder, will create if not exists
+        workers (int): number of worker processes, default 1 (no pool)
+        index (Optional[FingerprintIndex]): if set, skip files unchanged since
+        the previous run (see `skip_unchanged`) instead of the finished entries
+        results (Optional[ResultManifestWriter]): if set, a record per file is written
+        to it and failed files don't stop the run
+        count_tags (TagStats): which tags are counted in the state, see `TagStats`
+        shard (Optional[Shard]): if set, anonymize only files of the shard (files are
+        keyed by their path relative to the manifest folder). The shard has its own
+        state, see `merge_shard_states`
+    """
+    out_root = to_Path(out_root)
+    out_root.mkdir(parents=True, exist_ok=True)
+    manifest_key = str(to_Path(manifest_path).resolve())
+
+    state = _load_state(shard)
+    start = state.manifest_done(manifest_key) if index is None else 0
+    progress = _ManifestProgress(start)
+    # (input file, output file) -> positions of the entries in flight
+    positions = {}
+
+    def finish(position):
+        progress.finish(position)
+        state.mark_manifest_progress(manifest_key, progress.count)
+
+    def get_tasks():
+        out_dir = None
+        for position, task in enumerate(read_manifest(manifest_path, out_root)):
+            if position < start:
+                # finished by an interrupted run
+                continue
+            tasks = [task]
+            if shard is not None:
+                tasks = shard.select(tasks, Path(manifest_key).parent, by_folder=False)
+            if next(skip_unchanged(tasks, index), None) is None:
+                # file of another shard or unchanged since the previous run
+                finish(position)
+                continue
+            # manifests are usually sorted, create every folder once
+            if task[1].parent != out_dir:
+                out_dir = task[1].parent
+                out_dir.mkdir(parents=True, exist_ok=True)
+            positions.setdefault(task, deque()).append(position)
+            yield task
+
+    # counts of tags (as ints) seen in this run
+    tag_ids = Counter()
+    try:
+        for f_in, f_out, info in run_file_tasks(
+            get_tasks(),
+            workers,
+            collect_tags=count_tags,
+            collect_results=results is not None,
+            tag_counter=tag_ids,
+            **kwargs,
+        ):
+            done = _unpack_result(info, results)
+            _update_index(index, f_in, f_out, done)
+            task_positions = positions[f_in, f_out]
+            finish(task_positions.popleft())
+            if not task_positions:
+                del positions[f_in, f_out]
+    finally:
+        if index is not None:
+            index.flush()
+        if results is not None:
+            results.flush()
+        # keywords are resolved once per distinct tag
+        state.tag_counter.update(tag_keywords(tag_ids))
+        report_and_save_state(state)
+
+
+def anonymize_member(
+    name: str,
+    data: bytes,
+    collect_tags: Union[bool, TagStats] = False,
+    collect_results: bool = False,
+    **kwargs,
+) -> Tuple[FileResult, Optional[bytes]]:
+    """Anonymize one archive member in memory, see `anonymize_bytes`. Runs either
+    in the current process or in a worker process.
+
+    Args:
+        name (str): member name (used for logging)
+        data (bytes): member data
+        collect_tags (Union[bool, TagStats], optional): if (or which, see `TagStats`)
+        collect the dataset tags into `FileResult.tags`. Defaults to False.
+        collect_results (bool, optional): if exceptions are reported in the result
+        instead of being raised. Defaults to False.
+        kwargs: see `anonymize_bytes`
+
+    Returns:
+        Tuple[FileResult, Optional[bytes]]: result (paths are set by the caller) and
+        the anonymized data, None if the member is skipped or failed
+    """
+    result = FileResult(name, name, bytes_in=len(data))
+    stats = tag_stats(collect_tags)
+    if stats is not None:
+        result.tags = []
+        kwargs["ds_callback"] = lambda dataset: result.tags.extend(
+            stats.collect(dataset)
         )
-        if new_tags:
-            logger.warning(
-                f"During the anonymization new tags: {new_tags} were present"
+    try:
+        with recording_uids() as uids:
+            result.uids = uids
+            data = anonymize_bytes(data, timings=result.timings, **kwargs)
+    except Exception as e:
+        logger.info(name)
+        logger.exception(e)
+        if not collect_results:
+            raise e
+        _set_error(result, e)
+        return result, None
+    if data is None:
+        result.status = STATUS_SKIPPED
+    else:
+        result.bytes_out = len(data)
+    return result, data
+
+
+def _recover_members(
+    previous: Path, writer: MemberWriter, completed: Set[str]
+) -> Set[str]:
+    """Copy `completed` members from the (partial) output archive of an interrupted run
+    to the new one. Members after a truncation are anonymized again.
+
+    Returns:
+        Set[str]: names of the copied members
+    """
+    recovered = set()
+    try:
+        for name, read in iter_members(previous):
+            if name in completed:
+                writer.add(name, read())
+                recovered.add(name)
+    except Exception as e:
+        logger.warning(f"Output of the previous run {previous} is truncated: {e}")
+    logger.info(f"{len(recovered)} members are copied from {previous}")
+    return recovered
+
+
+def anonymize_archive(
+    src: Path_Str,
+    dst: Path_Str,
+    workers: int = 1,
+    non_dicom: str = "ignore",
+    results: Optional[ResultManifestWriter] = None,
+    count_tags: TagStats = TagStats(),
+    max_inflight_bytes: int = 0,
+    **kwargs,
+):
+    """Anonymize members of the tar/zip archive `src` into the new archive `dst`
+    (see `archive_io`) without extracting them to disk: members are read sequentially,
+    anonymized in memory and written to `dst` in one pass (in order of completion),
+    relative paths are kept. Either side can be a folder instead.
+
+    Every source archive has its own state (completed members are recorded as
+    "<archive>!<member>"), so archives and folder runs with the same relative paths
+    don't collide. Tags are counted as with `anonymize_root_folder`. Completed members
+    are skipped on resume: with a folder `dst` they are already there, an archive `dst`
+    is complete only at the end (see `MemberWriter`), so completed members are copied
+    from the (partial) archive of the previous run, members missing from it are
+    anonymized again.
+
+    Args:
+        src (Path_Str): source archive (or folder)
+        dst (Path_Str): destination archive (or folder), the archive type is chosen
+        by the suffix, see `archive_io.TAR_SUFFIXES`
+        workers (int): number of worker processes, default 1 (no pool). Member data
+        is sent to the workers
+        non_dicom (str): what to do with non-dicom members, see `iter_folder_tasks`,
+        DICOMDIR members are always skipped
+        results (Optional[ResultManifestWriter]): if set, a record per member is written
+        to it and failed members don't stop the run
+        count_tags (TagStats): which tags are counted in the state, see `TagStats`
+        max_inflight_bytes (int): with `workers` > 1, budget of member bytes being
+        anonymized at once, 0 - unlimited
+        kwargs: passed to `anonymize_file_dataset`, must be picklable if `workers` > 1
+    """
+    src = to_Path(src)
+    dst = to_Path(dst)
+    archive_key = str(src.resolve())
+    state = _load_state(archive=Path(archive_key))
+    prefix = f"{archive_key}!"
+    completed = {
+        key[len(prefix) :] for key in state.completed_files if key.startswith(prefix)
+    }
+
+    # output of an interrupted (or a completed) previous run
+    previous = None
+    if is_archive(dst):
+        part = dst.with_name(dst.name + ".part")
+        if part.exists():
+            previous = part.replace(dst.with_name(dst.name + ".prev"))
+        elif dst.exists():
+            previous = dst
+
+    tag_ids = Counter()
+    with MemberWriter(dst) as writer:
+        if not is_archive(dst):
+            done = completed
+        elif previous is not None:
+            done = _recover_members(previous, writer, completed)
+        else:
+            done = set()
+
+        def get_tasks():
+            for name, read in iter_members(src):
+                safe_name = safe_member_name(name)
+                if safe_name is None:
+                    logger.warning(f"Unsafe member name {name} of {src}, skip")
+                    continue
+                if safe_name in done:
+                    continue
+                if is_dicomdir(safe_name):
+                    logger.info(f"{name} is a DICOMDIR with patient data, skip")
+                    continue
+                data = read()
+                if sniff_dicom_header(data, len(data)) is not None:
+                    yield safe_name, data
+                elif non_dicom == "copy":
+                    logger.debug(f"{name} is not a dicom file, copy")
+                    writer.add(safe_name, data)
+                else:
+                    logger.debug(f"{name} is not a dicom file, skip")
+
+        kwargs.update(collect_tags=count_tags, collect_results=results is not None)
+        if workers <= 1:
+            finished = (
+                (task, _count_tags(anonymize_member(*task, **kwargs), tag_ids))
+                for task in get_tasks()
             )
         else:
-            logger.info("No new tags werer present")
-        # now we can save the current state
-        state.save_state()
-
-
-# Add CLI args
-parser = argparse.ArgumentParser(description="Batch dicom-anonymization CLI")
-parser.add_argument(
-    "--type",
-    type=str,
-    choices=["batch", "folder"],
-    default="batch",
-    help="Process only one folder - folder or all nested folders - batch, default = batch",
-)
-parser.add_argument(
-    "--extra-rules",
-    default="",
-    help="Path to json file defining extra rules for additional tags. Defalult in project.",
-)
-parser.add_argument(
-    "--no-extra",
-    action="store_true",
-    help="Only use a rules from DICOM-standard basic de-id profile",
-)
-parser.add_argument(
-    "--debug", action="store_true", help="Will do a dry run (one file per folder)"
-)
-parser.add_argument(
-    "src",
-    type=str,
-    help="Absolute path to the folder containing dicom-files or nested folders with dicom-files",
-)
-parser.add_argument(
-    "dst",
-    type=str,
-    help="Absolute path to the folder where to save anonymized copy of src",
-)
+            finished = run_in_workers(
+                get_tasks(),
+                workers,
+                anonymize_member,
+                lambda task: len(task[1]),
+                max_inflight_bytes,
+                tag_ids,
+                **kwargs,
+            )
+        try:
+            for (name, _), (result, data) in finished:
+                if data is not None:
+                    writer.add(name, data)
+                result.source = str(src / name)
+                result.output = str(dst / name)
+                if not _unpack_result(result, results):
+                    continue
+                state.mark_file_done(prefix + name)
+        finally:
+            if results is not None:
+                results.flush()
+            # keywords are resolved once per distinct tag
+            state.tag_counter.update(tag_keywords(tag_ids))
+            report_and_save_state(state)
+    if previous is not None and previous != dst:
+        previous.unlink()
 
 
 def main():
-    # parse args
-    args = parser.parse_args()
-    in_path = Path(args.src)
-    out_path = Path(args.dst)
-    debug = args.debug
-
-    path = args.extra_rules
-    if not path:
-        path = PROJ_ROOT / "dicomanonymizer/resources/extra_rules.json"
-
-    extra_rules = get_extra_rules(use_extra=not args.no_extra, extra_json_path=path)
-    # fix known issue with dicom
-    fix_exposure()
-    msg = f"""
-    Start a job: {args.type}, debug set to {args.debug}
-    Will anonymize data at: {in_path} and save to {out_path}
-    """
-    logger.info(msg)
-    # anonymize
-    if args.type == "batch":
-        anonymize_root_folder(
-            in_path, out_path, debug=debug, extra_anonymization_rules=extra_rules
-        )
-    elif args.type == "folder":
-        anonymize_dicom_folder(
-            in_path, out_path, debug=debug, extra_anonymization_rules=extra_rules
-        )
-    logger.info("Well done!")
+    # the CLI lives in `cli`, kept for `python -m dicomanonymizer.batch_anonymizer`
+    from dicomanonymizer.cli import main as cli_main
+
+    cli_main()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,474 @@
+"""Command line interface of the batch anonymization (see `batch_anonymizer`).
+The parser is built without importing pydicom or the anonymization modules, they
+are imported after the arguments are parsed, so `--help` and argument errors
+don't pay for them.
+
+`dicom-anonymizer merge-state` combines states of the shards (see `--shard`).
+"""
+import argparse
+import hashlib
+import logging
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+from .defaults import READ_AHEAD, UUID_DERIVED_ROOT, WRITE_BEHIND
+
+logger = logging.getLogger(__name__)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Parser of the `dicom-anonymizer` arguments
+
+    Returns:
+        argparse.ArgumentParser: parser
+    """
+    parser = argparse.ArgumentParser(
+        description="Batch dicom-anonymization CLI",
+        epilog="See `dicom-anonymizer merge-state --help` to combine states of the shards",
+    )
+    parser.add_argument(
+        "--type",
+        type=str,
+        choices=["batch", "folder", "manifest", "archive"],
+        default="batch",
+        help="Process only one folder - folder or all nested folders - batch, or files listed "
+        "in the src manifest file (.jsonl, .csv or one path per line) - manifest, or members of "
+        "the src tar/zip archive into the dst archive without extracting them (either can be "
+        "a folder) - archive, default = batch",
+    )
+    parser.add_argument(
+        "--extra-rules",
+        default="",
+        help="Path to json file defining extra rules for additional tags. Defalult in project.",
+    )
+    parser.add_argument(
+        "--no-extra",
+        action="store_true",
+        help="Only use a rules from DICOM-standard basic de-id profile",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="Will do a dry run (one file per folder)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes anonymizing files in parallel, default = 1",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=0,
+        help="Number of threads reading and writing files ahead/behind anonymization (only with --workers 1), "
+        "useful for network storages, default = 0 (no overlap)",
+    )
+    parser.add_argument(
+        "--sniff-threads",
+        type=int,
+        default=0,
+        help="Number of threads sniffing files (an open and a 132 bytes read per file) ahead of "
+        "the reads or the workers, useful for network storages, default = 0 (sniff one by one)",
+    )
+    parser.add_argument(
+        "--read-ahead",
+        type=int,
+        default=READ_AHEAD,
+        help=f"Max number of files read ahead with --io-threads, default = {READ_AHEAD}",
+    )
+    parser.add_argument(
+        "--write-behind",
+        type=int,
+        default=WRITE_BEHIND,
+        help=f"Max number of files waiting to be written with --io-threads, default = {WRITE_BEHIND}",
+    )
+    parser.add_argument(
+        "--write-threads",
+        type=int,
+        default=0,
+        help="Number of writer threads with --io-threads, default = 0 (as many as --io-threads)",
+    )
+    parser.add_argument(
+        "--max-inflight-mb",
+        type=float,
+        default=0,
+        help="Budget of source file megabytes read, but not yet written (with --io-threads) or "
+        "being anonymized by the workers. Bounds memory with large files, a file larger than "
+        "the budget is processed alone. Default = 0 (unlimited)",
+    )
+    parser.add_argument(
+        "--uid-secret-file",
+        default="",
+        help="Path to a file with a site secret. If set, UIDs are replaced deterministically with "
+        "a keyed hash of the original UID, so runs, processes and nodes give the same UIDs",
+    )
+    parser.add_argument(
+        "--uid-store",
+        default="",
+        help="Path to SQLite database keeping random UID replacements between runs "
+        "(created if not exists), can't be used with --uid-secret-file",
+    )
+    parser.add_argument(
+        "--uid-cache-size",
+        type=int,
+        default=100_000,
+        help="Max number of UID replacements cached in memory with --uid-store, default = 100000",
+    )
+    parser.add_argument(
+        "--uid-root",
+        default=UUID_DERIVED_ROOT,
+        help=f"UID root of the new UIDs (with --uid-secret-file or --uid-store), default = {UUID_DERIVED_ROOT}",
+    )
+    parser.add_argument(
+        "--pixel-passthrough",
+        action="store_true",
+        help="Read and anonymize only the header, copy pixel data from the source file as is "
+        "(zero-copy if possible), lowers memory usage for large files",
+    )
+    parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="Memory map input files, large values (pixel data, OB/UN blobs) are not copied "
+        "into process memory, lowers RSS if many workers process large files",
+    )
+    parser.add_argument(
+        "--incremental",
+        default="",
+        help="Path to SQLite index of source file fingerprints (created if not exists). If set, "
+        "files unchanged since the previous run with the same rules are skipped without reading them",
+    )
+    parser.add_argument(
+        "--hash-content",
+        action="store_true",
+        help="With --incremental, compare content hashes of the source files too, not only size "
+        "and modification time",
+    )
+    parser.add_argument(
+        "--non-dicom",
+        choices=["ignore", "copy"],
+        default="ignore",
+        help="What to do with non-dicom files (reports, thumbnails): ignore or copy them as is "
+        "(NOT anonymized) to dst, DICOMDIR files hold patient data and are always skipped, "
+        "default = ignore",
+    )
+    parser.add_argument(
+        "--results",
+        default="",
+        help="Path to the result manifest (appended to), one record per file: paths, status, error, "
+        "sizes, stage timings and replaced UIDs. CSV if the path ends with .csv, json lines otherwise. "
+        "Failed files don't stop the run then",
+    )
+    parser.add_argument(
+        "--count-nested-tags",
+        action="store_true",
+        help="Count tags of the nested sequence items in the tag statistics too",
+    )
+    parser.add_argument(
+        "--count-private-creators",
+        action="store_true",
+        help="Count private creators (by name) in the tag statistics",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        default="",
+        help="Folder to export histograms of the read/anonymize/write (and rules/private tags) "
+        "stage timings to, as json and Prometheus textfiles, one pair of files per process. "
+        "Disabled by default",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between exports of the stage metrics during the run (they are exported "
+        "at the end too), 0 - only at the end, default = 60",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Profile the rules: print hits, misses and time spent per rule (most expensive first) "
+        "and the rules never matched at the end of the run. Slower, needs --workers 1",
+    )
+    parser.add_argument(
+        "--shard",
+        default="",
+        help="Anonymize only the shard K of N (K/N, 0 <= K < N) of the files, e.g. run 0/4, 1/4, 2/4 "
+        "and 3/4 on four nodes. Every shard keeps its own state, combine them with merge-state",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=["path", "study"],
+        default="path",
+        help="Assign files to the shards by a stable hash of their folder path (relative to src, "
+        "the file path with --type folder/manifest) - path, or of the StudyInstanceUID - study "
+        "(keeps studies spread across folders together, every shard reads all headers), default = path",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["single_pass", "per_rule"],
+        default="single_pass",
+        help="Rules matching engine, per_rule is a slower reference one, default = single_pass",
+    )
+    parser.add_argument(
+        "src",
+        type=str,
+        help="Absolute path to the folder containing dicom-files or nested folders with dicom-files "
+        "(or to the manifest file with --type manifest)",
+    )
+    parser.add_argument(
+        "dst",
+        type=str,
+        help="Absolute path to the folder where to save anonymized copy of src",
+    )
+
+    return parser
+
+
+def build_merge_parser() -> argparse.ArgumentParser:
+    """Parser of the `dicom-anonymizer merge-state` arguments
+
+    Returns:
+        argparse.ArgumentParser: parser
+    """
+    parser = argparse.ArgumentParser(
+        prog="dicom-anonymizer merge-state",
+        description="Combine states (completed folders/files and tag statistics) of the shards "
+        "into one and report new tags across the whole run",
+    )
+    parser.add_argument(
+        "--out",
+        default="",
+        help="Folder of the merged state, default = merged folder in the state folder",
+    )
+    parser.add_argument(
+        "shards",
+        nargs="*",
+        help="State folders of the shards (e.g. copied from the nodes), default = all shards "
+        "run on this machine",
+    )
+    return parser
+
+
+def merge_state_main(argv: List[str]):
+    """`dicom-anonymizer merge-state` entry point
+
+    Args:
+        argv (List[str]): arguments after the subcommand
+    """
+    args = build_merge_parser().parse_args(argv)
+    from .batch_anonymizer import merge_shard_states, setup_logging
+
+    setup_logging()
+    state = merge_shard_states(args.shards or None, args.out or None)
+    print(
+        f"Merged state saved to {state.state_path}: {len(state.visited_folders)} folders, "
+        f"{len(state.completed_files)} files in progress, {len(state.tag_counter)} tags"
+    )
+
+
+def main(argv: Optional[List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "merge-state":
+        return merge_state_main(argv[1:])
+    # parse args
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # anonymization modules (and pydicom) are imported only for a real run
+    from .batch_anonymizer import (
+        anonymize_archive,
+        anonymize_dicom_folder,
+        anonymize_manifest,
+        anonymize_root_folder,
+        get_extra_rules,
+        setup_logging,
+    )
+    from .dicom_utils import fix_exposure
+    from .fingerprint_index import FingerprintIndex, run_fingerprint
+    from .result_manifest import ResultManifestWriter
+    from .rule_profile import RuleProfile
+    from .sharding import Shard
+    from .simpledicomanonymizer import build_plan, set_uid_mapper
+    from .stage_metrics import StageMetrics, set_stage_metrics
+    from .tag_stats import TagStats
+    from .uid_mapping import KeyedUIDMapper, SQLiteUIDMapper
+    from .utils import PROJ_ROOT
+
+    setup_logging()
+    in_path = Path(args.src)
+    out_path = Path(args.dst)
+    debug = args.debug
+    if args.workers < 1:
+        parser.error("--workers should be a positive number")
+    if args.explain and args.workers > 1:
+        parser.error("--explain needs --workers 1")
+    if args.io_threads > 0 and args.workers > 1:
+        # reads and writes of the workers are not overlapped
+        parser.error("--io-threads needs --workers 1")
+    if min(args.read_ahead, args.write_behind) < 1:
+        parser.error("--read-ahead and --write-behind should be positive numbers")
+    if min(args.write_threads, args.max_inflight_mb, args.sniff_threads) < 0:
+        parser.error(
+            "--write-threads, --max-inflight-mb and --sniff-threads can't be negative"
+        )
+    io_kwargs = dict(
+        io_threads=args.io_threads,
+        read_ahead=args.read_ahead,
+        write_behind=args.write_behind,
+        write_threads=args.write_threads,
+        max_inflight_bytes=int(args.max_inflight_mb * 2**20),
+    )
+    profile = RuleProfile() if args.explain else None
+    shard = None
+    if args.shard:
+        try:
+            shard = Shard.parse(args.shard, args.shard_by)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.type == "archive" and (args.incremental or args.shard):
+        parser.error("--incremental and --shard can't be used with --type archive")
+    if args.type == "archive" and (
+        args.io_threads or args.mmap or args.pixel_passthrough
+    ):
+        # members are read sequentially from the archive and anonymized in memory
+        parser.error(
+            "--io-threads, --mmap and --pixel-passthrough can't be used with --type archive"
+        )
+    if args.sniff_threads and args.type in ("manifest", "archive"):
+        # listed files and archive members are not sniffed from the storage
+        parser.error(f"--sniff-threads can't be used with --type {args.type}")
+
+    path = args.extra_rules
+    if not path:
+        path = PROJ_ROOT / "dicomanonymizer/resources/extra_rules.json"
+
+    extra_rules = get_extra_rules(use_extra=not args.no_extra, extra_json_path=path)
+    # rules are compiled once and reused for every file
+    plan = build_plan(extra_rules)
+    if args.uid_secret_file and args.uid_store:
+        parser.error("--uid-secret-file and --uid-store can't be used together")
+    # UID replacement settings, part of the fingerprint of incremental runs
+    uid_options = {}
+    try:
+        if args.uid_secret_file:
+            secret = Path(args.uid_secret_file).read_bytes().strip()
+            set_uid_mapper(KeyedUIDMapper(secret, args.uid_root))
+            uid_options = dict(
+                uid_secret=hashlib.sha256(secret).hexdigest(), uid_root=args.uid_root
+            )
+        elif args.uid_store:
+            set_uid_mapper(
+                SQLiteUIDMapper(
+                    args.uid_store,
+                    cache_size=args.uid_cache_size,
+                    uid_root=args.uid_root,
+                )
+            )
+            uid_options = dict(
+                uid_store=str(Path(args.uid_store).resolve()), uid_root=args.uid_root
+            )
+    except ValueError as e:
+        parser.error(str(e))
+    # fix known issue with dicom
+    fix_exposure()
+    msg = f"""
+    Start a job: {args.type}, debug set to {args.debug}
+    Will anonymize data at: {in_path} and save to {out_path}
+    """
+    logger.info(msg)
+    index = None
+    if args.incremental:
+        # outputs of another plan or with other options are anonymized again
+        fingerprint = run_fingerprint(
+            plan.fingerprint,
+            engine=args.engine,
+            pixel_passthrough=args.pixel_passthrough,
+            non_dicom=args.non_dicom,
+            **uid_options,
+        )
+        index = FingerprintIndex(args.incremental, fingerprint, args.hash_content)
+    results = ResultManifestWriter(args.results) if args.results else None
+    count_tags = TagStats(args.count_nested_tags, args.count_private_creators)
+    metrics = None
+    if args.metrics_dir:
+        metrics = StageMetrics(args.metrics_dir, args.metrics_interval)
+        set_stage_metrics(metrics)
+    # anonymize
+    if args.type == "batch":
+        anonymize_root_folder(
+            in_path,
+            out_path,
+            debug=debug,
+            workers=args.workers,
+            plan=plan,
+            engine=args.engine,
+            pixel_passthrough=args.pixel_passthrough,
+            use_mmap=args.mmap,
+            profile=profile,
+            index=index,
+            shard=shard,
+            results=results,
+            non_dicom=args.non_dicom,
+            count_tags=count_tags,
+            sniff_threads=args.sniff_threads,
+            **io_kwargs,
+        )
+    elif args.type == "folder":
+        anonymize_dicom_folder(
+            in_path,
+            out_path,
+            debug=debug,
+            workers=args.workers,
+            plan=plan,
+            engine=args.engine,
+            pixel_passthrough=args.pixel_passthrough,
+            use_mmap=args.mmap,
+            profile=profile,
+            index=index,
+            shard=shard,
+            results=results,
+            non_dicom=args.non_dicom,
+            sniff_threads=args.sniff_threads,
+            **io_kwargs,
+        )
+    elif args.type == "manifest":
+        anonymize_manifest(
+            in_path,
+            out_path,
+            workers=args.workers,
+            plan=plan,
+            engine=args.engine,
+            pixel_passthrough=args.pixel_passthrough,
+            use_mmap=args.mmap,
+            profile=profile,
+            index=index,
+            shard=shard,
+            results=results,
+            count_tags=count_tags,
+            **io_kwargs,
+        )
+    elif args.type == "archive":
+        anonymize_archive(
+            in_path,
+            out_path,
+            workers=args.workers,
+            non_dicom=args.non_dicom,
+            results=results,
+            count_tags=count_tags,
+            max_inflight_bytes=io_kwargs["max_inflight_bytes"],
+            plan=plan,
+            engine=args.engine,
+            profile=profile,
+        )
+    if index is not None:
+        index.close()
+    if results is not None:
+        results.close()
+    if metrics is not None:
+        metrics.export()
+    if profile is not None:
+        print(profile.report())
+    logger.info("Well done!")
+
+
+if __name__ == "__main__":
+    main()
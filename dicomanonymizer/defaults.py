@@ -0,0 +1,8 @@
+"""Default values shared by the library and the CLI. The module has no imports,
+so the CLI parser can be built without importing pydicom (see `cli`).
+"""
+# UID root for UIDs derived from 128-bit numbers (see DICOM PS3.5 B.2)
+UUID_DERIVED_ROOT = "2.25"
+# default queue depths of the overlapped I/O mode
+READ_AHEAD = 8
+WRITE_BEHIND = 8
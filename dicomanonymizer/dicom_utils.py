@@ -1,7 +1,13 @@
-from typing import List
+import errno
+import io
+import mmap
+import os
+import struct
+from typing import BinaryIO, List, Optional, Tuple
 
 import pydicom
 from pydicom.dataelem import RawDataElement
+from pydicom.errors import InvalidDicomError
 
 
 def exposure_callback(raw_data_element: RawDataElement, encoding: List[str]):
@@ -30,3 +36,344 @@ def exposure_callback(raw_data_element: RawDataElement, encoding: List[str]):
 
 def fix_exposure():
     pydicom.config.data_element_callback = exposure_callback
+
+
+# VRs with 2 reserved bytes and 4 bytes length in explicit VR encoding
+_LONG_LENGTH_VRS = set(b"OB OD OF OL OV OW SQ UC UN UR UT".split())
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM_TAG = (0xFFFE, 0xE000)
+_SEQUENCE_DELIMITER_TAG = (0xFFFE, 0xE0DD)
+_COPY_CHUNK_SIZE = 1024 * 1024
+_UNSUPPORTED_COPY_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.ENOTSOCK,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+}
+
+
+def get_element_tag(
+    fp: BinaryIO, offset: int, is_little_endian: bool
+) -> Optional[Tuple[int, int]]:
+    """Read the tag of the data element starting at `offset`
+
+    Args:
+        fp (BinaryIO): file opened in binary mode
+        offset (int): offset of the element in the file
+        is_little_endian (bool): encoding of the dataset
+
+    Returns:
+        Optional[Tuple[int, int]]: (group, element) or None at the end of the file
+    """
+    fp.seek(offset)
+    header = fp.read(4)
+    if len(header) < 4:
+        return None
+    return struct.unpack(("<" if is_little_endian else ">") + "HH", header)
+
+
+def get_element_end(
+    fp: BinaryIO, offset: int, is_implicit_VR: bool, is_little_endian: bool
+) -> Optional[int]:
+    """Find where the data element starting at `offset` ends without reading
+    its value. Undefined length values (encapsulated pixel data) are skipped
+    item by item.
+
+    Args:
+        fp (BinaryIO): file opened in binary mode
+        offset (int): offset of the element (its tag) in the file
+        is_implicit_VR (bool): encoding of the dataset
+        is_little_endian (bool): encoding of the dataset
+
+    Returns:
+        Optional[int]: offset right after the element, None if it can't be found
+    """
+    endian = "<" if is_little_endian else ">"
+    fp.seek(offset)
+    header = fp.read(8)
+    if len(header) < 8:
+        return None
+    if is_implicit_VR:
+        (length,) = struct.unpack(endian + "L", header[4:])
+        position = offset + 8
+    elif header[4:6] in _LONG_LENGTH_VRS:
+        long_length = fp.read(4)
+        if len(long_length) < 4:
+            return None
+        (length,) = struct.unpack(endian + "L", long_length)
+        position = offset + 12
+    else:
+        (length,) = struct.unpack(endian + "H", header[6:])
+        position = offset + 8
+
+    if length != _UNDEFINED_LENGTH:
+        return position + length
+
+    # encapsulated value: items with defined length up to the sequence delimiter
+    while True:
+        fp.seek(position)
+        item = fp.read(8)
+        if len(item) < 8:
+            return None
+        group, element, length = struct.unpack(endian + "HHL", item)
+        position += 8
+        if (group, element) == _SEQUENCE_DELIMITER_TAG:
+            return position
+        if (group, element) != _ITEM_TAG or length == _UNDEFINED_LENGTH:
+            return None
+        position += length
+
+
+def append_file_range(src: BinaryIO, dst: BinaryIO, offset: int, count: int):
+    """Append `count` bytes of `src` starting at `offset` to `dst` (at its current
+    position). Uses zero-copy `os.copy_file_range` or `os.sendfile` if available,
+    plain read/write otherwise.
+
+    Args:
+        src (BinaryIO): source file opened for reading in binary mode
+        dst (BinaryIO): destination file opened for writing in binary mode
+        offset (int): offset of the range in `src`
+        count (int): number of bytes to copy
+
+    Raises:
+        EOFError: if `src` is shorter than the range
+    """
+    dst.flush()
+    end = offset + count
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+
+    def copy_file_range(position):
+        return os.copy_file_range(src_fd, dst_fd, end - position, position)
+
+    def sendfile(position):
+        return os.sendfile(dst_fd, src_fd, position, end - position)
+
+    for copy, available in (
+        (copy_file_range, hasattr(os, "copy_file_range")),
+        (sendfile, hasattr(os, "sendfile")),
+    ):
+        if not available or offset >= end:
+            continue
+        try:
+            while offset < end:
+                copied = copy(offset)
+                if not copied:
+                    raise EOFError(f"Unexpected end of {src.name}")
+                offset += copied
+        except OSError as e:
+            # not supported for these files (e.g. cross-device, not a socket), fallback
+            if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+                raise
+
+    src.seek(offset)
+    while offset < end:
+        chunk = src.read(min(_COPY_CHUNK_SIZE, end - offset))
+        if not chunk:
+            raise EOFError(f"Unexpected end of {src.name}")
+        dst.write(chunk)
+        offset += len(chunk)
+    dst.flush()
+
+
+# pydicom >= 3 reads deferred values from the buffer the dataset was read from
+_DEFERRED_BUFFER_READS = int(pydicom.__version__.split(".")[0]) >= 3
+# values of at least this size stay views into the memory mapped file
+MMAP_VIEW_MIN_SIZE = 64 * 1024
+
+
+def open_mmap(path) -> mmap.mmap:
+    """Memory map the file for reading, the file itself is closed right away
+
+    Args:
+        path (Path_Str): path to the file
+
+    Raises:
+        InvalidDicomError: if the file is empty
+
+    Returns:
+        mmap.mmap: read-only mapping of the whole file
+    """
+    with open(path, "rb") as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            raise InvalidDicomError(f"Empty file: {path}")
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def dcmread_mmap(
+    buffer: mmap.mmap, view_min_size: int = MMAP_VIEW_MIN_SIZE, **kwargs
+) -> pydicom.Dataset:
+    """Read dataset from the memory mapped file. Top level values of at least
+    `view_min_size` bytes (pixel data, large OB/UN blobs) are not copied, they stay
+    memoryviews into the mapping. The mapping is kept open as long as the views exist.
+
+    Args:
+        buffer (mmap.mmap): mapped file, see `open_mmap`
+        view_min_size (int, optional): min size of a value kept as a view.
+        Defaults to MMAP_VIEW_MIN_SIZE.
+        kwargs: passed to `pydicom.dcmread`
+
+    Returns:
+        pydicom.Dataset: dataset
+    """
+    return _dcmread_views(buffer, memoryview(buffer), view_min_size, **kwargs)
+
+
+class MemoryReader(io.RawIOBase):
+    """Read-only file object over data in memory (bytes, bytearray, memoryview, mmap),
+    unlike `io.BytesIO` the data is not copied
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data).cast("B")
+        self.offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self.view[self.offset : self.offset + len(buffer)]
+        buffer[: len(chunk)] = chunk
+        self.offset += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.offset, io.SEEK_END: len(self.view)}
+        self.offset = max(base[whence] + offset, 0)
+        return self.offset
+
+    def tell(self) -> int:
+        return self.offset
+
+
+def dcmread_buffer(
+    data, view_min_size: int = MMAP_VIEW_MIN_SIZE, **kwargs
+) -> pydicom.Dataset:
+    """Read dataset from data in memory, as `dcmread_mmap` does: top level values
+    of at least `view_min_size` bytes stay memoryviews into `data`
+
+    Args:
+        data (bytes-like): dicom file data (bytes, bytearray, memoryview)
+        view_min_size (int, optional): min size of a value kept as a view.
+        Defaults to MMAP_VIEW_MIN_SIZE.
+        kwargs: passed to `pydicom.dcmread`
+
+    Returns:
+        pydicom.Dataset: dataset
+    """
+    reader = MemoryReader(data)
+    return _dcmread_views(reader, reader.view, view_min_size, **kwargs)
+
+
+def _dcmread_views(
+    fp, view: memoryview, view_min_size: int, **kwargs
+) -> pydicom.Dataset:
+    if not _DEFERRED_BUFFER_READS:
+        # older pydicom can't read deferred values back from a buffer
+        return pydicom.dcmread(fp, **kwargs)
+
+    dataset = pydicom.dcmread(fp, defer_size=view_min_size, **kwargs)
+    file_meta = getattr(dataset, "file_meta", pydicom.Dataset())
+    transfer_syntax = file_meta.get("TransferSyntaxUID")
+    if transfer_syntax is not None and transfer_syntax.is_deflated:
+        # positions are in the inflated stream, not in the buffer, read it as usual
+        fp.seek(0)
+        return pydicom.dcmread(fp, **kwargs)
+    for tag in list(dataset.keys()):
+        raw = dataset.get_item(tag, keep_deferred=True)
+        # deferred values are not read, only their position is known. Values of
+        # undefined length (encapsulated pixel data) are left to pydicom
+        if (
+            isinstance(raw, RawDataElement)
+            and raw.value is None
+            and raw.length
+            and raw.length != _UNDEFINED_LENGTH
+        ):
+            start = raw.value_tell
+            dataset[tag] = raw._replace(value=view[start : start + raw.length])
+    return dataset
+
+
+# results of `sniff_dicom`: file with preamble and "DICM" prefix (DICOM PS3.10),
+# file starting right with the dataset (no preamble, no file meta)
+SNIFF_PART10 = "part10"
+SNIFF_RAW = "raw"
+_PREAMBLE_LENGTH = 128
+_DICOM_PREFIX = b"DICM"
+_VRS = set(
+    b"AE AS AT CS DA DS DT FD FL IS LO LT OB OD OF OL OV OW PN SH SL SQ SS ST SV TM "
+    b"UC UI UL UN UR US UT UV".split()
+)
+# groups a dataset without file meta starts with, (0008,xxxx) in practice
+_RAW_FIRST_GROUPS = {0x0002, 0x0004, 0x0008, 0x0010}
+
+
+def is_dicomdir(path) -> bool:
+    """Check if the file is a DICOMDIR (media directory, DICOM PS3.10 fixes its name).
+    Its directory records hold patient names and IDs, so it must never be copied
+    as is into the anonymized output.
+
+    Args:
+        path (Path_Str): path to the file (or archive member name)
+
+    Returns:
+        bool: True if the file is a DICOMDIR
+    """
+    return os.path.basename(str(path).replace("\\", "/")).upper() == "DICOMDIR"
+
+
+def sniff_dicom(path) -> Optional[str]:
+    """Cheaply tell if the file is a dicom file, reads only the first 132 bytes.
+    Files without preamble are recognized by the first element header: it should
+    be an element of one of the first groups (0002-0010) of little endian implicit or explicit VR
+    with a length fitting into the file. DICOMDIR files (media directories, not
+    images) are not dicom files here.
+
+    Args:
+        path (Path_Str): path to the file
+
+    Returns:
+        Optional[str]: SNIFF_PART10, SNIFF_RAW or None if not a dicom file
+    """
+    if is_dicomdir(path):
+        return None
+    with open(path, "rb") as fp:
+        header = fp.read(_PREAMBLE_LENGTH + len(_DICOM_PREFIX))
+        file_size = os.fstat(fp.fileno()).st_size
+    return sniff_dicom_header(header, file_size)
+
+
+def sniff_dicom_header(header: bytes, file_size: int) -> Optional[str]:
+    """Tell if the data is a dicom file by its first bytes, see `sniff_dicom`.
+    Used for data already in memory (e.g. archive members).
+
+    Args:
+        header (bytes): first 132 (or more) bytes of the file
+        file_size (int): size of the whole file
+
+    Returns:
+        Optional[str]: SNIFF_PART10, SNIFF_RAW or None if not a dicom file
+    """
+    header = bytes(header[: _PREAMBLE_LENGTH + len(_DICOM_PREFIX)])
+    if header[_PREAMBLE_LENGTH:] == _DICOM_PREFIX:
+        return SNIFF_PART10
+    if len(header) < 8:
+        return None
+
+    group, element = struct.unpack("<HH", header[:4])
+    if group not in _RAW_FIRST_GROUPS:
+        return None
+    vr = header[4:6]
+    if vr in _VRS:
+        if vr in _LONG_LENGTH_VRS:
+            return SNIFF_RAW if len(header) >= 12 and header[6:8] == b"\0\0" else None
+        length = struct.unpack("<H", header[6:8])[0]
+        return SNIFF_RAW if 8 + length <= file_size else None
+    length = struct.unpack("<L", header[4:8])[0]
+    if length == _UNDEFINED_LENGTH or 8 + length <= file_size:
+        return SNIFF_RAW
+    return None
@@ -0,0 +1,193 @@
+"""This module keeps fingerprints of anonymized source files, so incremental
+re-runs skip files, which didn't change since the last anonymization, without
+reading them.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from .utils import Path_Str
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class SourceFingerprint:
+    size: int
+    mtime_ns: int
+    content_hash: Optional[str] = None
+
+
+def hash_file(path: Path_Str) -> str:
+    """Fast (BLAKE2b) hash of the file content
+
+    Args:
+        path (Path_Str): path to the file
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(path: Path_Str, hash_content: bool = False) -> SourceFingerprint:
+    """Fingerprint of the file: size, modification time and optionally content hash
+
+    Args:
+        path (Path_Str): path to the file
+        hash_content (bool, optional): if hash the content. Defaults to False.
+
+    Returns:
+        SourceFingerprint: fingerprint
+    """
+    stat = os.stat(path)
+    content_hash = hash_file(path) if hash_content else None
+    return SourceFingerprint(stat.st_size, stat.st_mtime_ns, content_hash)
+
+
+def run_fingerprint(plan_fingerprint: str, **options) -> str:
+    """Fingerprint of the plan and of the other options, which change the anonymized
+    output (e.g. UID replacement settings), to be used by `FingerprintIndex`
+
+    Args:
+        plan_fingerprint (str): see `AnonymizationPlan.fingerprint`
+        options: option name -> value, values should be json serializable
+
+    Returns:
+        str: hex digest
+    """
+    description = json.dumps([plan_fingerprint, options], sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class FingerprintIndex:
+    """SQLite index of source file -> (fingerprint, output path, plan fingerprint)
+    of the last anonymization. A file is unchanged, if its size and modification
+    time (and content hash with `hash_content`) are the same, it was anonymized
+    into the same output path with the same plan (see `AnonymizationPlan.fingerprint`,
+    `run_fingerprint` to include the other options) and the output still exists.
+    Entries made with another plan never match, so changed rules re-anonymize all files.
+    Missing source files are never unchanged, they fail (and are reported) when
+    anonymized.
+
+    The fingerprint is taken by `is_unchanged` before the file is anonymized and
+    stored by `record` after the output is written, or dropped by `discard` if the
+    file failed, so only fingerprints of the files in flight are kept in memory.
+    Records are committed every `batch_size` files and on `flush`. The index is used
+    by one process.
+    """
+
+    def __init__(
+        self,
+        db_path: Path_Str,
+        plan_fingerprint: str,
+        hash_content: bool = False,
+        batch_size: int = 256,
+    ):
+        self.db_path = str(db_path)
+        self.plan_fingerprint = plan_fingerprint
+        self.hash_content = hash_content
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(self.db_path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS source_files (source TEXT PRIMARY KEY, "
+            "size INTEGER, mtime_ns INTEGER, content_hash TEXT, output TEXT, plan TEXT) "
+            "WITHOUT ROWID"
+        )
+        # fingerprints of the files checked, but not yet recorded
+        self._pending: Dict[str, SourceFingerprint] = {}
+        self._uncommitted = 0
+
+    def is_unchanged(self, f_in: Path_Str, f_out: Path_Str) -> bool:
+        """Check if `f_in` was anonymized into `f_out` with the same plan and
+        didn't change since then. Doesn't read the file, unless `hash_content` is set.
+
+        Args:
+            f_in (Path_Str): path to the source file
+            f_out (Path_Str): path to the anonymized copy
+
+        Returns:
+            bool: True if anonymization of the file can be skipped
+        """
+        try:
+            stat = os.stat(f_in)
+        except OSError:
+            # e.g. a stale manifest entry, the error is reported by the anonymization
+            return False
+        row = self._conn.execute(
+            "SELECT size, mtime_ns, content_hash, output, plan FROM source_files "
+            "WHERE source = ?",
+            (str(f_in),),
+        ).fetchone()
+        if (
+            row is not None
+            and row[:2] == (stat.st_size, stat.st_mtime_ns)
+            and row[3:] == (str(f_out), self.plan_fingerprint)
+            and os.path.exists(f_out)
+        ):
+            if not self.hash_content:
+                return True
+            content_hash = hash_file(f_in)
+            if content_hash == row[2]:
+                return True
+        else:
+            content_hash = hash_file(f_in) if self.hash_content else None
+        self._pending[str(f_in)] = SourceFingerprint(
+            stat.st_size, stat.st_mtime_ns, content_hash
+        )
+        return False
+
+    def record(self, f_in: Path_Str, f_out: Path_Str):
+        """Store the fingerprint of anonymized `f_in` (taken by `is_unchanged`)
+
+        Args:
+            f_in (Path_Str): path to the source file
+            f_out (Path_Str): path to the anonymized copy
+        """
+        fingerprint = self._pending.pop(str(f_in), None)
+        if fingerprint is None:
+            fingerprint = source_fingerprint(f_in, self.hash_content)
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO source_files VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                str(f_in),
+                fingerprint.size,
+                fingerprint.mtime_ns,
+                fingerprint.content_hash,
+                str(f_out),
+                self.plan_fingerprint,
+            ),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.batch_size:
+            self.flush()
+
+    def discard(self, f_in: Path_Str):
+        """Drop the fingerprint of `f_in` taken by `is_unchanged` without recording it,
+        e.g. if the anonymization failed
+
+        Args:
+            f_in (Path_Str): path to the source file
+        """
+        self._pending.pop(str(f_in), None)
+
+    def flush(self):
+        """Commit recorded fingerprints"""
+        if self._conn.in_transaction:
+            self._conn.execute("COMMIT")
+        self._uncommitted = 0
+
+    def close(self):
+        """Commit recorded fingerprints and close the database"""
+        self.flush()
+        self._conn.close()
@@ -0,0 +1,115 @@
+"""This module holds per file results of the batch anonymization and
+writes them to a result manifest (json lines or csv), one record per file.
+"""
+import csv
+import io
+import json
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from .tag_stats import TagKey
+from .utils import Path_Str
+
+# FileResult.status values
+STATUS_OK = "ok"
+STATUS_SKIPPED = "skipped"
+STATUS_ERROR = "error"
+
+STAGES = ("read", "anonymize", "write")
+
+CSV_FIELDS = (
+    ["source", "output", "status", "error", "bytes_in", "bytes_out"]
+    + [f"{stage}_s" for stage in STAGES]
+    + ["uids"]
+)
+
+
+@dataclass
+class FileResult:
+    """Result of anonymization of one file. Status is "ok" if the anonymized copy is
+    saved, "skipped" if the file is not a valid dicom file or failed to anonymize
+    (see `anonymize_file_dataset`), "error" if an exception was raised.
+    """
+
+    source: str
+    output: str
+    status: str = STATUS_OK
+    error: Optional[str] = None
+    bytes_in: int = 0
+    bytes_out: int = 0
+    # seconds per stage, see `anonymize_dicom_file`
+    timings: Dict[str, float] = field(default_factory=dict)
+    # original -> new UID pairs
+    uids: Dict[str, str] = field(default_factory=dict)
+    # dataset tags, not a part of the manifest record
+    tags: Optional[List[TagKey]] = None
+
+    def to_record(self) -> dict:
+        """Manifest record of the result
+
+        Returns:
+            dict: result fields without tags
+        """
+        record = asdict(self)
+        del record["tags"]
+        return record
+
+
+class ResultManifestWriter:
+    """Append results to the manifest file, csv if the file extension is .csv,
+    json lines otherwise. Records are buffered and written `buffer_size` at a time
+    (and on `flush`/`close`), so writing adds one append per batch of files.
+    """
+
+    def __init__(self, path: Path_Str, buffer_size: int = 256):
+        self.path = path
+        self.is_csv = str(path).lower().endswith(".csv")
+        self.buffer_size = buffer_size
+        self._buffer: List[FileResult] = []
+        self._file = open(path, "a", newline="")
+        if self.is_csv and self._file.tell() == 0:
+            csv.writer(self._file).writerow(CSV_FIELDS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, result: FileResult):
+        """Buffer the result, see `flush`
+
+        Args:
+            result (FileResult): result of one file
+        """
+        self._buffer.append(result)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def _format(self) -> str:
+        out = io.StringIO()
+        if self.is_csv:
+            writer = csv.writer(out)
+            for result in self._buffer:
+                record = result.to_record()
+                writer.writerow(
+                    [record[name] for name in CSV_FIELDS[:6]]
+                    + [record["timings"].get(stage) for stage in STAGES]
+                    + [json.dumps(record["uids"])]
+                )
+        else:
+            for result in self._buffer:
+                out.write(json.dumps(result.to_record()) + "\n")
+        return out.getvalue()
+
+    def flush(self):
+        """Write buffered results to the file"""
+        if self._buffer:
+            self._file.write(self._format())
+            self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        """Write buffered results and close the file"""
+        self.flush()
+        self._file.close()
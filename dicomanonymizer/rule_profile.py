@@ -0,0 +1,159 @@
+"""This module profiles anonymization rules: which rules fire on a corpus and what
+they cost. Actions of the plan are wrapped to count hits and time spent in them,
+so profiling works with any engine (see `anonymize_dataset`).
+"""
+import functools
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pydicom
+from pydicom.datadict import keyword_for_tag
+
+from .anonym_plan import AnonymizationPlan, _to_ints
+from .utils import TagTuple
+
+
+@dataclass
+class RuleStats:
+    """Counters of one rule"""
+
+    # number of elements the action was applied to
+    hits: int = 0
+    # number of datasets with at least one hit
+    datasets: int = 0
+    # time spent in the action, hits and misses (per rule engine) included
+    seconds: float = 0.0
+
+
+class _ProfiledAction:
+    """Action wrapper updating `RuleStats` of its rule"""
+
+    def __init__(self, profile: "RuleProfile", stats: RuleStats, action: Callable):
+        self.profile = profile
+        self.stats = stats
+        self.action = action
+        # number of the last dataset with a hit, see `RuleProfile.datasets`
+        self.last_dataset = 0
+
+    def __call__(self, dataset: pydicom.Dataset, tag):
+        # the per rule engine applies every rule, present or not,
+        # actions look the tag up in the file meta too
+        file_meta = getattr(dataset, "file_meta", None)
+        hit = tag in dataset or (file_meta is not None and tag in file_meta)
+        start = time.perf_counter()
+        self.action(dataset, tag)
+        self.stats.seconds += time.perf_counter() - start
+        if hit:
+            self.stats.hits += 1
+            if self.last_dataset != self.profile.datasets:
+                self.last_dataset = self.profile.datasets
+                self.stats.datasets += 1
+
+
+def rule_name(tag: TagTuple) -> str:
+    """Readable name of the rule tag: "(gggg,eeee) Keyword" for individual tags,
+    "(gggg,eeee)&(mmmm,mmmm)" with masks for repeating groups
+
+    Args:
+        tag (TagTuple): tag as defined in the rules
+
+    Returns:
+        str: name of the rule
+    """
+    ints = _to_ints(tag)
+    name = f"({ints[0]:04X},{ints[1]:04X})"
+    if len(ints) > 2:
+        return f"{name}&({ints[2]:04X},{ints[3]:04X})"
+    keyword = keyword_for_tag((ints[0] << 16) | ints[1])
+    return f"{name} {keyword}" if keyword else name
+
+
+def action_name(action: Callable) -> str:
+    """Name of the action function (of the wrapped one for partials)"""
+    if isinstance(action, functools.partial):
+        return action_name(action.func)
+    return getattr(action, "__name__", None) or repr(action)
+
+
+class RuleProfile:
+    """Hit counts and cumulative time per rule, collected over all datasets
+    anonymized with the profile (see `anonymize_dataset`). Not meant for
+    worker processes: every process would collect its own profile.
+    """
+
+    def __init__(self):
+        self.stats: Dict[TagTuple, RuleStats] = {}
+        self.actions: Dict[TagTuple, Callable] = {}
+        # number of profiled datasets
+        self.datasets = 0
+        self._plans: Dict[int, Tuple[AnonymizationPlan, AnonymizationPlan]] = {}
+
+    def instrument(self, plan: AnonymizationPlan) -> AnonymizationPlan:
+        """Plan with the actions wrapped to update the profile, built once per plan
+
+        Args:
+            plan (AnonymizationPlan): plan to profile
+
+        Returns:
+            AnonymizationPlan: instrumented plan
+        """
+        cached = self._plans.get(id(plan))
+        if cached is not None and cached[0] is plan:
+            return cached[1]
+        rules = []
+        for tag, action in plan.rules:
+            stats = self.stats.setdefault(tag, RuleStats())
+            self.actions[tag] = action
+            rules.append((tag, _ProfiledAction(self, stats, action)))
+        instrumented = AnonymizationPlan(tuple(rules))
+        # the plan is kept in the cache, so its id is not reused
+        self._plans[id(plan)] = (plan, instrumented)
+        return instrumented
+
+    def start_dataset(self):
+        """Count the next dataset, called by `anonymize_dataset`"""
+        self.datasets += 1
+
+    def ranked(self) -> List[Tuple[TagTuple, RuleStats]]:
+        """Rules sorted by cumulative time, most expensive first
+
+        Returns:
+            List[Tuple[TagTuple, RuleStats]]: (rule tag, stats) pairs
+        """
+        return sorted(self.stats.items(), key=lambda item: -item[1].seconds)
+
+    def unused_rules(self) -> List[TagTuple]:
+        """Rules, which never matched an element of the profiled datasets
+
+        Returns:
+            List[TagTuple]: rule tags in the plan order
+        """
+        return [tag for tag, stats in self.stats.items() if not stats.hits]
+
+    def report(self, top: Optional[int] = None) -> str:
+        """Ranked report (see `ranked`) followed by the list of unused rules
+
+        Args:
+            top (Optional[int], optional): max number of ranked rules. Defaults to None (all).
+
+        Returns:
+            str: report text
+        """
+        lines = [
+            f"Profiled datasets: {self.datasets}",
+            f"{'rule':<48} {'action':<32} {'hits':>8} {'misses':>8} {'ms':>10} {'us/hit':>8}",
+        ]
+        for tag, stats in self.ranked()[:top]:
+            per_hit = 1e6 * stats.seconds / stats.hits if stats.hits else 0.0
+            lines.append(
+                f"{rule_name(tag):<48} {action_name(self.actions[tag]):<32} "
+                f"{stats.hits:>8} {self.datasets - stats.datasets:>8} "
+                f"{1e3 * stats.seconds:>10.3f} {per_hit:>8.1f}"
+            )
+        unused = self.unused_rules()
+        lines.append(f"Rules never matched ({len(unused)}):")
+        lines.extend(
+            f"  {rule_name(tag)} {action_name(self.actions[tag])}" for tag in unused
+        )
+        return "\n".join(lines)
@@ -0,0 +1,147 @@
+"""This module splits a batch between independent runs (nodes) without a coordinator:
+every run gets its shard K of N and keeps only files whose key hashes to K.
+The hash is stable between processes, machines and Python versions.
+"""
+
+import hashlib
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# keys of the files, see `Shard`
+SHARD_BY_PATH = "path"
+SHARD_BY_STUDY = "study"
+SHARD_BY = (SHARD_BY_PATH, SHARD_BY_STUDY)
+
+
+def shard_of(key: str, count: int) -> int:
+    """Shard of the key
+
+    Args:
+        key (str): key, e.g. relative path or StudyInstanceUID
+        count (int): number of shards
+
+    Returns:
+        int: shard index in [0, count)
+    """
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def read_study_uid(path: Path) -> Optional[str]:
+    """StudyInstanceUID of the dicom file, only the header is parsed
+
+    Args:
+        path (Path): path to the file
+
+    Returns:
+        Optional[str]: StudyInstanceUID or None if the file has none or can't be read
+    """
+    import pydicom
+
+    try:
+        dataset = pydicom.dcmread(
+            path, stop_before_pixels=True, specific_tags=["StudyInstanceUID"]
+        )
+    except Exception as e:
+        logger.debug(f"Can't read StudyInstanceUID of {path}: {e}")
+        return None
+    uid = dataset.get("StudyInstanceUID")
+    return str(uid) if uid else None
+
+
+def _relative_key(path: Path, root: Path) -> str:
+    """Path relative to the root (or as is, if outside of it)"""
+    try:
+        path = path.relative_to(root)
+    except ValueError:
+        pass
+    return path.as_posix()
+
+
+@dataclass(frozen=True)
+class Shard:
+    """Shard `index` of `count`. Files are assigned by their key:
+    - "path": path of the file folder relative to the source root, so folders stay
+    together and folders of other shards are skipped without listing them. Files of
+    a single folder or of a manifest are keyed by their own relative path instead
+    (see `select`), so they spread across the shards
+    - "study": StudyInstanceUID, so studies stay together even if spread across folders,
+    costs a header read per file by every shard (files without the UID fall back to "path")
+    """
+
+    index: int
+    count: int
+    by: str = SHARD_BY_PATH
+
+    def __post_init__(self):
+        if not 0 <= self.index < self.count:
+            raise ValueError(
+                f"Shard index should be in [0, {self.count}): {self.index}"
+            )
+        if self.by not in SHARD_BY:
+            raise ValueError(f"Unknown shard key: {self.by}, use one of {SHARD_BY}")
+
+    @classmethod
+    def parse(cls, spec: str, by: str = SHARD_BY_PATH) -> "Shard":
+        """Create a shard from "K/N" spec
+
+        Args:
+            spec (str): "K/N", 0 <= K < N
+            by (str, optional): key of the files. Defaults to SHARD_BY_PATH.
+
+        Raises:
+            ValueError: if the spec is not valid
+
+        Returns:
+            Shard: shard
+        """
+        try:
+            index, count = (int(x) for x in spec.split("/"))
+        except ValueError:
+            raise ValueError(f"Shard should be K/N, e.g. 0/4: {spec}")
+        return cls(index, count, by)
+
+    @property
+    def name(self) -> str:
+        """Name of the shard, e.g. "0-of-4" """
+        return f"{self.index}-of-{self.count}"
+
+    def owns(self, key: str) -> bool:
+        """Check if the key belongs to the shard"""
+        return shard_of(key, self.count) == self.index
+
+    def owns_folder(self, rel_path: str) -> bool:
+        """Check if files of the folder might belong to the shard
+
+        Args:
+            rel_path (str): path of the folder relative to the source root
+
+        Returns:
+            bool: False if the whole folder belongs to other shards
+        """
+        return self.by != SHARD_BY_PATH or self.owns(Path(rel_path).as_posix())
+
+    def select(
+        self, tasks: Iterable[Tuple[Path, Path]], root: Path, by_folder: bool = True
+    ) -> Iterator[Tuple[Path, Path]]:
+        """Keep tasks of the files, which belong to the shard
+
+        Args:
+            tasks (Iterable[Tuple[Path, Path]]): (input file, output file) pairs
+            root (Path): source root, paths are keyed relative to it
+            by_folder (bool, optional): if "path" keys are the file folders, otherwise
+            the files themselves. Defaults to True.
+
+        Yields:
+            Iterator[Tuple[Path, Path]]: tasks of the shard
+        """
+        for f_in, f_out in tasks:
+            key = read_study_uid(f_in) if self.by == SHARD_BY_STUDY else None
+            if key is None:
+                key = _relative_key(f_in.parent if by_folder else f_in, root)
+            if self.owns(key):
+                yield f_in, f_out
@@ -1,17 +1,44 @@
+import functools
+import io
 import logging
 import logging.config
+import os
 import re
-from random import randint
-from typing import Callable, Dict, List, Optional, Tuple
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import pydicom
 from pydicom.errors import InvalidDicomError
 
+from .anonym_plan import AnonymizationPlan
+from .dicom_utils import (
+    SNIFF_RAW,
+    append_file_range,
+    dcmread_buffer,
+    dcmread_mmap,
+    get_element_end,
+    get_element_tag,
+    open_mmap,
+    sniff_dicom,
+    sniff_dicom_header,
+)
 from .dicomfields import ACTION_TO_TAG_LIST
 from .format_tag import tag_to_hex_strings
+from .rule_profile import RuleProfile
+from .stage_metrics import observe_since, observe_stage, stage_start
+from .uid_mapping import (
+    KeyedUIDMapper,
+    RandomUIDMapper,
+    RecordingUIDMapper,
+    SQLiteUIDMapper,
+    UIDMapper,
+)
 from .utils import ActionsDict, Path_Str, TagList, TagTuple
 
 dictionary = {}
+_uid_mapper: UIDMapper = RandomUIDMapper(dictionary)
 
 # setup logging
 logger = logging.getLogger(__name__)
@@ -19,6 +46,15 @@ logger = logging.getLogger(__name__)
 # Regexp function
 
 
+def apply_regexp(options: dict, dataset, tag):
+    """
+    Apply a regexp to the dataset
+    """
+    element = dataset.get(tag)
+    if element is not None:
+        element.value = re.sub(options["find"], options["replace"], str(element.value))
+
+
 def regexp(options: dict):
     """
     Apply a regexp method to the dataset
@@ -26,36 +62,63 @@ def regexp(options: dict):
     :param options: contains two values:
         - find: which string should be find
         - replace: string that will replace the find string
+    :return action function, picklable (so it can be a part of AnonymizationPlan)
     """
+    return functools.partial(apply_regexp, options)
 
-    def apply_regexp(dataset, tag):
-        """
-        Apply a regexp to the dataset
-        """
-        element = dataset.get(tag)
-        if element is not None:
-            element.value = re.sub(
-                options["find"], options["replace"], str(element.value)
-            )
 
-    return apply_regexp
+# Default anonymization functions
 
 
-# Default anonymization functions
+def set_uid_mapper(mapper: UIDMapper) -> None:
+    """Set how UIDs are replaced, e.g. `set_uid_mapper(KeyedUIDMapper(secret))`
+    for deterministic replacements or `set_uid_mapper(SQLiteUIDMapper(db_path))`
+    for random replacements persistent between runs. Default is RandomUIDMapper(dictionary).
+
+    Args:
+        mapper (UIDMapper): UID replacement strategy
+    """
+    global _uid_mapper
+    _uid_mapper = mapper
+
+
+def get_uid_mapper() -> UIDMapper:
+    """Get current UID replacement strategy
+
+    Returns:
+        UIDMapper: UID replacement strategy
+    """
+    return _uid_mapper
+
+
+@contextmanager
+def recording_uids() -> Iterator[Dict[str, str]]:
+    """Record UID replacements done within the context
+
+    Yields:
+        Iterator[Dict[str, str]]: original -> new UID pairs, filled as UIDs are replaced
+    """
+    global _uid_mapper
+    mapper = _uid_mapper
+    recorder = RecordingUIDMapper(mapper)
+    _uid_mapper = recorder
+    try:
+        yield recorder.pairs
+    finally:
+        _uid_mapper = mapper
 
 
 def replace_element_UID(element: pydicom.DataElement):
     """
-    Keep char value but replace char number with random number
+    Replace UID(s) with the current UID mapper (see `set_uid_mapper`).
+    Default one keeps char value but replace char number with random number
     The replaced value is kept in a dictionary link to the initial element.value in order to automatically
     apply the same replaced value if we have an other UID with the same value
     """
-    if element.value not in dictionary:
-        new_chars = [
-            str(randint(0, 9)) if char.isalnum() else char for char in element.value
-        ]
-        dictionary[element.value] = "".join(new_chars)
-    element.value = dictionary.get(element.value)
+    if isinstance(element.value, pydicom.multival.MultiValue):
+        element.value = [_uid_mapper.map(uid) for uid in element.value]
+    else:
+        element.value = _uid_mapper.map(element.value)
 
 
 def replace_element_date(element: pydicom.DataElement):
@@ -88,9 +151,74 @@ def replace_element_IS(element: pydicom.DataElement):
         element.value = "0"
 
 
+def replace_element_time(element: pydicom.DataElement):
+    """
+    Replace time element's value with '000000.00'
+    """
+    element.value = "000000.00"
+
+
+def replace_element_text(element: pydicom.DataElement):
+    """
+    Replace text element's value with 'Anonymized'
+    """
+    element.value = "Anonymized"
+
+
+def replace_element_number(element: pydicom.DataElement):
+    """
+    Replace numeric element's value with 0
+    """
+    element.value = 0
+
+
+def empty_element_value(element: pydicom.DataElement):
+    """
+    Replace element's value with ''
+    """
+    element.value = ""
+
+
+def keep_element(element: pydicom.DataElement):
+    """
+    Leave element's value as is
+    """
+    pass
+
+
+def replace_element_sequence(element: pydicom.DataElement):
+    """
+    Call replace_element for all sub elements of the sequence
+    """
+    for sub_dataset in element.value:
+        # iterating a dataset yields converted elements (not raw ones)
+        for sub_element in sub_dataset:
+            replace_element(sub_element)
+
+
+REPLACE_VR_HANDLERS = {
+    "DA": replace_element_date,
+    "TM": replace_element_time,
+    "LO": replace_element_text,
+    "SH": replace_element_text,
+    "PN": replace_element_text,
+    "CS": replace_element_text,
+    "UI": replace_element_UID,
+    "UL": keep_element,
+    "IS": replace_element_IS,
+    "FD": replace_element_number,
+    "FL": replace_element_number,
+    "SS": replace_element_number,
+    "US": replace_element_number,
+    "ST": empty_element_value,
+    "SQ": replace_element_sequence,
+    "DT": replace_element_date_time,
+}
+
+
 def replace_element(element):
     """
-    Replace element's value according to it's VR:
+    Replace element's value according to it's VR (see REPLACE_VR_HANDLERS):
     - DA: cf replace_element_date
     - TM: replace with '000000.00'
     - LO, SH, PN, CS: replace with 'Anonymized'
@@ -100,33 +228,14 @@ def replace_element(element):
     - ST: replace with ''
     - SQ: call replace_element for all sub elements
     - DT: cf replace_element_date_time
+    Handlers for other VRs can be added with `register_vr_handler`
     """
-    if element.VR == "DA":
-        replace_element_date(element)
-    elif element.VR == "TM":
-        element.value = "000000.00"
-    elif element.VR in ("LO", "SH", "PN", "CS"):
-        element.value = "Anonymized"
-    elif element.VR == "UI":
-        replace_element_UID(element)
-    elif element.VR == "UL":
-        pass
-    elif element.VR == "IS":
-        replace_element_IS(element)
-    elif element.VR in ("FD", "FL", "SS", "US"):
-        element.value = 0
-    elif element.VR == "ST":
-        element.value = ""
-    elif element.VR == "SQ":
-        for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
-                replace_element(sub_element)
-    elif element.VR == "DT":
-        replace_element_date_time(element)
-    else:
+    handler = REPLACE_VR_HANDLERS.get(element.VR)
+    if handler is None:
         raise NotImplementedError(
             "Not anonymized. VR {} not yet implemented.".format(element.VR)
         )
+    handler(element)
 
 
 # NOTE: In case user want to add a tag from `file_meta` to de-id rules, we need to
@@ -149,31 +258,44 @@ def replace(dataset: pydicom.Dataset, tag: Tuple[int, int]):
         replace_element(element)
 
 
+def empty_element_sequence(element: pydicom.DataElement):
+    """
+    Call empty_element for all sub elements of the sequence
+    """
+    for sub_dataset in element.value:
+        for sub_element in sub_dataset:
+            empty_element(sub_element)
+
+
+EMPTY_VR_HANDLERS = {
+    "SH": empty_element_value,
+    "PN": empty_element_value,
+    "UI": empty_element_value,
+    "LO": empty_element_value,
+    "CS": empty_element_value,
+    "DA": replace_element_date,
+    "TM": replace_element_time,
+    "UL": replace_element_number,
+    "SQ": empty_element_sequence,
+}
+
+
 def empty_element(element: pydicom.DataElement):
     """
-    Clean element according to the element's VR:
+    Clean element according to the element's VR (see EMPTY_VR_HANDLERS):
     - SH, PN, UI, LO, CS: value will be set to ''
     - DA: value will be replaced by '00010101'
     - TM: value will be replaced by '000000.00'
     - UL: value will be replaced by 0
     - SQ: all subelement will be called with "empty_element"
+    Handlers for other VRs can be added with `register_vr_handler`
     """
-    if element.VR in ("SH", "PN", "UI", "LO", "CS"):
-        element.value = ""
-    elif element.VR == "DA":
-        replace_element_date(element)
-    elif element.VR == "TM":
-        element.value = "000000.00"
-    elif element.VR == "UL":
-        element.value = 0
-    elif element.VR == "SQ":
-        for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
-                empty_element(sub_element)
-    else:
+    handler = EMPTY_VR_HANDLERS.get(element.VR)
+    if handler is None:
         raise NotImplementedError(
             "Not anonymized. VR {} not yet implemented.".format(element.VR)
         )
+    handler(element)
 
 
 def empty(dataset: pydicom.Dataset, tag: Tuple[int, int]):
@@ -191,27 +313,73 @@ def empty(dataset: pydicom.Dataset, tag: Tuple[int, int]):
         empty_element(element)
 
 
+def remove_element(dataset: pydicom.Dataset, element: pydicom.DataElement):
+    """Remove the element from the dataset or from its file_meta
+
+    Args:
+        dataset (pydicom.Dataset): dataset to work with
+        element (pydicom.DataElement): dataelement to work with
+    """
+    # in case the tag is from file_meta
+    if hasattr(dataset, "file_meta") and element.tag in dataset.file_meta:
+        del dataset.file_meta[element.tag]
+    # in the rest of the header
+    else:
+        del dataset[element.tag]
+
+
+def delete_element_date(dataset: pydicom.Dataset, element: pydicom.DataElement):
+    """Date element is not removed, but replaced by 00010101"""
+    replace_element_date(element)
+
+
+def delete_element_sequence(dataset: pydicom.Dataset, element: pydicom.DataElement):
+    """Call delete_element for all sub elements of the sequence"""
+    if not isinstance(element.value, pydicom.Sequence):
+        remove_element(dataset, element)
+        return
+    for sub_dataset in element.value:
+        for sub_element in sub_dataset:
+            delete_element(sub_dataset, sub_element)
+
+
+# VRs not in the mapping are removed with `remove_element`
+DELETE_VR_HANDLERS = {
+    "DA": delete_element_date,
+    "SQ": delete_element_sequence,
+}
+
+
 def delete_element(dataset: pydicom.Dataset, element: pydicom.DataElement):
-    """Delete the element from the dataset.
+    """Delete the element from the dataset (see DELETE_VR_HANDLERS).
     If VR's element is a date, then it will be replaced by 00010101
 
     Args:
         dataset (pydicom.Dataset): dataset to work with
         element (pydicom.DataElement): dataelement to work with
     """
-    if element.VR == "DA":
-        replace_element_date(element)
-    elif element.VR == "SQ" and isinstance(element.value, pydicom.Sequence):
-        for sub_dataset in element.value:
-            for sub_element in sub_dataset.elements():
-                delete_element(sub_dataset, sub_element)
-    else:
-        # in case the tag is from file_meta
-        if hasattr(dataset, "file_meta") and element.tag in dataset.file_meta:
-            del dataset.file_meta[element.tag]
-        # in the rest of the header
-        else:
-            del dataset[element.tag]
+    DELETE_VR_HANDLERS.get(element.VR, remove_element)(dataset, element)
+
+
+VR_HANDLERS = {
+    "replace": REPLACE_VR_HANDLERS,
+    "empty": EMPTY_VR_HANDLERS,
+    "delete": DELETE_VR_HANDLERS,
+}
+
+
+def register_vr_handler(operation: str, vr: str, handler: Callable) -> None:
+    """Register (or override) how elements with the given VR are handled,
+    e.g. `register_vr_handler("empty", "LT", empty_element_value)`
+
+    Args:
+        operation (str): one of "replace", "empty", "delete"
+        vr (str): value representation, like "AS", "LT", "DS"
+        handler (Callable): for "replace" and "empty" takes an element,
+        for "delete" takes a dataset and an element
+    """
+    assert operation in VR_HANDLERS, f"Unknown operation: {operation}"
+    VR_HANDLERS[operation][vr] = handler
 
 
 def delete(dataset: pydicom.Dataset, tag: Tuple[int, int]):
@@ -363,31 +531,206 @@ def initialize_actions(
     return anonymization_actions
 
 
-def anonymize_dicom_file(
-    in_file: Path_Str,
-    out_file: Path_Str,
+def build_plan(
     extra_anonymization_rules: Optional[ActionsDict] = None,
-    delete_private_tags: bool = True,
-    ds_callback: Optional[Callable[[pydicom.Dataset], None]] = None,
-) -> None:
-    """Anonymize a DICOM file by modifying personal tags
+    act_to_tag_list_map: Dict[str, TagList] = ACTION_TO_TAG_LIST,
+) -> AnonymizationPlan:
+    """Build an anonymization plan: profile rules updated with user-defined rules.
+    Build it once and pass it to `anonymize_dataset` or `anonymize_dicom_file`
+    for every dataset, instead of rebuilding the rules per dataset.
+
+    Args:
+        extra_anonymization_rules (Optional[ActionsDict], optional): user-defined rules. Defaults to None.
+        act_to_tag_list_map (Dict[str, TagList], optional): mapping of action
+        (as a str) -> list of tags. Defaults to ACTION_TO_TAG_LIST.
+
+    Raises:
+        ValueError: if a repeating group rule has bits outside of its masks,
+        see `AnonymizationPlan`
+
+    Returns:
+        AnonymizationPlan: immutable plan
+    """
+    anonymization_actions = initialize_actions(act_to_tag_list_map)
+    if extra_anonymization_rules is not None:
+        anonymization_actions.update(extra_anonymization_rules)
+    return AnonymizationPlan.from_actions(anonymization_actions)
+
+
+@functools.lru_cache(maxsize=None)
+def _default_plan() -> AnonymizationPlan:
+    return build_plan()
+
+
+def resolve_plan(
+    extra_anonymization_rules: Optional[ActionsDict] = None,
+    plan: Optional[AnonymizationPlan] = None,
+) -> AnonymizationPlan:
+    """Get a plan to work with: either provided `plan` or one built from
+    the profile and `extra_anonymization_rules`
+
+    Args:
+        extra_anonymization_rules (Optional[ActionsDict], optional): user-defined rules. Defaults to None.
+        plan (Optional[AnonymizationPlan], optional): prebuilt plan. Defaults to None.
+
+    Raises:
+        ValueError: if both `extra_anonymization_rules` and `plan` provided
+
+    Returns:
+        AnonymizationPlan: plan
+    """
+    if plan is not None:
+        if extra_anonymization_rules is not None:
+            raise ValueError(
+                "Provide either extra_anonymization_rules or plan, not both. "
+                "Extra rules should be included into the plan with build_plan."
+            )
+        return plan
+    if extra_anonymization_rules is None:
+        return _default_plan()
+    return build_plan(extra_anonymization_rules)
+
+
+# (group, element) of float, double float and integer pixel data
+_PIXEL_DATA_TAGS = {(0x7FE0, 0x0008), (0x7FE0, 0x0009), (0x7FE0, 0x0010)}
+
+
+@dataclass(frozen=True)
+class PixelPayload:
+    """Byte range of the pixel data element (header included) in the original file,
+    which is copied to the anonymized file as is
+    """
+
+    path: Path_Str
+    offset: int
+    length: int
 
-    Conforms to DICOM standard except for customer specificities.
+
+def _dcmread(fp, use_mmap: bool, **kwargs) -> pydicom.Dataset:
+    if use_mmap:
+        return dcmread_mmap(fp, **kwargs)
+    return pydicom.dcmread(fp, **kwargs)
+
+
+def read_dicom_header(
+    in_file: Path_Str, use_mmap: bool = False, force: bool = False
+) -> pydicom.Dataset:
+    """Read the dataset up to the pixel data. If pixel data is the last
+    element of the file, its location is kept in `dataset.pixel_payload`
+    to be copied by `write_dicom_file`, otherwise the whole file is read.
 
     Args:
         in_file (Path_Str): path to the original file
-        out_file (Path_Str): path to anonymized version of `in_file` to be saved
-        extra_anonymization_rules (dict, optional): User-provided custom anonymization rules. Defaults to None.
-        delete_private_tags (bool, optional): if private tags to be deleted. Defaults to True.
-        ds_callback (Optional[Callable[[pydicom.Dataset], None]], optional): optional way to access a dataset
-        before anonymization. Defaults to None.
+        use_mmap (bool, optional): if read the memory mapped file, see `dcmread_mmap`.
+        Defaults to False.
+        force (bool, optional): passed to `pydicom.dcmread`. Defaults to False.
+
+    Returns:
+        pydicom.Dataset: dataset
+    """
+    # the mapping is not closed explicitly, dataset values might be views into it
+    fp = open_mmap(in_file) if use_mmap else open(in_file, "rb")
+    try:
+        dataset = _dcmread(fp, use_mmap, stop_before_pixels=True, force=force)
+        file_meta = getattr(dataset, "file_meta", pydicom.Dataset())
+        transfer_syntax = file_meta.get("TransferSyntaxUID")
+        if transfer_syntax is not None and transfer_syntax.is_deflated:
+            # the dataset is read from the inflated stream, file positions don't map on it
+            logger.debug(f"{in_file} is deflated, read it all")
+            fp.seek(0)
+            return _dcmread(fp, use_mmap, force=force)
+
+        # dcmread leaves the file at the start of the pixel data element
+        offset = fp.tell()
+        file_size = len(fp) if use_mmap else os.fstat(fp.fileno()).st_size
+        if offset == file_size:
+            return dataset
+
+        end = None
+        # the byte range is copied only if it is the pixel data element as stored
+        if (
+            transfer_syntax is not None
+            and get_element_tag(fp, offset, transfer_syntax.is_little_endian)
+            in _PIXEL_DATA_TAGS
+        ):
+            end = get_element_end(
+                fp,
+                offset,
+                transfer_syntax.is_implicit_VR,
+                transfer_syntax.is_little_endian,
+            )
+        if end == file_size:
+            dataset.pixel_payload = PixelPayload(in_file, offset, end - offset)
+            return dataset
+
+        logger.debug(f"Pixel data is not the last element of {in_file}, read it all")
+        fp.seek(0)
+        return _dcmread(fp, use_mmap, force=force)
+    finally:
+        if not use_mmap:
+            fp.close()
+
+
+def read_dicom_file(
+    in_file: Path_Str, pixel_passthrough: bool = False, use_mmap: bool = False
+) -> Optional[pydicom.Dataset]:
+    """Read stage of `anonymize_dicom_file`
+
+    Args:
+        in_file (Path_Str): path to the original file
+        pixel_passthrough (bool, optional): if only read the header, see `read_dicom_header`.
+        Defaults to False.
+        use_mmap (bool, optional): if read the memory mapped file, large values stay views
+        into the mapping, see `dcmread_mmap`. Defaults to False.
+
+    Returns:
+        Optional[pydicom.Dataset]: dataset or None if `in_file` is not a valid dicom file
     """
+
+    def read(force):
+        if pixel_passthrough:
+            return read_dicom_header(in_file, use_mmap, force)
+        if use_mmap:
+            return dcmread_mmap(open_mmap(in_file), force=force)
+        return pydicom.dcmread(in_file, force=force)
+
     try:
-        dataset = pydicom.dcmread(in_file)
+        try:
+            return read(force=False)
+        except InvalidDicomError:
+            # dataset without preamble and file meta, see `sniff_dicom`
+            if sniff_dicom(in_file) != SNIFF_RAW:
+                raise
+            return read(force=True)
     except InvalidDicomError:
         logger.error(f"Invalid dicom file: {in_file}, skipping")
-        return
+        return None
+
+
+def anonymize_file_dataset(
+    dataset: pydicom.Dataset,
+    in_file: Path_Str,
+    plan: AnonymizationPlan,
+    delete_private_tags: bool = True,
+    ds_callback: Optional[Callable[[pydicom.Dataset], None]] = None,
+    engine: str = "single_pass",
+    profile: Optional[RuleProfile] = None,
+) -> bool:
+    """Anonymization stage of `anonymize_dicom_file`
+
+    Args:
+        dataset (pydicom.Dataset): dataset read from `in_file`
+        in_file (Path_Str): path to the original file (used for logging)
+        plan (AnonymizationPlan): anonymization plan
+        delete_private_tags (bool, optional): if private tags to be deleted. Defaults to True.
+        ds_callback (Optional[Callable[[pydicom.Dataset], None]], optional): optional way to access a dataset
+        before anonymization. Defaults to None.
+        engine (str, optional): rules matching engine, see `anonymize_dataset`. Defaults to "single_pass".
+        profile (Optional[RuleProfile], optional): see `anonymize_dataset`. Defaults to None.
 
+    Returns:
+        bool: True if anonymized and should be saved
+    """
     # dataset callback goes here:
     if ds_callback is not None:
         ds_callback(dataset)
@@ -396,13 +739,257 @@ def anonymize_dicom_file(
     # like this: NotImplementedError: Unknown Value Representation '0x01 0xbc'
     # This dataset (explored manually) have empty `dir`
     try:
-        anonymize_dataset(dataset, extra_anonymization_rules, delete_private_tags)
+        anonymize_dataset(
+            dataset,
+            delete_private_tags=delete_private_tags,
+            plan=plan,
+            engine=engine,
+            profile=profile,
+        )
     except NotImplementedError as e:
         logger.error(f"error in file: {in_file}, see below")
         logger.exception(e)
+        return False
+    return True
+
+
+def write_dicom_file(dataset: pydicom.Dataset, out_file: Path_Str) -> None:
+    """Write stage of `anonymize_dicom_file`. Pixel data of the datasets read with
+    `read_dicom_header` is copied from the original file byte by byte.
+
+    Args:
+        dataset (pydicom.Dataset): anonymized dataset
+        out_file (Path_Str): path to save the dataset to
+    """
+    payload = getattr(dataset, "pixel_payload", None)
+    if payload is None:
+        dataset.save_as(out_file)
         return
+    with open(out_file, "wb") as out, open(payload.path, "rb") as src:
+        dataset.save_as(out)
+        append_file_range(src, out, payload.offset, payload.length)
+
+
+def anonymize_dicom_file(
+    in_file: Path_Str,
+    out_file: Path_Str,
+    extra_anonymization_rules: Optional[ActionsDict] = None,
+    delete_private_tags: bool = True,
+    ds_callback: Optional[Callable[[pydicom.Dataset], None]] = None,
+    plan: Optional[AnonymizationPlan] = None,
+    engine: str = "single_pass",
+    pixel_passthrough: bool = False,
+    use_mmap: bool = False,
+    timings: Optional[Dict[str, float]] = None,
+    profile: Optional[RuleProfile] = None,
+) -> bool:
+    """Anonymize a DICOM file by modifying personal tags
+
+    Conforms to DICOM standard except for customer specificities.
+
+    Args:
+        in_file (Path_Str): path to the original file
+        out_file (Path_Str): path to anonymized version of `in_file` to be saved
+        extra_anonymization_rules (dict, optional): User-provided custom anonymization rules. Defaults to None.
+        delete_private_tags (bool, optional): if private tags to be deleted. Defaults to True.
+        ds_callback (Optional[Callable[[pydicom.Dataset], None]], optional): optional way to access a dataset
+        before anonymization. Defaults to None.
+        plan (Optional[AnonymizationPlan], optional): prebuilt anonymization plan, use instead
+        of `extra_anonymization_rules` when anonymizing many files. Defaults to None.
+        engine (str, optional): rules matching engine, see `anonymize_dataset`. Defaults to "single_pass".
+        pixel_passthrough (bool, optional): if only the header is read and anonymized, pixel data is
+        copied from `in_file` as is (if no rule touches it). `ds_callback` gets the dataset without
+        pixel data then. Defaults to False.
+        use_mmap (bool, optional): if `in_file` is memory mapped and large values (pixel data,
+        OB/UN blobs) stay views into the mapping instead of being copied. Defaults to False.
+        timings (Optional[Dict[str, float]], optional): if given, filled with seconds spent
+        in the "read", "anonymize" and "write" stages. Defaults to None.
+        profile (Optional[RuleProfile], optional): see `anonymize_dataset`. Defaults to None.
+
+    Returns:
+        bool: True if the anonymized copy is saved, False if `in_file` was skipped
+    """
+    # resolve plan before reading, so misuse is reported even for the invalid files
+    plan = resolve_plan(extra_anonymization_rules, plan)
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    dataset = read_dicom_file(
+        in_file, pixel_passthrough and not plan.touches_pixel_data, use_mmap
+    )
+    timings["read"] = time.perf_counter() - start
+    observe_stage("read", timings["read"])
+    if dataset is None:
+        return False
+    start = time.perf_counter()
+    anonymized = anonymize_file_dataset(
+        dataset, in_file, plan, delete_private_tags, ds_callback, engine, profile
+    )
+    timings["anonymize"] = time.perf_counter() - start
+    observe_stage("anonymize", timings["anonymize"])
+    if not anonymized:
+        return False
     # Store modified image
-    dataset.save_as(out_file)
+    start = time.perf_counter()
+    write_dicom_file(dataset, out_file)
+    timings["write"] = time.perf_counter() - start
+    observe_stage("write", timings["write"])
+    return True
+
+
+# data of a dicom file in memory
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def read_dicom_bytes(data: Buffer) -> Optional[pydicom.Dataset]:
+    """Read stage of `anonymize_bytes`, large values (pixel data, OB/UN blobs) are not
+    copied, they stay memoryviews into `data` (see `dcmread_buffer`)
+
+    Args:
+        data (Buffer): dicom file data
+
+    Returns:
+        Optional[pydicom.Dataset]: dataset or None if `data` is not a valid dicom file
+    """
+    sniffed = sniff_dicom_header(data, len(data))
+    try:
+        if sniffed is not None:
+            return dcmread_buffer(data, force=sniffed == SNIFF_RAW)
+    except InvalidDicomError:
+        pass
+    logger.error("Invalid dicom data, skipping")
+    return None
+
+
+def _anonymize_buffer(
+    data: Buffer,
+    out: BinaryIO,
+    extra_anonymization_rules: Optional[ActionsDict] = None,
+    delete_private_tags: bool = True,
+    ds_callback: Optional[Callable[[pydicom.Dataset], None]] = None,
+    plan: Optional[AnonymizationPlan] = None,
+    engine: str = "single_pass",
+    timings: Optional[Dict[str, float]] = None,
+    profile: Optional[RuleProfile] = None,
+) -> bool:
+    # same stages as `anonymize_dicom_file`, but in memory
+    plan = resolve_plan(extra_anonymization_rules, plan)
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    dataset = read_dicom_bytes(data)
+    timings["read"] = time.perf_counter() - start
+    observe_stage("read", timings["read"])
+    if dataset is None:
+        return False
+    start = time.perf_counter()
+    anonymized = anonymize_file_dataset(
+        dataset, "<bytes>", plan, delete_private_tags, ds_callback, engine, profile
+    )
+    timings["anonymize"] = time.perf_counter() - start
+    observe_stage("anonymize", timings["anonymize"])
+    if not anonymized:
+        return False
+    start = time.perf_counter()
+    dataset.save_as(out)
+    timings["write"] = time.perf_counter() - start
+    observe_stage("write", timings["write"])
+    return True
+
+
+def anonymize_bytes(
+    data: Buffer,
+    extra_anonymization_rules: Optional[ActionsDict] = None,
+    delete_private_tags: bool = True,
+    ds_callback: Optional[Callable[[pydicom.Dataset], None]] = None,
+    plan: Optional[AnonymizationPlan] = None,
+    engine: str = "single_pass",
+    timings: Optional[Dict[str, float]] = None,
+    profile: Optional[RuleProfile] = None,
+) -> Optional[bytes]:
+    """Anonymize a DICOM file held in memory, no temporary files are written.
+    Rules (`plan`) and UID replacements (see `set_uid_mapper`) are the same as
+    with `anonymize_dicom_file`, build the plan once to anonymize many buffers.
+
+    Args:
+        data (Buffer): dicom file data, large values of the anonymized dataset are
+        views into it (not copied), so it should not be modified during the call
+        extra_anonymization_rules (dict, optional): User-provided custom anonymization rules. Defaults to None.
+        delete_private_tags (bool, optional): if private tags to be deleted. Defaults to True.
+        ds_callback (Optional[Callable[[pydicom.Dataset], None]], optional): optional way to access a dataset
+        before anonymization. Defaults to None.
+        plan (Optional[AnonymizationPlan], optional): prebuilt anonymization plan, see
+        `anonymize_dicom_file`. Defaults to None.
+        engine (str, optional): rules matching engine, see `anonymize_dataset`. Defaults to "single_pass".
+        timings (Optional[Dict[str, float]], optional): if given, filled with seconds spent
+        in the "read", "anonymize" and "write" stages. Defaults to None.
+        profile (Optional[RuleProfile], optional): see `anonymize_dataset`. Defaults to None.
+
+    Returns:
+        Optional[bytes]: anonymized file data, None if `data` was skipped
+    """
+    out = io.BytesIO()
+    if not _anonymize_buffer(
+        data,
+        out,
+        extra_anonymization_rules,
+        delete_private_tags,
+        ds_callback,
+        plan,
+        engine,
+        timings,
+        profile,
+    ):
+        return None
+    # the buffer of BytesIO is returned as is, not copied
+    return out.getvalue()
+
+
+def anonymize_stream(
+    src: BinaryIO,
+    dst: BinaryIO,
+    extra_anonymization_rules: Optional[ActionsDict] = None,
+    delete_private_tags: bool = True,
+    ds_callback: Optional[Callable[[pydicom.Dataset], None]] = None,
+    plan: Optional[AnonymizationPlan] = None,
+    engine: str = "single_pass",
+    timings: Optional[Dict[str, float]] = None,
+    profile: Optional[RuleProfile] = None,
+) -> bool:
+    """Anonymize a DICOM file read from `src` and write the anonymized one to `dst`,
+    see `anonymize_bytes`. An `io.BytesIO` source is read without copying its buffer.
+
+    Args:
+        src (BinaryIO): binary file object to read the original file from
+        dst (BinaryIO): binary file object to write the anonymized file to
+        extra_anonymization_rules (dict, optional): User-provided custom anonymization rules. Defaults to None.
+        delete_private_tags (bool, optional): if private tags to be deleted. Defaults to True.
+        ds_callback (Optional[Callable[[pydicom.Dataset], None]], optional): optional way to access a dataset
+        before anonymization. Defaults to None.
+        plan (Optional[AnonymizationPlan], optional): prebuilt anonymization plan, see
+        `anonymize_dicom_file`. Defaults to None.
+        engine (str, optional): rules matching engine, see `anonymize_dataset`. Defaults to "single_pass".
+        timings (Optional[Dict[str, float]], optional): if given, filled with seconds spent
+        in the "read", "anonymize" and "write" stages. Defaults to None.
+        profile (Optional[RuleProfile], optional): see `anonymize_dataset`. Defaults to None.
+
+    Returns:
+        bool: True if the anonymized copy is written, False if `src` was skipped
+    """
+    if isinstance(src, io.BytesIO):
+        data = src.getbuffer()[src.tell() :]
+        src.seek(0, io.SEEK_END)
+    else:
+        data = src.read()
+    return _anonymize_buffer(
+        data,
+        dst,
+        extra_anonymization_rules,
+        delete_private_tags,
+        ds_callback,
+        plan,
+        engine,
+        timings,
+        profile,
+    )
 
 
 def get_private_tag(dataset, tag):
@@ -463,45 +1050,87 @@ def get_private_tags(
     return private_tags
 
 
-def anonymize_dataset(
-    dataset: pydicom.Dataset,
-    extra_anonymization_rules: Optional[ActionsDict] = None,
-    delete_private_tags: bool = True,
+def walk_repeating_group(
+    dataset: pydicom.Dataset, tag: TagTuple, action: Callable
 ) -> None:
-    """Anonymize a pydicom Dataset by using anonymization rules which links an action to a tag
+    """Apply `action` to elements of the repeating group defined by `tag`
+    over the whole dataset (nested sequences included)
 
     Args:
-        dataset (pydicom.Dataset): dicom dataset
-        extra_anonymization_rules (dict, optional): user-defined rules. Defaults to None.
-        delete_private_tags (bool, optional): if delete private tags. Defaults to True.
+        dataset (pydicom.Dataset): dataset to work with
+        tag (TagTuple): (group, element, group_mask, element_mask)
+        action (Callable): action function
+    """
+    group, element, group_mask, element_mask = (
+        int(x, 16) if isinstance(x, str) else x for x in tag
+    )
+
+    def range_callback(dataset, data_element):
+        # repeating group condition
+        is_repeating_group = (
+            data_element.tag.group & group_mask == group
+            and data_element.tag.element & element_mask == element
+        )
+        if is_repeating_group:
+            # action is applied to the matched element, not to (group, element)
+            action(dataset, data_element.tag)
 
-    Raises:
-        Exception: will raise Exception if `dataset.get(tag)` fails
+    dataset.walk(range_callback)
+
+
+def walk_mask_index(dataset: pydicom.Dataset, plan: AnonymizationPlan) -> None:
+    """Apply all repeating group rules of the plan during one traversal
+    of the dataset (nested sequences included). As with the per rule engine,
+    every rule matching an element is applied, in the plan order, until
+    the element is gone (e.g. deleted).
+
+    Args:
+        dataset (pydicom.Dataset): dataset to work with
+        plan (AnonymizationPlan): anonymization plan
     """
-    current_anonymization_actions = initialize_actions()
+    mask_index = plan.mask_index
+    if not mask_index:
+        return
 
-    if extra_anonymization_rules is not None:
-        current_anonymization_actions.update(extra_anonymization_rules)
+    def range_callback(dataset, data_element):
+        tag = data_element.tag
+        group, element = tag.group, tag.element
+        matched = []
+        for group_mask, element_mask, masked in mask_index:
+            rule = masked.get((group & group_mask, element & element_mask))
+            if rule is not None:
+                matched.append(rule)
+        # rules of different masks might overlap
+        matched.sort()
+        for _, _, action in matched:
+            if tag not in dataset:
+                break
+            action(dataset, tag)
 
-    private_tags = []
+    dataset.walk(range_callback)
 
-    for tag, action in current_anonymization_actions.items():
 
-        def range_callback(dataset, data_element):
-            # repeating group condition
-            is_repeating_group = (
-                data_element.tag.group & tag[2] == tag[0]
-                and data_element.tag.element & tag[3] == tag[1]
-            )
-            if is_repeating_group:
-                # puting tag of 4 elements here will trigger the error with dataset.get
-                action(dataset, (tag[0], tag[1]))
+def apply_rules_per_rule(
+    dataset: pydicom.Dataset, plan: AnonymizationPlan
+) -> List[dict]:
+    """Reference engine: goes through every rule of the plan and looks
+    the tag up in the dataset. Cost scales with the number of rules.
+
+    Args:
+        dataset (pydicom.Dataset): dataset to work with
+        plan (AnonymizationPlan): anonymization plan
+
+    Returns:
+        List[dict]: private tags to restore (see `get_private_tag`)
+    """
+    private_tags = []
 
+    for tag, action in plan.rules:
         element = None
 
         # We are in a repeating group
         if len(tag) > 2:
-            dataset.walk(range_callback)
+            walk_repeating_group(dataset, tag, action)
         # Individual Tags
         else:
             action(dataset, tag)
@@ -515,8 +1144,100 @@ def anonymize_dataset(
             if element and element.tag.is_private:
                 private_tags.append(get_private_tag(dataset, tag))
 
+    return private_tags
+
+
+def apply_rules_single_pass(
+    dataset: pydicom.Dataset, plan: AnonymizationPlan
+) -> List[dict]:
+    """Default engine: goes once through elements present in the dataset
+    (and its `file_meta`) and dispatches each of them with a lookup in the
+    plan's tag index. Cost scales with the number of elements in the dataset.
+
+    Gives the same result as the per rule engine, except for an element matched
+    by both an individual tag rule and a repeating group rule: individual tag
+    rules are applied first here, the per rule engine follows the plan order.
+
+    Args:
+        dataset (pydicom.Dataset): dataset to work with
+        plan (AnonymizationPlan): anonymization plan
+
+    Returns:
+        List[dict]: private tags to restore (see `get_private_tag`)
+    """
+    private_tags = []
+    tag_index = plan.tag_index
+
+    present_tags = list(dataset.keys())
+    file_meta = getattr(dataset, "file_meta", None)
+    if file_meta is not None:
+        present_tags.extend(file_meta.keys())
+
+    # snapshot of tags is used, as actions are allowed to delete elements
+    for present_tag in present_tags:
+        rule = tag_index.get(present_tag)
+        if rule is None:
+            continue
+        tag, action = rule
+        action(dataset, tag)
+        # Get private tag to restore it later
+        if present_tag.is_private and present_tag in dataset:
+            private_tags.append(get_private_tag(dataset, tag))
+
+    walk_mask_index(dataset, plan)
+
+    return private_tags
+
+
+# "single_pass" is the default, "per_rule" is kept as a reference
+ENGINES = {
+    "single_pass": apply_rules_single_pass,
+    "per_rule": apply_rules_per_rule,
+}
+
+
+def anonymize_dataset(
+    dataset: pydicom.Dataset,
+    extra_anonymization_rules: Optional[ActionsDict] = None,
+    delete_private_tags: bool = True,
+    plan: Optional[AnonymizationPlan] = None,
+    engine: str = "single_pass",
+    profile: Optional[RuleProfile] = None,
+) -> None:
+    """Anonymize a pydicom Dataset by using anonymization rules which links an action to a tag
+
+    Args:
+        dataset (pydicom.Dataset): dicom dataset
+        extra_anonymization_rules (dict, optional): user-defined rules. Defaults to None.
+        delete_private_tags (bool, optional): if delete private tags. Defaults to True.
+        plan (Optional[AnonymizationPlan], optional): prebuilt anonymization plan (see `build_plan`),
+        mutually exclusive with `extra_anonymization_rules`. Defaults to None.
+        engine (str, optional): how rules are matched to the dataset, one of `ENGINES`:
+        "single_pass" - iterate dataset elements once and look rules up by tag,
+        "per_rule" - iterate rules and look each tag up in the dataset (reference).
+        Defaults to "single_pass".
+        profile (Optional[RuleProfile], optional): if set, hits and time spent per rule
+        are added to it (explain mode, slower). Defaults to None.
+
+    Raises:
+        Exception: will raise Exception if `dataset.get(tag)` fails
+    """
+    assert engine in ENGINES, f"Unknown engine: {engine}"
+    plan = resolve_plan(extra_anonymization_rules, plan)
+    if profile is not None:
+        plan = profile.instrument(plan)
+        profile.start_dataset()
+
+    # stage timings are recorded only if enabled, see `set_stage_metrics`
+    start = stage_start()
+    private_tags = ENGINES[engine](dataset, plan)
+    # UID replacements used by the dataset are made persistent before it is saved
+    _uid_mapper.flush()
+    observe_since("rules", start)
+
     # X - Private tags = (0xgggg, 0xeeee) where 0xgggg is odd
     if delete_private_tags:
+        start = stage_start()
         dataset.remove_private_tags()
 
         # Adding back private tags if specified in dictionary
@@ -530,3 +1251,4 @@ def anonymize_dataset(
                 block.add_new(
                     element["offset"], element["element"].VR, element["element"].value
                 )
+        observe_since("private_tags", start)
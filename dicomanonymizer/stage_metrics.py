@@ -0,0 +1,219 @@
+"""This module aggregates time spent in the anonymization stages into histograms
+and exports them as json and as a Prometheus textfile (see node_exporter textfile
+collector). Metrics are disabled by default, then every hook is one global lookup.
+Every process (the main one and every worker) aggregates and exports its own
+histograms, labeled "main" or "worker-<pid>".
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from .utils import Path_Str, to_Path
+
+# upper bounds of the histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+METRIC_NAME = "dicomanonymizer_stage_seconds"
+
+
+class Histogram:
+    """Counts of observations per bucket (see BUCKETS), their number and sum"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "sum": self.sum, "counts": list(self.counts)}
+
+
+class StageMetrics:
+    """Histograms of the stage timings of one process. Exported to `out_dir`
+    as stages-<label>.json and stages-<label>.prom on `export` and after
+    `export_interval` seconds since the previous export (checked on `observe`).
+
+    Args:
+        out_dir (Optional[Path_Str]): folder to export to, nothing is exported if None
+        export_interval (float): seconds between periodic exports, 0 disables them
+        label (str): name of the process in file names and in the "worker" label
+    """
+
+    def __init__(
+        self,
+        out_dir: Optional[Path_Str] = None,
+        export_interval: float = 60.0,
+        label: str = "main",
+    ):
+        self.out_dir = None if out_dir is None else to_Path(out_dir)
+        self.export_interval = export_interval
+        self.label = label
+        self.stages: Dict[str, Histogram] = {}
+        # stages might be observed by the I/O threads
+        self._lock = threading.Lock()
+        self._last_export = time.monotonic()
+
+    def settings(self) -> dict:
+        """Arguments to create the metrics of a worker process
+
+        Returns:
+            dict: `out_dir` and `export_interval`
+        """
+        return {"out_dir": self.out_dir, "export_interval": self.export_interval}
+
+    def observe(self, stage: str, seconds: float):
+        """Add an observation to the histogram of the stage
+
+        Args:
+            stage (str): name of the stage
+            seconds (float): time spent in the stage
+        """
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+        if (
+            self.export_interval > 0
+            and time.monotonic() - self._last_export >= self.export_interval
+        ):
+            self.export()
+
+    def to_dict(self) -> dict:
+        """Histograms as a json serializable dict
+
+        Returns:
+            dict: label, pid, bucket bounds and histograms per stage
+        """
+        with self._lock:
+            stages = {stage: h.to_dict() for stage, h in sorted(self.stages.items())}
+        return {
+            "label": self.label,
+            "pid": os.getpid(),
+            "buckets": list(BUCKETS),
+            "stages": stages,
+        }
+
+    def to_prometheus(self) -> str:
+        """Histograms in the Prometheus text exposition format
+
+        Returns:
+            str: text of the metric
+        """
+        lines = [
+            f"# HELP {METRIC_NAME} Time spent in the anonymization stages.",
+            f"# TYPE {METRIC_NAME} histogram",
+        ]
+        for stage, h in self.to_dict()["stages"].items():
+            labels = f'stage="{stage}",worker="{self.label}"'
+            cumulative = 0
+            for bound, count in zip(list(BUCKETS) + ["+Inf"], h["counts"]):
+                cumulative += count
+                lines.append(
+                    f'{METRIC_NAME}_bucket{{{labels},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f"{METRIC_NAME}_sum{{{labels}}} {h['sum']}")
+            lines.append(f"{METRIC_NAME}_count{{{labels}}} {h['count']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """Write the json and the Prometheus files to `out_dir` (if set). Files
+        are replaced atomically, so readers never see a partial file.
+        """
+        self._last_export = time.monotonic()
+        if self.out_dir is None:
+            return
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        stem = self.out_dir / f"stages-{self.label}"
+        _write_atomic(stem.with_suffix(".json"), json.dumps(self.to_dict()))
+        _write_atomic(stem.with_suffix(".prom"), self.to_prometheus())
+
+
+def _write_atomic(path: Path, text: str):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as fout:
+        fout.write(text)
+    os.replace(tmp_path, path)
+
+
+# disabled by default
+_metrics: Optional[StageMetrics] = None
+
+
+def set_stage_metrics(metrics: Optional[StageMetrics]) -> None:
+    """Enable (or disable with None) collection of the stage timings in this process
+
+    Args:
+        metrics (Optional[StageMetrics]): metrics to collect into
+    """
+    global _metrics
+    _metrics = metrics
+
+
+def get_stage_metrics() -> Optional[StageMetrics]:
+    """Get metrics of this process
+
+    Returns:
+        Optional[StageMetrics]: metrics or None if disabled
+    """
+    return _metrics
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Record time spent in the stage, if metrics are enabled
+
+    Args:
+        stage (str): name of the stage
+        seconds (float): time spent in the stage
+    """
+    if _metrics is not None:
+        _metrics.observe(stage, seconds)
+
+
+def stage_start() -> Optional[float]:
+    """Start of a stage to pass to `observe_since`, None if metrics are disabled,
+    so the clock is not even read
+
+    Returns:
+        Optional[float]: `time.perf_counter()` or None
+    """
+    if _metrics is None:
+        return None
+    return time.perf_counter()
+
+
+def observe_since(stage: str, start: Optional[float]) -> None:
+    """Record time spent in the stage since `start` (see `stage_start`)
+
+    Args:
+        stage (str): name of the stage
+        start (Optional[float]): start of the stage or None
+    """
+    if start is not None and _metrics is not None:
+        _metrics.observe(stage, time.perf_counter() - start)
@@ -0,0 +1,105 @@
+"""This module collects statistics of the tags seen in anonymized datasets.
+Tags are collected as ints, keywords are resolved only for reporting.
+"""
+from collections import Counter
+from dataclasses import dataclass
+from typing import List, Optional, Union
+
+import pydicom
+from pydicom.datadict import dictionary_VR, keyword_for_tag
+
+# private creators are counted by name, e.g. "PrivateCreator[SIEMENS CSA HEADER]"
+PRIVATE_CREATOR_KEY = "PrivateCreator[{}]"
+
+TagKey = Union[int, str]
+
+
+def _is_sequence(dataset: pydicom.Dataset, tag: int) -> bool:
+    # raw elements of implicit VR datasets have no VR
+    vr = dataset.get_item(tag).VR
+    if vr is None:
+        try:
+            vr = dictionary_VR(tag)
+        except KeyError:
+            return False
+    return vr == "SQ"
+
+
+@dataclass(frozen=True)
+class TagStats:
+    """Which tags of a dataset are counted: public tags of the top level dataset,
+    and optionally tags of the nested sequence items and private creators
+    (by name). Values of elements are not converted, except for sequences and
+    private creators, if those are counted.
+    """
+
+    nested: bool = False
+    private_creators: bool = False
+
+    def collect(self, dataset: pydicom.Dataset) -> List[TagKey]:
+        """Collect tags of the dataset
+
+        Args:
+            dataset (pydicom.Dataset): dataset
+
+        Returns:
+            List[TagKey]: tags as ints and private creators as PRIVATE_CREATOR_KEY strings
+        """
+        tags = []
+        self._collect(dataset, tags)
+        return tags
+
+    def _collect(self, dataset: pydicom.Dataset, tags: List[TagKey]):
+        for tag in dataset.keys():
+            if tag.is_private:
+                if self.private_creators and tag.is_private_creator:
+                    tags.append(PRIVATE_CREATOR_KEY.format(dataset[tag].value))
+                continue
+            tags.append(int(tag))
+            if self.nested and _is_sequence(dataset, tag):
+                for item in dataset[tag].value:
+                    self._collect(item, tags)
+
+
+def tag_stats(collect_tags: Union[bool, TagStats]) -> Optional[TagStats]:
+    """Options of tags collection: None if tags are not collected,
+    default TagStats for `collect_tags` == True
+
+    Args:
+        collect_tags (Union[bool, TagStats]): if (or which) tags to collect
+
+    Returns:
+        Optional[TagStats]: options or None
+    """
+    if isinstance(collect_tags, TagStats):
+        return collect_tags
+    return TagStats() if collect_tags else None
+
+
+def tag_name(tag: TagKey) -> str:
+    """Keyword of the tag, "(gggg,eeee)" if the tag is not in the dictionary
+
+    Args:
+        tag (TagKey): tag as int or private creator key
+
+    Returns:
+        str: name of the tag
+    """
+    if isinstance(tag, str):
+        return tag
+    return keyword_for_tag(tag) or f"({tag >> 16:04X},{tag & 0xFFFF:04X})"
+
+
+def tag_keywords(counter: Counter) -> Counter:
+    """Resolve names (see `tag_name`) of the collected tags
+
+    Args:
+        counter (Counter): counts of TagKey
+
+    Returns:
+        Counter: counts of names
+    """
+    names = Counter()
+    for tag, count in counter.items():
+        names[tag_name(tag)] += count
+    return names
@@ -0,0 +1,48 @@
+import pydicom
+import pytest
+from pydicom.encaps import encapsulate
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+
+def write_dicom_file(
+    path, pixel_bytes=b"", transfer_syntax=ExplicitVRLittleEndian, **elements
+):
+    """Write a small dicom file (explicit VR little endian by default), `elements` are
+    keyword -> value pairs to add to the default ones. With a compressed transfer
+    syntax `pixel_bytes` are encapsulated as one fragment (not really compressed)
+    """
+    file_meta = pydicom.dataset.FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = transfer_syntax
+    ds = pydicom.FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.PatientName = "Demyanchuk^Alexey"
+    ds.PatientID = "123456"
+    ds.StudyDate = "20170131"
+    ds.InstitutionName = "Uni Name"
+    for keyword, value in elements.items():
+        setattr(ds, keyword, value)
+    if pixel_bytes:
+        ds.Rows, ds.Columns = 1, len(pixel_bytes) // 2
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+        ds.SamplesPerPixel, ds.PixelRepresentation = 1, 0
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        if transfer_syntax.is_compressed:
+            ds.PixelData = encapsulate([pixel_bytes])
+            ds["PixelData"].VR = "OB"
+        else:
+            ds.PixelData = pixel_bytes
+            ds["PixelData"].VR = "OW"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ds.save_as(path)
+    return path
+
+
+@pytest.fixture
+def make_dicom_file(tmp_path):
+    def _make_dicom_file(rel_path, **kwargs):
+        return write_dicom_file(tmp_path / rel_path, **kwargs)
+
+    return _make_dicom_file
@@ -0,0 +1,77 @@
+import dataclasses
+import pickle
+
+import pydicom
+import pytest
+
+from dicomanonymizer import simpledicomanonymizer as smpd
+from dicomanonymizer.anonym_plan import AnonymizationPlan
+
+
+def make_dataset():
+    ds = pydicom.Dataset()
+    ds.add_new((0x0010, 0x0010), "PN", "Demyanchuk^Alexey")
+    ds.add_new((0x0008, 0x0080), "LO", "Uni Name")
+    ds.add_new((0x0008, 0x0012), "DA", "20170131")
+    ds.add_new((0x0008, 0x103E), "LO", "Series")
+    return ds
+
+
+def test_build_plan_extra_rules_override():
+    extra = {(0x0008, 0x0080): smpd.keep}
+    plan = smpd.build_plan(extra)
+    assert plan.actions[(0x0008, 0x0080)] is smpd.keep
+    assert len(plan) == len(smpd.initialize_actions())
+
+
+def test_plan_is_immutable():
+    plan = smpd.build_plan()
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        plan.rules = ()
+    with pytest.raises(TypeError):
+        plan.actions[(0x0008, 0x0080)] = smpd.keep
+
+
+def test_plan_is_picklable():
+    extra = {(0x0008, 0x103E): smpd.regexp({"find": "Ser", "replace": "X"})}
+    plan = smpd.build_plan(extra)
+    restored = pickle.loads(pickle.dumps(plan))
+    assert isinstance(restored, AnonymizationPlan)
+    assert [tag for tag, _ in restored.rules] == [tag for tag, _ in plan.rules]
+
+    ds = make_dataset()
+    smpd.anonymize_dataset(ds, plan=restored)
+    assert ds[0x0008, 0x103E].value == "Xies"
+
+
+def test_anonymize_with_plan_same_as_with_rules():
+    extra = {(0x0008, 0x103E): smpd.delete}
+    ds_rules, ds_plan = make_dataset(), make_dataset()
+    smpd.anonymize_dataset(ds_rules, extra)
+    smpd.anonymize_dataset(ds_plan, plan=smpd.build_plan(extra))
+    assert ds_rules == ds_plan
+    assert (0x0008, 0x103E) not in ds_plan
+
+
+def test_plan_and_rules_are_exclusive():
+    with pytest.raises(ValueError):
+        smpd.anonymize_dataset(make_dataset(), {}, plan=smpd.build_plan())
+
+
+def test_plan_fingerprint():
+    def regexp_plan(replace):
+        return smpd.build_plan(
+            {(0x0008, 0x103E): smpd.regexp({"find": "Ser", "replace": replace})}
+        )
+
+    assert regexp_plan("X").fingerprint == regexp_plan("X").fingerprint
+    assert regexp_plan("X").fingerprint != regexp_plan("Y").fingerprint
+    assert smpd.build_plan().fingerprint != regexp_plan("X").fingerprint
+
+
+@pytest.mark.parametrize(
+    "tag", [(0x5001, 0x0000, 0xFF00, 0x0000), (0x5000, 0x0010, 0xFF00, 0x0000)]
+)
+def test_repeating_rule_bits_outside_of_masks(tag):
+    with pytest.raises(ValueError):
+        smpd.build_plan({tag: smpd.delete})
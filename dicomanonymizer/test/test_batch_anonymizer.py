@@ -0,0 +1,663 @@
+import csv
+import json
+import os
+import tarfile
+import zipfile
+from collections import Counter
+from pathlib import Path
+
+import pydicom
+import pytest
+
+from dicomanonymizer import batch_anonymizer as batch
+from dicomanonymizer import simpledicomanonymizer as smpd
+from dicomanonymizer.fingerprint_index import run_fingerprint
+from dicomanonymizer.sharding import Shard
+
+# keep UIDs, so outputs of different processes can be compared byte by byte
+KEEP_UIDS = {(0x0002, 0x0003): smpd.keep, (0x0008, 0x0018): smpd.keep}
+
+REL_PATHS = ["a/1.dcm", "a/2.dcm", "b/c/3.dcm", "b/c/4.dcm", "b/5.dcm"]
+
+
+@pytest.fixture
+def state_path(tmp_path, monkeypatch):
+    path = tmp_path / "cache"
+    path.mkdir()
+    monkeypatch.setattr(batch, "_STATE_PATH", path)
+    return path
+
+
+@pytest.fixture
+def src_root(tmp_path, make_dicom_file):
+    for rel_path in REL_PATHS:
+        make_dicom_file(f"src/{rel_path}")
+    return tmp_path / "src"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_anonymize_root_folder(tmp_path, state_path, src_root, workers):
+    dst = tmp_path / f"dst_{workers}"
+    batch.anonymize_root_folder(
+        src_root, dst, workers=workers, plan=smpd.build_plan(KEEP_UIDS)
+    )
+    state = batch.AnonState(state_path)
+    state.init_state()
+    state.load_state()
+    assert set(state.visited_folders) == {"a", "b", "b/c"}
+    assert state.tag_counter["PatientName"] == len(REL_PATHS)
+    for rel_path in REL_PATHS:
+        assert (dst / rel_path).exists()
+
+
+def test_workers_output_same_as_serial(tmp_path, src_root):
+    plan = smpd.build_plan(KEEP_UIDS)
+    batch.anonymize_dicom_folder(src_root / "a", tmp_path / "serial", plan=plan)
+    batch.anonymize_dicom_folder(
+        src_root / "a", tmp_path / "parallel", workers=2, plan=plan
+    )
+    for name in ["1.dcm", "2.dcm"]:
+        serial = (tmp_path / "serial" / name).read_bytes()
+        assert serial == (tmp_path / "parallel" / name).read_bytes()
+
+
+@pytest.mark.parametrize("read_ahead,write_behind", [(1, 1), (3, 2)])
+def test_overlapped_io_same_as_serial(tmp_path, src_root, read_ahead, write_behind):
+    tasks = [(src_root / p, tmp_path / "serial" / p) for p in REL_PATHS]
+    overlapped_tasks = [(src_root / p, tmp_path / "overlapped" / p) for p in REL_PATHS]
+    for _, f_out in tasks + overlapped_tasks:
+        f_out.parent.mkdir(parents=True, exist_ok=True)
+    plan = smpd.build_plan(KEEP_UIDS)
+
+    list(batch.run_file_tasks(tasks, plan=plan))
+    results = list(
+        batch.run_file_tasks(
+            overlapped_tasks,
+            collect_tags=True,
+            io_threads=2,
+            read_ahead=read_ahead,
+            write_behind=write_behind,
+            plan=plan,
+        )
+    )
+
+    assert [f_in for f_in, _, _ in results] == [f_in for f_in, _ in tasks]
+    # (0010,0010) PatientName
+    assert all(0x00100010 in tags for _, _, tags in results)
+    for p in REL_PATHS:
+        serial = (tmp_path / "serial" / p).read_bytes()
+        assert serial == (tmp_path / "overlapped" / p).read_bytes()
+
+
+@pytest.mark.parametrize("budget_files,max_inflight", [(1.5, 1), (2.5, 2)])
+def test_overlapped_io_byte_budget(
+    tmp_path, src_root, monkeypatch, budget_files, max_inflight
+):
+    tasks = [(src_root / p, tmp_path / p) for p in REL_PATHS]
+    for _, f_out in tasks:
+        f_out.parent.mkdir(parents=True, exist_ok=True)
+    size = max(f_in.stat().st_size for f_in, _ in tasks)
+    # files read, but not yet written
+    inflight, peak = [0], [0]
+    read, write = batch.read_dicom_file, batch.write_dicom_file
+
+    def counting_read(*args):
+        inflight[0] += 1
+        peak[0] = max(peak[0], inflight[0])
+        return read(*args)
+
+    def counting_write(*args):
+        write(*args)
+        inflight[0] -= 1
+
+    monkeypatch.setattr(batch, "read_dicom_file", counting_read)
+    monkeypatch.setattr(batch, "write_dicom_file", counting_write)
+    results = list(
+        batch.run_file_tasks(
+            tasks,
+            io_threads=4,
+            write_threads=2,
+            max_inflight_bytes=int(budget_files * size),
+            plan=smpd.build_plan(KEEP_UIDS),
+        )
+    )
+    assert len(results) == len(tasks)
+    assert peak[0] == max_inflight
+    assert all(f_out.exists() for _, f_out in tasks)
+
+
+def test_workers_byte_budget(tmp_path, src_root):
+    # budget smaller than a file: files go one by one, but all of them
+    tasks = [(src_root / p, tmp_path / p) for p in REL_PATHS]
+    for _, f_out in tasks:
+        f_out.parent.mkdir(parents=True, exist_ok=True)
+    results = list(
+        batch.run_file_tasks(
+            tasks, workers=2, max_inflight_bytes=1, plan=smpd.build_plan(KEEP_UIDS)
+        )
+    )
+    assert sorted(f_in for f_in, _, _ in results) == sorted(f for f, _ in tasks)
+    assert all(f_out.exists() for _, f_out in tasks)
+
+
+@pytest.mark.parametrize("workers,io_threads", [(1, 0), (1, 2), (2, 0)])
+def test_tag_counter(tmp_path, src_root, workers, io_threads):
+    tasks = [(src_root / p, tmp_path / p.replace("/", "_")) for p in REL_PATHS]
+    tag_counter = Counter()
+    results = list(
+        batch.run_file_tasks(
+            tasks,
+            workers,
+            collect_tags=True,
+            io_threads=io_threads,
+            collect_results=True,
+            tag_counter=tag_counter,
+            plan=smpd.build_plan(KEEP_UIDS),
+        )
+    )
+    # tags are counted, not sent with every file
+    assert all(result.tags is None for _, _, result in results)
+    assert tag_counter[0x00100010] == len(REL_PATHS)
+
+
+def test_io_threads_need_one_worker(tmp_path, src_root):
+    tasks = [(src_root / "a/1.dcm", tmp_path / "1.dcm")]
+    with pytest.raises(ValueError):
+        list(batch.run_file_tasks(tasks, workers=2, io_threads=2))
+    assert not (tmp_path / "1.dcm").exists()
+
+
+def test_workers_keyed_uids_same_as_serial(tmp_path, src_root, monkeypatch):
+    monkeypatch.setattr(smpd, "_uid_mapper", smpd.KeyedUIDMapper(b"secret"))
+    batch.anonymize_dicom_folder(src_root / "a", tmp_path / "serial")
+    batch.anonymize_dicom_folder(src_root / "a", tmp_path / "parallel", workers=2)
+    for name in ["1.dcm", "2.dcm"]:
+        serial = (tmp_path / "serial" / name).read_bytes()
+        assert serial == (tmp_path / "parallel" / name).read_bytes()
+
+
+def test_workers_uid_store_same_as_serial(tmp_path, src_root, monkeypatch):
+    mapper = smpd.SQLiteUIDMapper(tmp_path / "uids.db")
+    monkeypatch.setattr(smpd, "_uid_mapper", mapper)
+    batch.anonymize_dicom_folder(src_root / "a", tmp_path / "serial")
+    batch.anonymize_dicom_folder(src_root / "a", tmp_path / "parallel", workers=2)
+    for name in ["1.dcm", "2.dcm"]:
+        serial = (tmp_path / "serial" / name).read_bytes()
+        assert serial == (tmp_path / "parallel" / name).read_bytes()
+
+
+def test_resume_skips_completed_files(tmp_path, state_path, src_root, monkeypatch):
+    anonymize_dicom_file = batch.anonymize_dicom_file
+    done = []
+
+    def fail_on_third(f_in, f_out, **kwargs):
+        if len(done) == 2:
+            raise RuntimeError("crash")
+        anonymize_dicom_file(f_in, f_out, **kwargs)
+        done.append(f_in.relative_to(src_root).as_posix())
+
+    monkeypatch.setattr(batch, "anonymize_dicom_file", fail_on_third)
+    with pytest.raises(RuntimeError):
+        batch.anonymize_root_folder(
+            src_root, tmp_path / "dst", plan=smpd.build_plan(KEEP_UIDS)
+        )
+
+    state = batch.AnonState(state_path)
+    state.init_state()
+    state.load_state()
+    assert all(state.is_file_done(rel_path) for rel_path in done)
+    # a torn record of a killed process is ignored
+    with open(state_path / state.jn_filename, "a") as fin:
+        fin.write('{"file": "b/')
+
+    resumed = []
+    monkeypatch.setattr(
+        batch,
+        "anonymize_dicom_file",
+        lambda f_in, f_out, **kwargs: resumed.append(
+            f_in.relative_to(src_root).as_posix()
+        ),
+    )
+    batch.anonymize_root_folder(src_root, tmp_path / "dst")
+    assert sorted(done + resumed) == sorted(REL_PATHS)
+
+
+def test_incremental_run_skips_unchanged(tmp_path, state_path, src_root, monkeypatch):
+    plan = smpd.build_plan(KEEP_UIDS)
+    db_path = tmp_path / "index.db"
+    dst = tmp_path / "dst"
+    index = batch.FingerprintIndex(db_path, plan.fingerprint)
+    batch.anonymize_root_folder(src_root, dst, plan=plan, index=index)
+    index.close()
+
+    read = []
+    dcmread = smpd.pydicom.dcmread
+    monkeypatch.setattr(
+        smpd.pydicom, "dcmread", lambda fp, **kw: read.append(fp) or dcmread(fp, **kw)
+    )
+    (dst / "a/1.dcm").unlink()
+    os.utime(src_root / "b/5.dcm", ns=(0, 0))
+    index = batch.FingerprintIndex(db_path, plan.fingerprint)
+    batch.anonymize_root_folder(src_root, dst, plan=plan, index=index)
+    index.close()
+    assert sorted(read) == [src_root / "a/1.dcm", src_root / "b/5.dcm"]
+
+    # other rules, all files are anonymized again
+    read.clear()
+    plan = smpd.build_plan({(0x0008, 0x103E): smpd.delete, **KEEP_UIDS})
+    index = batch.FingerprintIndex(db_path, plan.fingerprint, hash_content=True)
+    batch.anonymize_dicom_folder(src_root / "a", dst / "a", plan=plan, index=index)
+    index.close()
+    assert len(read) == 2
+
+
+@pytest.mark.parametrize("sniff_threads", [0, 2])
+@pytest.mark.parametrize("non_dicom", ["ignore", "copy"])
+def test_non_dicom_files(tmp_path, src_root, non_dicom, sniff_threads, monkeypatch):
+    (src_root / "a" / "report.pdf").write_bytes(b"%PDF-1.4\n")
+    (src_root / "a" / "DICOMDIR").write_bytes((src_root / "a/1.dcm").read_bytes())
+    monkeypatch.setattr(
+        batch.pydicom, "dcmread", lambda *args, **kwargs: pytest.fail("parsed")
+    )
+    tasks = batch.get_folder_tasks(
+        src_root / "a",
+        tmp_path / "dst",
+        non_dicom=non_dicom,
+        sniff_threads=sniff_threads,
+    )
+    assert sorted(f_in.name for f_in, _ in tasks) == ["1.dcm", "2.dcm"]
+    assert (tmp_path / "dst" / "report.pdf").exists() == (non_dicom == "copy")
+    assert not (tmp_path / "dst" / "DICOMDIR").exists()
+
+
+@pytest.mark.parametrize(
+    "name,content",
+    [
+        ("files.txt", "# comment\na/1.dcm\n\nb/c/3.dcm\n"),
+        ("files.csv", "source,output\na/1.dcm,x/1.dcm\nb/c/3.dcm,\n"),
+        (
+            "files.jsonl",
+            '{"source": "a/1.dcm", "output": "x/1.dcm"}\n{"source": "b/c/3.dcm"}\n',
+        ),
+    ],
+)
+def test_read_manifest(tmp_path, name, content):
+    (tmp_path / name).write_text(content)
+    tasks = list(batch.read_manifest(tmp_path / name, tmp_path / "dst"))
+    out_1 = "x/1.dcm" if "x/" in content else "a/1.dcm"
+    assert tasks == [
+        (tmp_path / "a/1.dcm", tmp_path / "dst" / out_1),
+        (tmp_path / "b/c/3.dcm", tmp_path / "dst/b/c/3.dcm"),
+    ]
+
+
+def test_anonymize_manifest(tmp_path, state_path, src_root):
+    manifest = src_root / "manifest.txt"
+    manifest.write_text("\n".join(REL_PATHS[:3]))
+    plan = smpd.build_plan(KEEP_UIDS)
+    batch.anonymize_manifest(manifest, tmp_path / "dst", plan=plan)
+    for rel_path in REL_PATHS:
+        assert (tmp_path / "dst" / rel_path).exists() == (rel_path in REL_PATHS[:3])
+
+    state = batch.AnonState(state_path)
+    state.init_state()
+    state.load_state()
+    assert state.tag_counter["PatientName"] == 3
+    assert state.manifest_done(str(manifest)) == 3
+    assert not state.completed_files
+
+
+def test_read_manifest_unsafe_output(tmp_path):
+    (tmp_path / "files.csv").write_text(
+        "a/1.dcm,/etc/1.dcm\na/2.dcm,../2.dcm\n../b/3.dcm,\na/4.dcm,x/../4.dcm\n"
+    )
+    tasks = list(batch.read_manifest(tmp_path / "files.csv", tmp_path / "dst"))
+    # only the source outside of the manifest folder, output is its absolute path
+    source = tmp_path.parent / "b/3.dcm"
+    assert tasks == [(source, tmp_path / "dst" / source.relative_to("/"))]
+
+
+def test_anonymize_manifest_resume(tmp_path, state_path, src_root, monkeypatch):
+    manifest = src_root / "manifest.txt"
+    manifest.write_text("\n".join(REL_PATHS))
+    anonymize_dicom_file = batch.anonymize_dicom_file
+    calls = []
+
+    def fail_once_on_third(f_in, *args, **kwargs):
+        calls.append(f_in)
+        if calls == [src_root / rel_path for rel_path in REL_PATHS[:3]]:
+            raise RuntimeError("interrupted")
+        return anonymize_dicom_file(f_in, *args, **kwargs)
+
+    monkeypatch.setattr(batch, "anonymize_dicom_file", fail_once_on_third)
+    # relative manifest path, the progress is keyed by the absolute one
+    monkeypatch.chdir(src_root)
+    plan = smpd.build_plan(KEEP_UIDS)
+    with pytest.raises(RuntimeError):
+        batch.anonymize_manifest("manifest.txt", tmp_path / "dst", plan=plan)
+    calls.clear()
+    batch.anonymize_manifest("manifest.txt", tmp_path / "dst", plan=plan)
+    assert calls == [src_root / rel_path for rel_path in REL_PATHS[2:]]
+
+    state = batch.AnonState(state_path)
+    state.init_state()
+    state.load_state()
+    assert state.manifest_progress == {str(manifest): len(REL_PATHS)}
+
+
+def test_incremental_manifest_missing_file(tmp_path, state_path, src_root):
+    manifest = src_root / "manifest.txt"
+    manifest.write_text("\n".join(["a/missing.dcm"] + REL_PATHS[:2]))
+    plan = smpd.build_plan(KEEP_UIDS)
+    index = batch.FingerprintIndex(tmp_path / "index.db", plan.fingerprint)
+    with batch.ResultManifestWriter(tmp_path / "results.jsonl") as results:
+        batch.anonymize_manifest(
+            manifest, tmp_path / "dst", plan=plan, index=index, results=results
+        )
+    index.close()
+    records = [
+        json.loads(r) for r in (tmp_path / "results.jsonl").read_text().splitlines()
+    ]
+    errors = {Path(r["source"]).name: r["error"] for r in records if r["error"]}
+    assert errors == {"missing.dcm": "FileNotFoundError"}
+    assert (tmp_path / "dst" / REL_PATHS[1]).exists()
+
+
+def test_run_fingerprint():
+    plan = smpd.build_plan(KEEP_UIDS)
+    fingerprint = run_fingerprint(plan.fingerprint, uid_root="2.25")
+    assert fingerprint == run_fingerprint(plan.fingerprint, uid_root="2.25")
+    assert fingerprint != run_fingerprint(plan.fingerprint, uid_root="1.2")
+    assert fingerprint != run_fingerprint(plan.fingerprint)
+
+
+def test_shard_parse():
+    shard = Shard.parse("1/4", "study")
+    assert (shard.index, shard.count, shard.by, shard.name) == (1, 4, "study", "1-of-4")
+    for spec in ["4/4", "-1/4", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            Shard.parse(spec)
+
+
+def test_shards_cover_all_files(tmp_path, state_path, src_root):
+    plan = smpd.build_plan(KEEP_UIDS)
+    for k in range(3):
+        batch.anonymize_root_folder(
+            src_root, tmp_path / "dst", plan=plan, shard=Shard(k, 3)
+        )
+    for rel_path in REL_PATHS:
+        assert (tmp_path / "dst" / rel_path).exists()
+    assert len(list((state_path / "shards").iterdir())) == 3
+
+    for _ in range(2):
+        # merged again from the shards, counts are not doubled
+        state = batch.merge_shard_states()
+        assert state.state_path == state_path / "merged"
+        assert set(state.visited_folders) == {"a", "b", "b/c"}
+        assert state.tag_counter["PatientName"] == len(REL_PATHS)
+
+
+def test_shards_by_study(tmp_path, state_path, make_dicom_file):
+    # studies are spread across folders
+    for i, rel_path in enumerate(REL_PATHS):
+        make_dicom_file(f"src/{rel_path}", StudyInstanceUID=f"1.2.3.{i % 2}")
+    # keep study UIDs too, random replacements would change the seeded sequence
+    plan = smpd.build_plan({**KEEP_UIDS, (0x0020, 0x000D): smpd.keep})
+    studies = []
+    for k in range(2):
+        shard = Shard(k, 2, "study")
+        batch.anonymize_root_folder(
+            tmp_path / "src",
+            tmp_path / "dst",
+            plan=plan,
+            shard=shard,
+        )
+        state = batch._load_state(shard)
+        # folders might be shared with the other shard
+        assert not state.visited_folders
+        studies.append({REL_PATHS.index(f) % 2 for f in state.completed_files})
+    assert studies[0].isdisjoint(studies[1])
+    assert studies[0] | studies[1] == {0, 1}
+
+    state = batch.merge_shard_states(
+        [state_path / "shards" / f"{k}-of-2" for k in range(2)], tmp_path / "merged"
+    )
+    assert state.completed_files == set(REL_PATHS)
+    assert state.tag_counter["StudyInstanceUID"] == len(REL_PATHS)
+
+
+def test_shards_of_one_folder(tmp_path, state_path, make_dicom_file):
+    names = [f"{i}.dcm" for i in range(8)]
+    for name in names:
+        make_dicom_file(f"src/{name}")
+    (tmp_path / "manifest.txt").write_text("\n".join(f"src/{name}" for name in names))
+    plan = smpd.build_plan(KEEP_UIDS)
+    folder_shards, manifest_shards = [], []
+    for k in range(2):
+        dst = tmp_path / f"folder_{k}"
+        batch.anonymize_dicom_folder(
+            tmp_path / "src", dst, plan=plan, shard=Shard(k, 2)
+        )
+        folder_shards.append({p.name for p in dst.iterdir()})
+        dst = tmp_path / f"manifest_{k}"
+        batch.anonymize_manifest(
+            tmp_path / "manifest.txt", dst, plan=plan, shard=Shard(k, 2)
+        )
+        manifest_shards.append({p.name for p in (dst / "src").iterdir()})
+    # files of one folder are spread across the shards, not all in one
+    for shards in (folder_shards, manifest_shards):
+        assert all(shards)
+        assert shards[0].isdisjoint(shards[1])
+        assert shards[0] | shards[1] == set(names)
+
+
+@pytest.mark.parametrize(
+    "workers,io_threads,suffix", [(1, 0, "jsonl"), (2, 0, "jsonl"), (1, 2, "csv")]
+)
+def test_result_manifest(
+    tmp_path, state_path, src_root, monkeypatch, workers, io_threads, suffix
+):
+    monkeypatch.setattr(smpd, "_uid_mapper", smpd.KeyedUIDMapper(b"secret"))
+    (src_root / "a" / "3.pdf").write_bytes(b"%PDF-1.4\n")
+    manifest = src_root / "manifest.txt"
+    manifest.write_text("a/1.dcm\na/2.dcm\na/3.pdf\n")
+    path = tmp_path / f"results.{suffix}"
+    with batch.ResultManifestWriter(path) as results:
+        batch.anonymize_manifest(
+            manifest,
+            tmp_path / "dst",
+            workers=workers,
+            io_threads=io_threads,
+            results=results,
+        )
+
+    if suffix == "csv":
+        with open(path, newline="") as fin:
+            records = list(csv.DictReader(fin))
+    else:
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+    records = {Path(r["source"]).name: r for r in records}
+    assert sorted(records) == ["1.dcm", "2.dcm", "3.pdf"]
+    assert records["3.pdf"]["status"] == "skipped"
+    ok = records["1.dcm"]
+    assert ok["status"] == "ok"
+    assert int(ok["bytes_out"]) == (tmp_path / "dst/a/1.dcm").stat().st_size
+    uids = json.loads(ok["uids"]) if suffix == "csv" else ok["uids"]
+    new_uid = pydicom.dcmread(tmp_path / "dst/a/1.dcm").SOPInstanceUID
+    assert new_uid in uids.values()
+
+
+def test_result_manifest_error_does_not_stop_run(tmp_path, src_root, monkeypatch):
+    def fail(f_in, f_out, **kwargs):
+        raise RuntimeError("crash")
+
+    monkeypatch.setattr(batch, "anonymize_dicom_file", fail)
+    index = batch.FingerprintIndex(tmp_path / "index.db", "plan")
+    with batch.ResultManifestWriter(tmp_path / "results.jsonl") as results:
+        batch.anonymize_dicom_folder(
+            src_root / "a", tmp_path / "dst", results=results, index=index
+        )
+    records = (tmp_path / "results.jsonl").read_text().splitlines()
+    assert [json.loads(r)["error"] for r in records] == ["RuntimeError"] * 2
+    # fingerprints of the failed files are not kept
+    assert not index._pending
+    index.close()
+
+
+def make_tar(path, src_root, names):
+    with tarfile.open(path, "w") as archive:
+        for name in names:
+            archive.add(src_root / name, arcname=name)
+    return path
+
+
+def read_members(path):
+    if str(path).endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+    with tarfile.open(path) as archive:
+        return {m.name: archive.extractfile(m).read() for m in archive if m.isfile()}
+
+
+@pytest.mark.parametrize(
+    "workers,suffix", [(1, ".tar"), (1, ".tar.gz"), (1, ".zip"), (2, ".tar.xz")]
+)
+def test_anonymize_archive(tmp_path, state_path, src_root, workers, suffix):
+    plan = smpd.build_plan(KEEP_UIDS)
+    batch.anonymize_root_folder(src_root, tmp_path / "serial", plan=plan)
+    src = make_tar(tmp_path / "src.tar", src_root, REL_PATHS)
+    dst = tmp_path / f"dst{suffix}"
+    batch.anonymize_archive(src, dst, workers=workers, plan=plan)
+
+    assert not dst.with_name(dst.name + ".part").exists()
+    members = read_members(dst)
+    assert sorted(members) == sorted(REL_PATHS)
+    for name, data in members.items():
+        assert data == (tmp_path / "serial" / name).read_bytes()
+
+
+def test_anonymize_archive_to_folder(tmp_path, state_path, src_root):
+    (src_root / "a" / "3.pdf").write_bytes(b"%PDF-1.4\n")
+    src = tmp_path / "src.tgz"
+    with tarfile.open(src, "w:gz") as archive:
+        for name in REL_PATHS + ["a/3.pdf"]:
+            archive.add(src_root / name, name)
+        archive.add(src_root / "a/1.dcm", "../1.dcm")
+        archive.add(src_root / "a/1.dcm", "DICOMDIR")
+    batch.anonymize_archive(
+        src, tmp_path / "dst", plan=smpd.build_plan(KEEP_UIDS), non_dicom="copy"
+    )
+    for name in REL_PATHS:
+        ds = pydicom.dcmread(tmp_path / "dst" / name)
+        assert ds.PatientName == ""
+    assert (tmp_path / "dst/a/3.pdf").read_bytes() == b"%PDF-1.4\n"
+    # members can't be written outside of dst
+    assert not (tmp_path / "1.dcm").exists()
+    # DICOMDIR holds patient data, it is never copied
+    assert not (tmp_path / "dst/DICOMDIR").exists()
+
+
+@pytest.mark.parametrize(
+    "transfer_syntax",
+    [pydicom.uid.JPEGBaseline8Bit, pydicom.uid.DeflatedExplicitVRLittleEndian],
+)
+def test_anonymize_archive_encapsulated_and_deflated(
+    tmp_path, state_path, make_dicom_file, transfer_syntax
+):
+    pixels = bytes(range(256)) * 64
+    make_dicom_file("src/1.dcm", pixel_bytes=pixels, transfer_syntax=transfer_syntax)
+    plan = smpd.build_plan(KEEP_UIDS)
+    smpd.anonymize_dicom_file(tmp_path / "src/1.dcm", tmp_path / "1.dcm", plan=plan)
+    src = make_tar(tmp_path / "src.tar", tmp_path / "src", ["1.dcm"])
+    # members are read with views into their data, pixel data should stay intact
+    batch.anonymize_archive(src, tmp_path / "dst.tar", plan=plan)
+    data = read_members(tmp_path / "dst.tar")["1.dcm"]
+    assert data == (tmp_path / "1.dcm").read_bytes()
+    expected = pydicom.dcmread(tmp_path / "src/1.dcm").PixelData
+    assert pydicom.dcmread(tmp_path / "1.dcm").PixelData == expected
+
+
+def test_anonymize_archive_resume(tmp_path, state_path, src_root, monkeypatch):
+    plan = smpd.build_plan(KEEP_UIDS)
+    src = make_tar(tmp_path / "src.tar", src_root, REL_PATHS)
+    dst = tmp_path / "dst.tar.gz"
+    anonymized = []
+    anonymize_bytes = smpd.anonymize_bytes
+
+    def crash_on_third(data, **kwargs):
+        if len(anonymized) == 2:
+            raise RuntimeError("crash")
+        anonymized.append(data)
+        return anonymize_bytes(data, **kwargs)
+
+    monkeypatch.setattr(batch, "anonymize_bytes", crash_on_third)
+    with pytest.raises(RuntimeError):
+        batch.anonymize_archive(src, dst, plan=plan)
+    assert not dst.exists()
+    assert sorted(read_members(dst.with_name("dst.tar.gz.part"))) == REL_PATHS[:2]
+
+    monkeypatch.setattr(batch, "anonymize_bytes", anonymize_bytes)
+    batch.anonymize_archive(src, dst, plan=plan)
+    assert sorted(read_members(dst)) == sorted(REL_PATHS)
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "cache",
+        "dst.tar.gz",
+        "src",
+        "src.tar",
+    ]
+
+
+def test_anonymize_archive_state_per_archive(
+    tmp_path, state_path, src_root, monkeypatch
+):
+    plan = smpd.build_plan(KEEP_UIDS)
+    # folder run and archives with the same relative paths
+    batch.anonymize_root_folder(src_root, tmp_path / "dst_root", plan=plan)
+    first = make_tar(tmp_path / "first.tar", src_root, REL_PATHS)
+    second = make_tar(tmp_path / "second.tar", src_root, REL_PATHS)
+    batch.anonymize_archive(first, tmp_path / "first", plan=plan)
+    batch.anonymize_archive(second, tmp_path / "second.zip", plan=plan)
+    for name in REL_PATHS:
+        assert (tmp_path / "first" / name).exists()
+    assert sorted(read_members(tmp_path / "second.zip")) == sorted(REL_PATHS)
+    assert len(list((state_path / "archives").iterdir())) == 2
+
+    # completed members are skipped on resume for both destination types
+    def fail(data, **kwargs):
+        raise RuntimeError("anonymized again")
+
+    monkeypatch.setattr(batch, "anonymize_bytes", fail)
+    (tmp_path / "first" / REL_PATHS[0]).unlink()
+    batch.anonymize_archive(first, tmp_path / "first", plan=plan)
+    assert not (tmp_path / "first" / REL_PATHS[0]).exists()
+    before = read_members(tmp_path / "second.zip")
+    batch.anonymize_archive(second, tmp_path / "second.zip", plan=plan)
+    assert read_members(tmp_path / "second.zip") == before
+
+
+def test_workers_share_random_uids(tmp_path, make_dicom_file, monkeypatch):
+    monkeypatch.setattr(smpd, "_uid_mapper", smpd.RandomUIDMapper())
+    monkeypatch.setattr(batch, "_run_uid_mapper", None)
+    study_uid = pydicom.uid.generate_uid()
+    for i in range(8):
+        make_dicom_file(f"src/{i}.dcm", StudyInstanceUID=study_uid)
+    batch.anonymize_dicom_folder(tmp_path / "src", tmp_path / "dst", workers=4)
+    study_uids = {
+        pydicom.dcmread(path).StudyInstanceUID for path in (tmp_path / "dst").iterdir()
+    }
+    assert len(study_uids) == 1
+    assert study_uid not in study_uids
+
+
+def test_sniff_files_in_order(tmp_path, make_dicom_file):
+    (tmp_path / "src").mkdir()
+    paths = []
+    for i in range(20):
+        if i % 3:
+            paths.append(make_dicom_file(f"src/{i}.dcm"))
+        else:
+            paths.append(tmp_path / f"src/{i}.txt")
+            paths[-1].write_text("not a dicom file")
+    expected = [(p, p.suffix == ".dcm") for p in paths]
+    assert list(batch.sniff_files(paths)) == expected
+    assert list(batch.sniff_files(paths, sniff_threads=3)) == expected
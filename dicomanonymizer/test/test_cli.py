@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from dicomanonymizer.cli import build_merge_parser, build_parser
+from dicomanonymizer.utils import PROJ_ROOT
+
+
+def run_python(code, home):
+    env = dict(os.environ, HOME=str(home), PYTHONPATH=str(PROJ_ROOT))
+    return subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True
+    )
+
+
+def test_help_does_not_import_pydicom(tmp_path):
+    code = (
+        "import sys\n"
+        "from dicomanonymizer.cli import main\n"
+        "sys.argv = ['dicom-anonymizer', '--help']\n"
+        "try:\n"
+        "    main()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print('pydicom' in sys.modules, 'tqdm' in sys.modules)\n"
+    )
+    result = run_python(code, tmp_path)
+    assert "usage:" in result.stdout
+    assert result.stdout.rstrip().endswith("False False")
+
+
+@pytest.mark.parametrize(
+    "module", ["dicomanonymizer", "dicomanonymizer.batch_anonymizer"]
+)
+def test_import_has_no_side_effects(tmp_path, module):
+    result = run_python(f"import {module}", tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert os.listdir(tmp_path) == []
+
+
+def test_lazy_package_api():
+    import dicomanonymizer
+
+    assert dicomanonymizer.anonymize_dataset is not None
+    assert "anonymize" in dicomanonymizer.__all__
+    with pytest.raises(AttributeError):
+        dicomanonymizer.no_such_function
+
+
+def test_parser_defaults():
+    args = build_parser().parse_args(["src", "dst"])
+    assert args.type == "batch"
+    assert args.read_ahead == 8
+    assert args.uid_root == "2.25"
+
+
+def test_shard_args():
+    args = build_parser().parse_args(["--shard", "1/4", "src", "dst"])
+    assert (args.shard, args.shard_by) == ("1/4", "path")
+    args = build_merge_parser().parse_args(["--out", "merged", "s0", "s1"])
+    assert (args.out, args.shards) == ("merged", ["s0", "s1"])
+
+
+@pytest.mark.parametrize(
+    "option", [["--io-threads", "2"], ["--mmap"], ["--pixel-passthrough"]]
+)
+def test_archive_rejects_file_options(tmp_path, option):
+    argv = ["--type", "archive", *option, "src.tar", "dst.tar"]
+    result = run_python(
+        f"from dicomanonymizer.cli import main\nmain({argv!r})", tmp_path
+    )
+    assert result.returncode == 2
+    assert "can't be used with --type archive" in result.stderr
@@ -0,0 +1,137 @@
+import io
+import os
+
+import pydicom
+import pytest
+from pydicom.encaps import encapsulate
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element
+from pydicom.uid import DeflatedExplicitVRLittleEndian, JPEGBaseline8Bit
+
+from dicomanonymizer import dicom_utils
+
+
+def encode_element(element, is_implicit_VR, is_little_endian):
+    fp = DicomBytesIO()
+    fp.is_implicit_VR = is_implicit_VR
+    fp.is_little_endian = is_little_endian
+    write_data_element(fp, element)
+    return fp.getvalue()
+
+
+@pytest.mark.parametrize(
+    "is_implicit_VR,is_little_endian", [(True, True), (False, True), (False, False)]
+)
+def test_get_element_end(is_implicit_VR, is_little_endian):
+    element = pydicom.DataElement(0x7FE00010, "OW", b"\x01\x02" * 10)
+    encoded = encode_element(element, is_implicit_VR, is_little_endian)
+    fp = io.BytesIO(b"\x00" * 6 + encoded + b"\x00" * 4)
+    end = dicom_utils.get_element_end(fp, 6, is_implicit_VR, is_little_endian)
+    assert end == 6 + len(encoded)
+
+
+def test_get_element_end_encapsulated():
+    element = pydicom.DataElement(
+        0x7FE00010, "OB", encapsulate([b"\x01" * 10, b"\x02" * 20])
+    )
+    element.is_undefined_length = True
+    encoded = encode_element(element, False, True)
+    fp = io.BytesIO(encoded)
+    assert dicom_utils.get_element_end(fp, 0, False, True) == len(encoded)
+    # truncated file
+    fp = io.BytesIO(encoded[:-8])
+    assert dicom_utils.get_element_end(fp, 0, False, True) is None
+
+
+@pytest.mark.parametrize("zero_copy", [True, False])
+def test_append_file_range(tmp_path, monkeypatch, zero_copy):
+    if not zero_copy:
+        monkeypatch.delattr(os, "copy_file_range", raising=False)
+        monkeypatch.delattr(os, "sendfile", raising=False)
+    src_path = tmp_path / "src"
+    src_path.write_bytes(bytes(range(256)) * 100)
+    with open(src_path, "rb") as src, open(tmp_path / "dst", "wb") as dst:
+        dst.write(b"header")
+        dicom_utils.append_file_range(src, dst, 100, 20000)
+    assert (tmp_path / "dst").read_bytes() == b"header" + src_path.read_bytes()[
+        100:20100
+    ]
+
+
+@pytest.mark.skipif(not dicom_utils._DEFERRED_BUFFER_READS, reason="needs pydicom >= 3")
+def test_dcmread_mmap_keeps_views(make_dicom_file):
+    pixel_bytes = bytes(range(256)) * 8
+    path = make_dicom_file("a.dcm", pixel_bytes=pixel_bytes)
+    ds = dicom_utils.dcmread_mmap(dicom_utils.open_mmap(path), view_min_size=1024)
+    assert isinstance(ds.PixelData, memoryview)
+    assert bytes(ds.PixelData) == pixel_bytes
+    assert ds.PatientName == "Demyanchuk^Alexey"
+
+
+def test_open_mmap_empty_file(tmp_path):
+    (tmp_path / "empty").write_bytes(b"")
+    with pytest.raises(pydicom.errors.InvalidDicomError):
+        dicom_utils.open_mmap(tmp_path / "empty")
+
+
+@pytest.mark.parametrize("implicit_vr", [True, False])
+def test_sniff_dicom(tmp_path, make_dicom_file, implicit_vr):
+    assert dicom_utils.sniff_dicom(make_dicom_file("a.dcm")) == dicom_utils.SNIFF_PART10
+
+    ds = pydicom.Dataset()
+    ds.SOPInstanceUID = "1.2.3"
+    ds.PatientName = "Demyanchuk^Alexey"
+    ds.save_as(tmp_path / "raw", implicit_vr=implicit_vr, little_endian=True)
+    assert dicom_utils.sniff_dicom(tmp_path / "raw") == dicom_utils.SNIFF_RAW
+
+    for name, content in [
+        ("thumb.jpg", b"\xff\xd8\xff\xe0\x00\x10JFIF" + b"\0" * 200),
+        ("report.pdf", b"%PDF-1.4\n" + b"\0" * 200),
+        ("notes.txt", b"hi"),
+        ("empty", b""),
+        ("DICOMDIR", (tmp_path / "a.dcm").read_bytes()),
+    ]:
+        (tmp_path / name).write_bytes(content)
+        assert dicom_utils.sniff_dicom(tmp_path / name) is None
+
+
+@pytest.mark.skipif(not dicom_utils._DEFERRED_BUFFER_READS, reason="needs pydicom >= 3")
+def test_dcmread_buffer_keeps_views(make_dicom_file):
+    pixel_bytes = bytes(range(256)) * 8
+    data = make_dicom_file("a.dcm", pixel_bytes=pixel_bytes).read_bytes()
+    ds = dicom_utils.dcmread_buffer(data, view_min_size=1024)
+    assert isinstance(ds.PixelData, memoryview)
+    assert ds.PixelData.obj is data
+    assert bytes(ds.PixelData) == pixel_bytes
+    assert ds.PatientName == "Demyanchuk^Alexey"
+
+
+def test_memory_reader():
+    reader = dicom_utils.MemoryReader(memoryview(b"0123456789")[2:])
+    assert reader.read(3) == b"234"
+    assert reader.seek(-2, io.SEEK_END) == 6
+    assert reader.read() == b"89"
+    assert reader.read(1) == b""
+
+
+@pytest.mark.parametrize("reader", ["mmap", "buffer"])
+@pytest.mark.parametrize(
+    "transfer_syntax", [JPEGBaseline8Bit, DeflatedExplicitVRLittleEndian]
+)
+def test_dcmread_views_encapsulated_and_deflated(
+    make_dicom_file, reader, transfer_syntax
+):
+    pixel_bytes = bytes(range(256)) * 8
+    path = make_dicom_file(
+        "a.dcm", pixel_bytes=pixel_bytes, transfer_syntax=transfer_syntax
+    )
+    expected = pydicom.dcmread(path).PixelData
+    if reader == "mmap":
+        ds = dicom_utils.dcmread_mmap(dicom_utils.open_mmap(path), view_min_size=1024)
+    else:
+        ds = dicom_utils.dcmread_buffer(path.read_bytes(), view_min_size=1024)
+    assert ds.PixelData == expected
+    # and it can be written back
+    out = io.BytesIO()
+    ds.save_as(out)
+    assert pydicom.dcmread(io.BytesIO(out.getvalue())).PixelData == expected
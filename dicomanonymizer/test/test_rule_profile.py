@@ -0,0 +1,76 @@
+import pydicom
+import pytest
+
+from dicomanonymizer import simpledicomanonymizer as smpd
+from dicomanonymizer.anonym_plan import AnonymizationPlan
+from dicomanonymizer.rule_profile import RuleProfile, rule_name
+
+CURVE_DATA = (0x5000, 0x0000, 0xFF00, 0x0000)
+
+PLAN = AnonymizationPlan.from_actions(
+    {
+        (0x0010, 0x0010): smpd.empty,
+        ("0x0010", "0x0020"): smpd.empty,
+        (0x0010, 0x1000): smpd.delete,
+        CURVE_DATA: smpd.delete,
+    }
+)
+
+
+def make_dataset(with_id=True):
+    ds = pydicom.Dataset()
+    ds.PatientName = "Demyanchuk^Alexey"
+    if with_id:
+        ds.PatientID = "123456"
+    ds.add_new(0x50000010, "US", 1)
+    ds.add_new(0x50020010, "US", 1)
+    return ds
+
+
+@pytest.mark.parametrize("engine", ["single_pass", "per_rule"])
+def test_rule_counters(engine):
+    profile = RuleProfile()
+    for with_id in [True, False]:
+        smpd.anonymize_dataset(
+            make_dataset(with_id), plan=PLAN, engine=engine, profile=profile
+        )
+    assert profile.datasets == 2
+    assert profile.stats[(0x0010, 0x0010)].hits == 2
+    assert profile.stats[("0x0010", "0x0020")].hits == 1
+    assert profile.stats[("0x0010", "0x0020")].datasets == 1
+    assert profile.stats[CURVE_DATA].hits == 4
+    assert profile.stats[CURVE_DATA].datasets == 2
+    assert profile.unused_rules() == [(0x0010, 0x1000)]
+
+
+@pytest.mark.parametrize("engine", ["single_pass", "per_rule"])
+def test_file_meta_hits(engine):
+    plan = AnonymizationPlan.from_actions({(0x0002, 0x0003): smpd.delete})
+    profile = RuleProfile()
+    ds = make_dataset()
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.MediaStorageSOPInstanceUID = "1.2.3.4"
+    smpd.anonymize_dataset(ds, plan=plan, engine=engine, profile=profile)
+    assert (0x0002, 0x0003) not in ds.file_meta
+    assert profile.stats[(0x0002, 0x0003)].hits == 1
+    assert profile.unused_rules() == []
+
+
+def test_plan_is_instrumented_once():
+    profile = RuleProfile()
+    assert profile.instrument(PLAN) is profile.instrument(PLAN)
+
+
+def test_report():
+    profile = RuleProfile()
+    ds = make_dataset()
+    smpd.anonymize_dataset(ds, plan=PLAN, profile=profile)
+    # rules are applied as without the profile
+    assert ds.PatientName == ""
+    assert 0x50000010 not in ds
+    report = profile.report()
+    assert "Profiled datasets: 1" in report
+    assert report.endswith(
+        "Rules never matched (1):\n  (0010,1000) OtherPatientIDs delete"
+    )
+    assert rule_name(CURVE_DATA) == "(5000,0000)&(FF00,0000)"
@@ -1,3 +1,4 @@
+import io
 import random
 
 import pydicom
@@ -73,3 +74,240 @@ def test_replace_element_value_types(make_elem, vr):
     type_pre = type(elem.value)
     smpd.replace_element(elem)
     assert isinstance(elem.value, type_pre)
+
+
+def make_engine_dataset():
+    ds = pydicom.Dataset()
+    ds.file_meta = pydicom.dataset.FileMetaDataset()
+    ds.file_meta.add_new((0x0002, 0x0016), "AE", "SOURCE_AE")
+    for values in dcm_elements.values():
+        ds.add_new(values["tag"], values["VR"], values["value"])
+    seq_item = pydicom.Dataset()
+    seq_item.add_new((0x0008, 0x1155), "UI", "1.2.3.4")
+    ds.add_new((0x0008, 0x1140), "SQ", pydicom.Sequence([seq_item]))
+    block = ds.private_block(0x0009, "Vendor", create=True)
+    block.add_new(0x01, "LO", "private")
+    return ds
+
+
+@pytest.mark.parametrize("delete_private_tags", [True, False])
+def test_engines_give_same_result(delete_private_tags):
+    extra = {
+        (0x0002, 0x0016): smpd.delete,
+        ("0x0009", "0x1001"): smpd.keep,
+    }
+    plan = smpd.build_plan(extra)
+    results = {}
+    for engine in smpd.ENGINES:
+        ds = make_engine_dataset()
+        smpd.anonymize_dataset(
+            ds, delete_private_tags=delete_private_tags, plan=plan, engine=engine
+        )
+        results[engine] = ds
+    reference = results["per_rule"]
+    assert (0x0002, 0x0016) not in reference.file_meta
+    assert reference[0x0009, 0x1001].value == "private"
+    for ds in results.values():
+        assert ds == reference
+        assert ds.file_meta == reference.file_meta
+
+
+def test_repeating_groups_single_traversal():
+    ds = pydicom.Dataset()
+    ds.add_new((0x6000, 0x4000), "LT", "overlay comment")
+    ds.add_new((0x6002, 0x4000), "LT", "another overlay comment")
+    ds.add_new((0x5004, 0x0010), "US", 1)
+    ds.add_new((0x6000, 0x0010), "US", 512)
+    seq_item = pydicom.Dataset()
+    seq_item.add_new((0x6004, 0x3000), "OW", b"\x00\x01")
+    ds.add_new((0x0028, 0x3000), "SQ", pydicom.Sequence([seq_item]))
+
+    results = {}
+    for engine in smpd.ENGINES:
+        engine_ds = pydicom.Dataset(ds)
+        engine_ds[0x0028, 0x3000].value = pydicom.Sequence([pydicom.Dataset(seq_item)])
+        smpd.anonymize_dataset(engine_ds, engine=engine)
+        results[engine] = engine_ds
+
+    for result in results.values():
+        assert (0x6000, 0x4000) not in result
+        assert (0x6002, 0x4000) not in result
+        assert (0x5004, 0x0010) not in result
+        assert (0x6004, 0x3000) not in result[0x0028, 0x3000].value[0]
+        # overlay rows are not matched by the overlay rules
+        assert result[0x6000, 0x0010].value == 512
+        assert result == results["per_rule"]
+
+
+def test_plan_mask_index_groups_rules():
+    plan = smpd.build_plan({("0x6000", "0x2000", "0xFF00", "0xFFFF"): smpd.delete})
+    masks = {
+        (group_mask, element_mask) for group_mask, element_mask, _ in plan.mask_index
+    }
+    assert masks == {(0xFF00, 0x0000), (0xFF00, 0xFFFF)}
+    assert sum(len(masked) for _, _, masked in plan.mask_index) == len(
+        plan.repeating_rules
+    )
+
+
+def test_register_vr_handler(monkeypatch):
+    elem = pydicom.DataElement((0x0010, 0x21B0), "LT", "long history")
+    with pytest.raises(NotImplementedError):
+        smpd.empty_element(elem)
+    # monkeypatch restores the registry after the test
+    monkeypatch.setitem(smpd.EMPTY_VR_HANDLERS, "LT", None)
+    smpd.register_vr_handler("empty", "LT", smpd.empty_element_value)
+    smpd.empty_element(elem)
+    assert elem.value == ""
+
+
+def test_sequence_handlers_get_converted_elements():
+    item = pydicom.Dataset()
+    item.add_new((0x0008, 0x0080), "LO", "Uni Name")
+    ds = pydicom.Dataset()
+    ds.add_new((0x0008, 0x1111), "SQ", pydicom.Sequence([item]))
+    raw = pydicom.dataelem.RawDataElement(
+        pydicom.tag.Tag(0x0008, 0x0080), "LO", 8, b"Uni Name", 0, False, True
+    )
+    # datasets read from file keep elements raw until accessed
+    item._dict[raw.tag] = raw
+    smpd.replace_element(ds[0x0008, 0x1111])
+    assert ds[0x0008, 0x1111].value[0][0x0008, 0x0080].value == "Anonymized"
+
+
+def test_keyed_uid_mapper(monkeypatch):
+    monkeypatch.setattr(smpd, "_uid_mapper", smpd.KeyedUIDMapper(b"secret", "1.2.3"))
+    uid = dcm_elements["UI"]["value"]
+    first = pydicom.DataElement(0x0020000D, "UI", uid)
+    smpd.replace_element_UID(first)
+    assert first.value.startswith("1.2.3.")
+    assert len(first.value) <= 64
+    assert pydicom.uid.UID(first.value).is_valid
+    # no state, same secret gives the same UID
+    assert smpd.KeyedUIDMapper(b"secret", "1.2.3").map(uid) == first.value
+    assert smpd.KeyedUIDMapper(b"other", "1.2.3").map(uid) != first.value
+
+    multi = pydicom.DataElement(0x00081150, "UI", [uid, "1.2.3.4"])
+    smpd.replace_element_UID(multi)
+    assert multi.value[0] == first.value
+
+
+@pytest.mark.parametrize("uid_root", ["", "1.02", "1." + "1" * 50])
+def test_keyed_uid_mapper_invalid_root(uid_root):
+    with pytest.raises(ValueError):
+        smpd.KeyedUIDMapper(b"secret", uid_root)
+
+
+PIXELS = bytes(range(256)) * 64
+
+
+@pytest.mark.parametrize("trailing", [False, True])
+def test_pixel_passthrough_same_as_full(tmp_path, make_dicom_file, trailing):
+    in_file = make_dicom_file("in.dcm", pixel_bytes=PIXELS)
+    if trailing:
+        ds = pydicom.dcmread(in_file)
+        # private element after the pixel data, passthrough can't be used
+        ds.private_block(0x7FE1, "Vendor", create=True).add_new(0x01, "LO", "x")
+        ds.save_as(in_file)
+
+    header = smpd.read_dicom_header(in_file)
+    assert "PixelData" not in header or trailing
+    assert (getattr(header, "pixel_payload", None) is None) == trailing
+
+    smpd.anonymize_dicom_file(in_file, tmp_path / "full.dcm")
+    smpd.anonymize_dicom_file(in_file, tmp_path / "fast.dcm", pixel_passthrough=True)
+    full = (tmp_path / "full.dcm").read_bytes()
+    assert full == (tmp_path / "fast.dcm").read_bytes()
+    assert pydicom.dcmread(tmp_path / "fast.dcm").PixelData == PIXELS
+
+
+def test_pixel_passthrough_not_used_if_rule_touches_pixels(tmp_path, make_dicom_file):
+    in_file = make_dicom_file("in.dcm", pixel_bytes=PIXELS)
+    plan = smpd.build_plan({(0x7FE0, 0x0010): smpd.delete})
+    assert plan.touches_pixel_data
+    smpd.anonymize_dicom_file(
+        in_file, tmp_path / "out.dcm", plan=plan, pixel_passthrough=True
+    )
+    assert "PixelData" not in pydicom.dcmread(tmp_path / "out.dcm")
+
+
+@pytest.mark.parametrize("pixel_passthrough", [False, True])
+def test_mmap_same_as_regular_read(tmp_path, make_dicom_file, pixel_passthrough):
+    in_file = make_dicom_file("in.dcm", pixel_bytes=PIXELS)
+    smpd.anonymize_dicom_file(in_file, tmp_path / "regular.dcm")
+    smpd.anonymize_dicom_file(
+        in_file,
+        tmp_path / "mmap.dcm",
+        pixel_passthrough=pixel_passthrough,
+        use_mmap=True,
+    )
+    regular = (tmp_path / "regular.dcm").read_bytes()
+    assert regular == (tmp_path / "mmap.dcm").read_bytes()
+
+
+def test_read_dataset_without_preamble(tmp_path):
+    ds = pydicom.Dataset()
+    ds.PatientName = "Demyanchuk^Alexey"
+    ds.save_as(tmp_path / "raw", implicit_vr=True, little_endian=True)
+    assert smpd.read_dicom_file(tmp_path / "raw").PatientName == "Demyanchuk^Alexey"
+    (tmp_path / "junk").write_bytes(b"%PDF-1.4\n")
+    assert smpd.read_dicom_file(tmp_path / "junk") is None
+
+
+def test_anonymize_bytes_same_as_file(tmp_path, make_dicom_file):
+    in_file = make_dicom_file("in.dcm", pixel_bytes=PIXELS)
+    smpd.anonymize_dicom_file(in_file, tmp_path / "out.dcm")
+    data = in_file.read_bytes()
+    assert smpd.anonymize_bytes(data) == (tmp_path / "out.dcm").read_bytes()
+    # the source data is not modified
+    assert data == in_file.read_bytes()
+    assert smpd.anonymize_bytes(b"%PDF-1.4\n") is None
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_anonymize_stream(tmp_path, make_dicom_file, in_memory):
+    in_file = make_dicom_file("in.dcm", pixel_bytes=PIXELS)
+    expected = smpd.anonymize_bytes(in_file.read_bytes())
+    out = io.BytesIO()
+    if in_memory:
+        assert smpd.anonymize_stream(io.BytesIO(in_file.read_bytes()), out)
+    else:
+        with open(in_file, "rb") as src:
+            assert smpd.anonymize_stream(src, out)
+    assert out.getvalue() == expected
+
+
+def test_pixel_passthrough_deflated(tmp_path, make_dicom_file):
+    in_file = make_dicom_file(
+        "in.dcm",
+        pixel_bytes=PIXELS,
+        transfer_syntax=pydicom.uid.DeflatedExplicitVRLittleEndian,
+    )
+    # deflated offsets don't map onto the file, the whole dataset is read
+    header = smpd.read_dicom_header(in_file)
+    assert getattr(header, "pixel_payload", None) is None
+    assert header.PixelData == PIXELS
+
+    smpd.anonymize_dicom_file(in_file, tmp_path / "fast.dcm", pixel_passthrough=True)
+    assert pydicom.dcmread(tmp_path / "fast.dcm").PixelData == PIXELS
+
+
+OVERLAY_RULES = [
+    ((0x6000, 0x0000, 0xFF00, 0x0000), smpd.replace),
+    ((0x6000, 0x1500, 0xFF00, 0xFFFF), smpd.empty),
+    ((0x6000, 0x0022, 0xFF00, 0xFFFF), smpd.delete),
+]
+
+
+@pytest.mark.parametrize("order", [(0, 1, 2), (1, 2, 0), (2, 0, 1), (1, 0, 2)])
+def test_overlapping_mask_rules_same_as_per_rule(order):
+    plan = smpd.AnonymizationPlan(tuple(OVERLAY_RULES[i] for i in order))
+    results = {}
+    for engine in smpd.ENGINES:
+        ds = pydicom.Dataset()
+        ds.add_new((0x6000, 0x1500), "LO", "overlay label")
+        ds.add_new((0x6000, 0x0022), "LO", "overlay description")
+        ds.add_new((0x6002, 0x1500), "LO", "another overlay label")
+        smpd.anonymize_dataset(ds, plan=plan, engine=engine)
+        results[engine] = ds
+    assert results["single_pass"] == results["per_rule"]
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from dicomanonymizer import batch_anonymizer as batch
+from dicomanonymizer import simpledicomanonymizer as smpd
+from dicomanonymizer.stage_metrics import (
+    BUCKETS,
+    StageMetrics,
+    observe_since,
+    observe_stage,
+    set_stage_metrics,
+    stage_start,
+)
+
+# keep UIDs, so the tests don't consume random numbers
+KEEP_UIDS = {(0x0002, 0x0003): smpd.keep, (0x0008, 0x0018): smpd.keep}
+
+
+@pytest.fixture
+def metrics(tmp_path):
+    metrics = StageMetrics(tmp_path / "metrics", export_interval=0)
+    set_stage_metrics(metrics)
+    yield metrics
+    set_stage_metrics(None)
+
+
+def test_disabled_by_default():
+    assert stage_start() is None
+    # no-ops without metrics
+    observe_stage("read", 1.0)
+    observe_since("read", None)
+
+
+def test_histogram_buckets(metrics):
+    observe_stage("read", 0.0001)
+    observe_stage("read", 0.003)
+    observe_stage("read", 100.0)
+    histogram = metrics.to_dict()["stages"]["read"]
+    assert histogram["count"] == 3
+    assert histogram["sum"] == pytest.approx(100.0031)
+    assert histogram["counts"][0] == 1
+    assert histogram["counts"][BUCKETS.index(0.005)] == 1
+    assert histogram["counts"][-1] == 1
+
+
+def test_prometheus_buckets_are_cumulative(metrics):
+    observe_stage("write", 0.0001)
+    observe_stage("write", 100.0)
+    text = metrics.to_prometheus()
+    assert "# TYPE dicomanonymizer_stage_seconds histogram" in text
+    labels = 'stage="write",worker="main"'
+    assert f'dicomanonymizer_stage_seconds_bucket{{{labels},le="0.0001"}} 1' in text
+    assert f'dicomanonymizer_stage_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+    assert f"dicomanonymizer_stage_seconds_count{{{labels}}} 2" in text
+
+
+def test_anonymize_dicom_file_stages(tmp_path, make_dicom_file, metrics):
+    f_in = make_dicom_file("in.dcm")
+    smpd.anonymize_dicom_file(
+        f_in, tmp_path / "out.dcm", plan=smpd.build_plan(KEEP_UIDS)
+    )
+    metrics.export()
+    exported = json.loads((tmp_path / "metrics/stages-main.json").read_text())
+    assert set(exported["stages"]) == {
+        "read",
+        "anonymize",
+        "write",
+        "rules",
+        "private_tags",
+    }
+    assert (tmp_path / "metrics/stages-main.prom").exists()
+
+
+def test_workers_export_their_metrics(tmp_path, make_dicom_file, metrics):
+    tasks = [(make_dicom_file(f"src/{i}.dcm"), tmp_path / f"{i}.dcm") for i in range(4)]
+    plan = smpd.build_plan(KEEP_UIDS)
+    list(batch.run_file_tasks(tasks, workers=2, plan=plan))
+    counts = [
+        json.loads(path.read_text())["stages"]["read"]["count"]
+        for path in (tmp_path / "metrics").glob("stages-worker-*.json")
+    ]
+    assert sum(counts) == len(tasks)
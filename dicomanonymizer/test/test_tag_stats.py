@@ -0,0 +1,37 @@
+from collections import Counter
+
+import pydicom
+
+from dicomanonymizer.tag_stats import TagStats, tag_keywords
+
+
+def make_dataset():
+    ds = pydicom.Dataset()
+    ds.PatientName = "Demyanchuk^Alexey"
+    item = pydicom.Dataset()
+    item.ReferencedSOPInstanceUID = "1.2.3"
+    ds.ReferencedImageSequence = pydicom.Sequence([item])
+    ds.private_block(0x0009, "Vendor", create=True).add_new(0x01, "LO", "private")
+    ds.add_new(0x00091100, "LO", "private without creator")
+    return ds
+
+
+def test_collect_top_level_public_tags():
+    assert sorted(TagStats().collect(make_dataset())) == [0x00081140, 0x00100010]
+
+
+def test_collect_nested_and_private_creators():
+    tags = TagStats(nested=True, private_creators=True).collect(make_dataset())
+    assert tag_keywords(Counter(tags)) == {
+        "ReferencedImageSequence": 1,
+        "ReferencedSOPInstanceUID": 1,
+        "PrivateCreator[Vendor]": 1,
+        "PatientName": 1,
+    }
+
+
+def test_tag_keywords_of_unknown_tags():
+    assert tag_keywords(Counter([0x00100010, 0x00100010, 0x00110010])) == {
+        "PatientName": 2,
+        "(0011,0010)": 1,
+    }
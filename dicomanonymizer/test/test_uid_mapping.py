@@ -0,0 +1,46 @@
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+
+from dicomanonymizer.uid_mapping import SQLiteUIDMapper
+
+UIDS = [f"1.2.826.0.1.3680043.2.{i}" for i in range(50)]
+
+
+def map_uids(mapper):
+    mapped = [mapper.map(uid) for uid in UIDS]
+    # write lock is held until replacements are committed
+    mapper.flush()
+    return mapped
+
+
+def test_sqlite_mapper_persistent(tmp_path):
+    mapper = SQLiteUIDMapper(tmp_path / "uids.db", batch_size=7)
+    first = map_uids(mapper)
+    mapper.close()
+    assert len(set(first)) == len(UIDS)
+    assert all(pydicom.uid.UID(uid).is_valid for uid in first)
+    assert all(uid.startswith("2.25.") for uid in first)
+
+    # new run, new process state
+    assert map_uids(SQLiteUIDMapper(tmp_path / "uids.db")) == first
+
+
+def test_sqlite_mapper_cache_is_bounded(tmp_path):
+    mapper = SQLiteUIDMapper(tmp_path / "uids.db", cache_size=10, uid_root="1.2.3")
+    first = map_uids(mapper)
+    assert len(mapper._cache) == 10
+    assert map_uids(mapper) == first
+    assert all(uid.startswith("1.2.3.") for uid in first)
+
+
+def test_sqlite_mapper_many_processes(tmp_path):
+    mapper = SQLiteUIDMapper(tmp_path / "uids.db", batch_size=3)
+    # mapper is pickled to the workers without its connection
+    restored = pickle.loads(pickle.dumps(mapper))
+    assert restored._conn is None
+    with ProcessPoolExecutor(4) as executor:
+        results = list(executor.map(map_uids, [mapper] * 8))
+    assert all(result == results[0] for result in results)
+    assert map_uids(mapper) == results[0]
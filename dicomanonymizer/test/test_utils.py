@@ -12,3 +12,15 @@ def test_to_Path():
 def test_to_Path_buggy():
     with pytest.raises(TypeError):
         utils.to_Path(1.2)
+
+
+def test_get_dirs_and_files(tmp_path):
+    for rel_path in ["a/1", "a/b/2", "c/3"]:
+        (tmp_path / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel_path).write_text("x")
+
+    dirs = [p.relative_to(tmp_path).as_posix() for p in utils.get_dirs(tmp_path)]
+    assert sorted(dirs) == ["a", "a/b", "c"]
+    # parent folder comes right before its subfolders
+    assert dirs.index("a/b") == dirs.index("a") + 1
+    assert [p.name for p in utils.get_files(tmp_path / "a")] == ["1"]
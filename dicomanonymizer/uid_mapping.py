@@ -0,0 +1,211 @@
+"""This module holds strategies used to replace UIDs (see `replace_element_UID`).
+The same original UID is always replaced with the same new UID within
+a mapper, so references between instances stay consistent.
+"""
+import hashlib
+import hmac
+import os
+import re
+import sqlite3
+from collections import OrderedDict
+from random import randint
+from typing import Dict, Optional
+
+from pydicom.uid import generate_uid
+
+from .defaults import UUID_DERIVED_ROOT
+from .utils import Path_Str
+
+# max length of a UID value (DICOM PS3.5 9.1)
+MAX_UID_LENGTH = 64
+
+_UID_ROOT_PATTERN = re.compile(r"^(0|[1-9][0-9]*)(\.(0|[1-9][0-9]*))*$")
+
+
+class UIDMapper:
+    """Base class of UID replacement strategies"""
+
+    def map(self, uid: str) -> str:
+        """Get replacement of the `uid`
+
+        Args:
+            uid (str): original UID
+
+        Returns:
+            str: replacement UID
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Make replacements done so far persistent (if mapper has a storage)"""
+        pass
+
+
+class RecordingUIDMapper(UIDMapper):
+    """Delegate to another mapper and record original -> new UID pairs it returned"""
+
+    def __init__(self, mapper: UIDMapper):
+        self.mapper = mapper
+        self.pairs: Dict[str, str] = {}
+
+    def map(self, uid: str) -> str:
+        replacement = self.mapper.map(uid)
+        self.pairs[uid] = replacement
+        return replacement
+
+    def flush(self) -> None:
+        self.mapper.flush()
+
+
+class RandomUIDMapper(UIDMapper):
+    """Keep char value but replace char number with random number.
+    Replacements are kept in memory (`cache`), so the same UID gets
+    the same replacement within the process.
+    """
+
+    def __init__(self, cache: Optional[Dict[str, str]] = None):
+        self.cache = {} if cache is None else cache
+
+    def map(self, uid: str) -> str:
+        if uid not in self.cache:
+            new_chars = [str(randint(0, 9)) if char.isalnum() else char for char in uid]
+            self.cache[uid] = "".join(new_chars)
+        return self.cache[uid]
+
+
+class KeyedUIDMapper(UIDMapper):
+    """Derive the replacement from the original UID with a keyed hash
+    (HMAC-SHA256 with a site secret): `<uid_root>.<digits of the hash>`.
+    No state is kept, so different processes, nodes and runs with the same
+    secret and root give the same replacements.
+    """
+
+    def __init__(self, secret: bytes, uid_root: str = UUID_DERIVED_ROOT):
+        if not secret:
+            raise ValueError("Secret for keyed UID mapping should not be empty")
+        if not _UID_ROOT_PATTERN.match(uid_root):
+            raise ValueError(f"Invalid UID root: {uid_root}")
+        # at least 16 digits for the hashed part, to keep collisions unlikely
+        self._max_digits = min(39, MAX_UID_LENGTH - len(uid_root) - 1)
+        if self._max_digits < 16:
+            raise ValueError(f"UID root {uid_root} is too long")
+        self.secret = secret
+        self.uid_root = uid_root
+
+    def map(self, uid: str) -> str:
+        if not uid:
+            return uid
+        digest = hmac.new(self.secret, uid.encode("ascii"), hashlib.sha256).digest()
+        # 128 bits fit into 39 decimal digits, no leading zeros by construction
+        digits = str(int.from_bytes(digest[:16], "big"))[: self._max_digits]
+        return f"{self.uid_root}.{digits}"
+
+
+class SQLiteUIDMapper(UIDMapper):
+    """Random (non-derivable) replacements kept in a SQLite database, so
+    re-runs give the same UIDs. A bounded LRU cache is kept in memory in front
+    of the database.
+
+    New replacements are inserted within a write transaction, which is committed
+    every `batch_size` new UIDs or on `flush` (called after every anonymized dataset,
+    before it is saved). Other processes wait for the write lock until then, so
+    call `flush` if the mapper is used outside of `anonymize_dataset`.
+
+    The database is in WAL mode and is safe to use from many processes: if two
+    processes map the same new UID, the first committed replacement wins and both
+    use it. Connection is opened lazily per process, so the mapper can be sent to
+    worker processes.
+    """
+
+    def __init__(
+        self,
+        db_path: Path_Str,
+        cache_size: int = 100_000,
+        batch_size: int = 256,
+        uid_root: str = UUID_DERIVED_ROOT,
+        timeout: float = 60.0,
+    ):
+        if not _UID_ROOT_PATTERN.match(uid_root):
+            raise ValueError(f"Invalid UID root: {uid_root}")
+        self.db_path = str(db_path)
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.uid_root = uid_root
+        self.timeout = timeout
+        self._cache = OrderedDict()
+        self._conn = None
+        self._pid = None
+        self._pending = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # connection and cache belong to the process, which created them
+        state.update(_cache=OrderedDict(), _conn=None, _pid=None, _pending=0)
+        return state
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            # connection inherited from a parent process (fork) must not be used
+            self._conn = sqlite3.connect(
+                self.db_path, timeout=self.timeout, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS uid_map "
+                "(original TEXT PRIMARY KEY, replacement TEXT NOT NULL) WITHOUT ROWID"
+            )
+            self._pid = os.getpid()
+            self._pending = 0
+        return self._conn
+
+    def _generate(self) -> str:
+        if self.uid_root == UUID_DERIVED_ROOT:
+            return generate_uid(prefix=None)
+        return generate_uid(prefix=f"{self.uid_root}.")
+
+    def _select(self, conn: sqlite3.Connection, uid: str) -> Optional[str]:
+        row = conn.execute(
+            "SELECT replacement FROM uid_map WHERE original = ?", (uid,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def map(self, uid: str) -> str:
+        if not uid:
+            return uid
+        replacement = self._cache.get(uid)
+        if replacement is not None:
+            self._cache.move_to_end(uid)
+            return replacement
+
+        conn = self._connection()
+        replacement = self._select(conn, uid)
+        if replacement is None:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR IGNORE INTO uid_map VALUES (?, ?)", (uid, self._generate())
+            )
+            # another process might have inserted it before we got the write lock
+            replacement = self._select(conn, uid)
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self.flush()
+
+        self._cache[uid] = replacement
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return replacement
+
+    def flush(self) -> None:
+        if self._conn is not None and self._pid == os.getpid():
+            if self._conn.in_transaction:
+                self._conn.execute("COMMIT")
+            self._pending = 0
+
+    def close(self) -> None:
+        """Commit pending replacements and close the connection"""
+        self.flush()
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
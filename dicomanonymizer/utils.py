@@ -1,5 +1,6 @@
+import os
 from pathlib import Path
-from typing import Callable, Dict, List, Tuple, Union
+from typing import Callable, Dict, Iterator, List, Tuple, Union
 
 import pydicom
 
@@ -69,8 +70,11 @@ def try_valid_dir(path: Path):
         raise NotADirectoryError
 
 
-def get_dirs(root_path: Path):
-    """Finds all folders in the root recursivly
+def get_dirs(root_path: Path) -> Iterator[Path]:
+    """Finds all folders in the root recursivly (depth first, a folder before
+    its subfolders). Folders are yielded while the tree is being listed, only the
+    listings on the path to the current folder are open. Entry types are taken
+    from the listing (`os.scandir`), without a stat per entry.
 
     Args:
         root_path (Path): root path
@@ -78,7 +82,30 @@ def get_dirs(root_path: Path):
     Yields:
         Path: directory inside the root path
     """
-    for p in root_path.iterdir():
-        if p.is_dir():
-            yield p
-            yield from get_dirs(p)
+    listings = [os.scandir(root_path)]
+    try:
+        while listings:
+            entry = next(listings[-1], None)
+            if entry is None:
+                listings.pop().close()
+            elif entry.is_dir():
+                yield Path(entry.path)
+                listings.append(os.scandir(entry.path))
+    finally:
+        for listing in listings:
+            listing.close()
+
+
+def get_files(dir_path: Path) -> Iterator[Path]:
+    """Lazily list files of the folder (not recursively), see `get_dirs`
+
+    Args:
+        dir_path (Path): folder path
+
+    Yields:
+        Path: file inside the folder
+    """
+    with os.scandir(dir_path) as listing:
+        for entry in listing:
+            if entry.is_file():
+                yield Path(entry.path)